@@ -0,0 +1,93 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Code shared by the benchmarks.
+"""
+import pyperf
+
+from persistent import Persistent
+from persistent.picklecache import PickleCache
+from persistent.picklecache import PickleCachePy
+
+
+# Which implementation we are measuring; PURE_PYTHON=1 selects the
+# Python one.
+IMPLEMENTATION = 'python' if PickleCache is PickleCachePy else 'c'
+
+
+class Item(Persistent):
+    """A persistent object keeping its state in its ``__dict__``."""
+
+
+class SlottedItem(Persistent):
+    """A persistent object keeping its state in slots."""
+
+    __slots__ = ('a', 'b', 'c')
+
+
+class MemoryJar:
+    """A stand-in for a ZODB connection, keeping the states of its objects
+    in a dict instead of loading them from a storage.
+    """
+
+    def __init__(self):
+        self.states = {}
+
+    def setstate(self, obj):
+        obj.__setstate__(self.states[obj._p_oid])
+
+    def register(self, obj):
+        "Does nothing"
+
+    def readCurrent(self, obj):
+        "Does nothing"
+
+
+def make_oid(i):
+    return i.to_bytes(8, 'big')
+
+
+def make_ghosts(count, cache_size=None, klass=Item, state=None):
+    """Return a cache with *count* ghosts of *klass* and the ghosts.
+
+    When the ghosts are activated, they get *state*.
+    """
+    jar = MemoryJar()
+    cache = PickleCache(jar, count if cache_size is None else cache_size)
+    ghosts = []
+    for i in range(count):
+        oid = make_oid(i)
+        ghost = klass()
+        cache.new_ghost(oid, ghost)
+        jar.states[oid] = state if state is not None else {'value': i}
+        ghosts.append(ghost)
+    return cache, ghosts
+
+
+def make_runner():
+    """Return a :class:`pyperf.Runner` for the implementation in use."""
+    runner = pyperf.Runner(
+        metadata={'persistent_implementation': IMPLEMENTATION})
+    # The worker processes must measure the same implementation.
+    runner.argparser.set_defaults(inherit_environ=['PURE_PYTHON'])
+    return runner
+
+
+def bench_time_func(runner, name, time_func, *args):
+    """Run a benchmark, naming it after the implementation, too.
+
+    Measuring both implementations and comparing each of them to an
+    earlier run shows regressions per implementation.
+    """
+    return runner.bench_time_func(
+        f'{IMPLEMENTATION}_{name}', time_func, *args)
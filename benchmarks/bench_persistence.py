@@ -0,0 +1,82 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks of persistent objects: activation and pickling.
+
+Each benchmark times operations on COUNT objects.
+"""
+from time import perf_counter
+
+from _support import Item
+from _support import SlottedItem
+from _support import bench_time_func
+from _support import make_ghosts
+from _support import make_runner
+
+
+COUNT = 1000
+
+STATE = {'a': 1, 'b': 'two', 'c': (3.0,)}
+
+SLOTTED_STATE = (None, STATE)
+
+
+def time_activate(loops):
+    elapsed = 0
+    for _ in range(loops):
+        cache, ghosts = make_ghosts(COUNT, state=STATE)
+        t0 = perf_counter()
+        for ghost in ghosts:
+            ghost._p_activate()
+        elapsed += perf_counter() - t0
+    return elapsed
+
+
+def _make_objects(klass, state):
+    objs = [klass() for _ in range(COUNT)]
+    for obj in objs:
+        obj.__setstate__(state)
+    return objs
+
+
+def time_getstate(loops, klass, state):
+    objs = _make_objects(klass, state)
+    t0 = perf_counter()
+    for _ in range(loops):
+        for obj in objs:
+            obj.__getstate__()
+    return perf_counter() - t0
+
+
+def time_setstate(loops, klass, state):
+    objs = _make_objects(klass, state)
+    t0 = perf_counter()
+    for _ in range(loops):
+        for obj in objs:
+            obj.__setstate__(state)
+    return perf_counter() - t0
+
+
+def main():
+    runner = make_runner()
+    bench_time_func(runner, 'persistent_activate', time_activate)
+    for name, klass, state in (('dict', Item, STATE),
+                               ('slots', SlottedItem, SLOTTED_STATE)):
+        bench_time_func(runner, f'persistent_getstate_{name}',
+                        time_getstate, klass, state)
+        bench_time_func(runner, f'persistent_setstate_{name}',
+                        time_setstate, klass, state)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks of the pickle cache.
+
+Each benchmark times operations on COUNT objects.
+"""
+from time import perf_counter
+
+from _support import Item
+from _support import MemoryJar
+from _support import bench_time_func
+from _support import make_ghosts
+from _support import make_oid
+from _support import make_runner
+
+from persistent.picklecache import PickleCache
+
+
+COUNT = 1000
+
+# Fill levels for incrgc, as multiples of the cache size.
+FILL_LEVELS = (0.5, 1, 2, 4)
+
+
+def time_setitem(loops):
+    elapsed = 0
+    for _ in range(loops):
+        jar = MemoryJar()
+        cache = PickleCache(jar, COUNT)
+        items = [(make_oid(i), Item()) for i in range(COUNT)]
+        for oid, obj in items:
+            obj._p_oid = oid
+            obj._p_jar = jar
+        t0 = perf_counter()
+        for oid, obj in items:
+            cache[oid] = obj
+        elapsed += perf_counter() - t0
+    return elapsed
+
+
+def time_new_ghost(loops):
+    elapsed = 0
+    for _ in range(loops):
+        cache = PickleCache(MemoryJar(), COUNT)
+        items = [(make_oid(i), Item()) for i in range(COUNT)]
+        t0 = perf_counter()
+        for oid, obj in items:
+            cache.new_ghost(oid, obj)
+        elapsed += perf_counter() - t0
+    return elapsed
+
+
+def time_new_ghost_many(loops):
+    # The same as time_new_ghost, adding all of them in one call.
+    elapsed = 0
+    for _ in range(loops):
+        cache = PickleCache(MemoryJar(), COUNT)
+        items = [(make_oid(i), Item()) for i in range(COUNT)]
+        t0 = perf_counter()
+        cache.new_ghost_many(items)
+        elapsed += perf_counter() - t0
+    return elapsed
+
+
+def time_get(loops, hit):
+    cache, ghosts = make_ghosts(COUNT)
+    oids = [make_oid(i if hit else COUNT + i) for i in range(COUNT)]
+    get = cache.get
+    t0 = perf_counter()
+    for _ in range(loops):
+        for oid in oids:
+            get(oid)
+    return perf_counter() - t0
+
+
+def time_mru(loops, buffer_size=0):
+    # Only the Python implementation has mru(). Both move an up-to-date
+    # object to the most recently used end of the ring when one of its
+    # attributes is accessed, so that is what we measure. With an access
+    # buffer, they do that in batches.
+    cache, ghosts = make_ghosts(COUNT)
+    cache.set_access_buffer(buffer_size)
+    for ghost in ghosts:
+        ghost._p_activate()
+    t0 = perf_counter()
+    for _ in range(loops):
+        # Moving the least recently used object each time.
+        for obj in ghosts:
+            obj.value
+    return perf_counter() - t0
+
+
+def time_incrgc(loops, fill_level):
+    elapsed = 0
+    cache_size = int(COUNT / fill_level)
+    for _ in range(loops):
+        cache, ghosts = make_ghosts(COUNT, cache_size)
+        for ghost in ghosts:
+            ghost._p_activate()
+        t0 = perf_counter()
+        cache.incrgc()
+        elapsed += perf_counter() - t0
+    return elapsed
+
+
+def time_invalidate(loops):
+    elapsed = 0
+    for _ in range(loops):
+        cache, ghosts = make_ghosts(COUNT)
+        for ghost in ghosts:
+            ghost._p_activate()
+        oids = [ghost._p_oid for ghost in ghosts]
+        t0 = perf_counter()
+        cache.invalidate(oids)
+        elapsed += perf_counter() - t0
+    return elapsed
+
+
+def main():
+    runner = make_runner()
+    bench_time_func(runner, 'cache_setitem', time_setitem)
+    bench_time_func(runner, 'cache_new_ghost', time_new_ghost)
+    bench_time_func(runner, 'cache_new_ghost_many', time_new_ghost_many)
+    bench_time_func(runner, 'cache_get_hit', time_get, True)
+    bench_time_func(runner, 'cache_get_miss', time_get, False)
+    bench_time_func(runner, 'cache_mru', time_mru)
+    bench_time_func(runner, 'cache_mru_buffered', time_mru, 256)
+    for fill_level in FILL_LEVELS:
+        bench_time_func(runner, f'cache_incrgc_fill_{fill_level:g}',
+                        time_incrgc, fill_level)
+    bench_time_func(runner, 'cache_invalidate', time_invalidate)
+
+
+if __name__ == '__main__':
+    main()
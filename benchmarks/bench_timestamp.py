@@ -0,0 +1,53 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks of TimeStamp construction.
+"""
+from time import perf_counter
+
+from _support import bench_time_func
+from _support import make_runner
+
+from persistent.timestamp import TimeStamp
+
+
+COUNT = 1000
+
+FIELDS = (2026, 10, 18, 12, 30, 15.5)
+
+
+def time_from_fields(loops):
+    t0 = perf_counter()
+    for _ in range(loops):
+        for _ in range(COUNT):
+            TimeStamp(*FIELDS)
+    return perf_counter() - t0
+
+
+def time_from_bytes(loops):
+    raw = TimeStamp(*FIELDS).raw()
+    t0 = perf_counter()
+    for _ in range(loops):
+        for _ in range(COUNT):
+            TimeStamp(raw)
+    return perf_counter() - t0
+
+
+def main():
+    runner = make_runner()
+    bench_time_func(runner, 'timestamp_from_fields', time_from_fields)
+    bench_time_func(runner, 'timestamp_from_bytes', time_from_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -187,6 +187,7 @@ def use_c_impl(py_impl, name=None, globs=None, mod_name=None):
             if new_globals is None:
                 new_globals = v.__globals__.copy()
                 new_globals[py_impl.__name__] = py_impl
+            kwdefaults = v.__kwdefaults__
             v = types.FunctionType(
                 v.__code__,
                 new_globals,
@@ -194,6 +195,7 @@ def use_c_impl(py_impl, name=None, globs=None, mod_name=None):
                 v.__defaults__,
                 v.__closure__,
             )
+            v.__kwdefaults__ = kwdefaults
             if static:
                 v = staticmethod(v)
             setattr(py_impl, k, v)
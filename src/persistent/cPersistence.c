@@ -87,6 +87,67 @@ static PyObject * pickle_slotnames(PyTypeObject *cls);
 
 static PyObject * convert_name(PyObject *name);
 
+/* Seconds from the performance counter, for measuring durations. */
+static double
+perf_counter(void)
+{
+#if PY_VERSION_HEX >= 0x030D0000
+    PyTime_t t;
+
+    if (PyTime_PerfCounterRaw(&t) < 0)
+    {
+        PyErr_Clear();
+        return 0.0;
+    }
+    return PyTime_AsSecondsDouble(t);
+#else
+    return _PyTime_AsSecondsDouble(_PyTime_GetPerfCounter());
+#endif
+}
+
+/* Whether the cache of the object has a trace hook (see
+   PickleCache.set_trace_hook()). This is all tracing costs when there
+   is none. */
+#define TRACING(O) ((O)->cache && (O)->cache->trace_hook)
+
+/* Whether unghostify() has to measure how long loading the object
+   takes, for the trace hook or the cache's activation histogram (see
+   PickleCache.set_activation_histogram()). */
+#define TIMING(O) (TRACING(O) \
+    || ((O)->cache && (O)->cache->activation_histogram))
+
+/* Call the trace hook of the object's cache with the event, the object's
+   oid and class, the duration (None if negative) and the cause (the
+   trace_cause of the cache, set while it works on objects, or None).
+   Errors are reported as unraisable, and a pending exception is kept. */
+static void
+trace(cPersistentObject *self, const char *event, double duration,
+      const char *cause)
+{
+    PyObject *hook = self->cache->trace_hook;
+    PyObject *errtype, *errvalue, *errtb, *seconds, *r = NULL;
+
+    PyErr_Fetch(&errtype, &errvalue, &errtb);
+    Py_INCREF(hook);
+    if (duration < 0)
+    {
+        seconds = Py_None;
+        Py_INCREF(seconds);
+    }
+    else
+        seconds = PyFloat_FromDouble(duration);
+    if (seconds)
+        r = PyObject_CallFunction(hook, "sOONz", event,
+                                  self->oid ? self->oid : Py_None,
+                                  (PyObject *)Py_TYPE(self), seconds, cause);
+    if (r == NULL)
+        PyErr_WriteUnraisable(hook);
+    else
+        Py_DECREF(r);
+    Py_DECREF(hook);
+    PyErr_Restore(errtype, errvalue, errtb);
+}
+
 /* Load the state of the object, unghostifying it.  Upon success, return 1.
  * If an error occurred, re-ghostify the object and return -1.
  */
@@ -95,24 +156,43 @@ unghostify(cPersistentObject *self)
 {
     if (self->state < 0 && self->jar)
     {
-        PyObject *r;
+        PyObject *r, *was_loading = NULL;
+        PerCache *cache = self->cache;
+        double start = -1.0;
 
         /* Is it ever possible to not have a cache? */
         if (self->cache)
         {
+            Py_ssize_t size = CACHE_OBJECT_SIZE(self->cache, self);
+
             /* Create a node in the ring for this unghostified object. */
             self->cache->non_ghost_count++;
-            self->cache->total_estimated_size +=
-                _estimated_size_in_bytes(self->estimated_size);
-            ring_add(&self->cache->ring_home, &self->ring);
+            self->cache->total_estimated_size += size;
+            CACHE_ACCOUNT(self->cache, self, 1, size);
+            ring_add(self->cache->ring_insert, &self->ring);
             Py_INCREF(self);
         }
         /* set state to CHANGED while setstate() call is in progress
             to prevent a recursive call to _PyPersist_Load().
         */
         self->state = cPersistent_CHANGED_STATE;
+        if (TIMING(self))
+            start = perf_counter();
+        /* Let the cache see what we look up while loading. It may leave
+           the cache meanwhile, so keep it. */
+        if (cache)
+        {
+            Py_INCREF(cache);
+            was_loading = cache->loading;
+            cache->loading = (PyObject *)self;
+        }
         /* Call the object's __setstate__() */
         r = PyObject_CallMethod(self->jar, "setstate", "O", (PyObject *)self);
+        if (cache)
+        {
+            cache->loading = was_loading;
+            Py_DECREF(cache);
+        }
         if (r == NULL)
         {
             ghostify(self);
@@ -133,6 +213,19 @@ unghostify(cPersistentObject *self)
             return -1;
 #endif
         }
+        if (self->cache && self->cache->loaded
+            && self->cache->loaded(self->cache, (PyObject *)self) < 0)
+            return -1;
+        if (start >= 0 && self->cache)
+        {
+            double duration = perf_counter() - start;
+
+            if (self->cache->activation_histogram)
+                self->cache->record_activation(
+                    self->cache, (PyObject *)Py_TYPE(self), duration);
+            if (self->cache->trace_hook)
+                trace(self, "activate", duration, self->cache->trace_cause);
+        }
     }
     return 1;
 }
@@ -141,12 +234,48 @@ unghostify(cPersistentObject *self)
 
 static PyTypeObject Pertype;
 
+static void
+buffer_access(PerCache *cache, cPersistentObject *self)
+{
+    /* Record the access in the cache's access buffer, draining it into
+       the ring first if it is full. */
+#ifdef Py_GIL_DISABLED
+    Py_BEGIN_CRITICAL_SECTION((PyObject *)cache);
+#endif
+    if (cache->access_buffer_used == cache->access_buffer_size)
+        cache->drain_accesses(cache);
+    cache->access_buffer[cache->access_buffer_used++] = (PyObject *)self;
+#ifdef Py_GIL_DISABLED
+    Py_END_CRITICAL_SECTION();
+#endif
+}
+
 static void
 accessed(cPersistentObject *self)
 {
-    /* Do nothing unless the object is in a cache and not a ghost. */
+    /* Do nothing unless the object is in a cache and not a ghost.
+
+       An object that is still the newest one linked in front of
+       ring_insert is not moved: for a plain LRU ring it is already the
+       most recently used object, and for a segmented ring this keeps the
+       accesses that immediately follow loading an object from promoting
+       it out of the probationary segment.
+
+       A cache using the "clock" policy only notes the access; its
+       garbage collection moves referenced objects when it gets to them.
+       A cache with an access buffer moves the objects in batches.
+    */
     if (self->cache && self->state >= 0 && self->ring.r_next)
-        ring_move_to_head(&self->cache->ring_home, &self->ring);
+    {
+        self->cache->access_count++;
+        if (self->cache->reference
+            && self->cache->reference(self->cache, (PyObject *)self))
+            return;
+        if (self->cache->access_buffer)
+            buffer_access(self->cache, self);
+        else if (self->ring.r_next != self->cache->ring_insert)
+            ring_move_to_head(&self->cache->ring_home, &self->ring);
+    }
 }
 
 static void
@@ -154,6 +283,7 @@ ghostify(cPersistentObject *self)
 {
     PyObject **dictptr, *slotnames;
     PyObject *errtype, *errvalue, *errtb;
+    Py_ssize_t size;
 
     /* are we already a ghost? */
     if (self->state == cPersistent_GHOST_STATE)
@@ -176,11 +306,15 @@ ghostify(cPersistentObject *self)
 #endif
     }
 
+    if (TRACING(self))
+        trace(self, "ghostify", -1.0, self->cache->trace_cause);
+
     /* If we're ghostifying an object, we better have some non-ghosts. */
     assert(self->cache->non_ghost_count > 0);
+    size = CACHE_OBJECT_SIZE(self->cache, self);
     self->cache->non_ghost_count--;
-    self->cache->total_estimated_size -=
-        _estimated_size_in_bytes(self->estimated_size);
+    self->cache->total_estimated_size -= size;
+    CACHE_ACCOUNT(self->cache, self, -1, -size);
     ring_del(&self->ring);
     self->state = cPersistent_GHOST_STATE;
 
@@ -278,6 +412,8 @@ changed(cPersistentObject *self)
         Py_DECREF(result);
 
         self->state = cPersistent_CHANGED_STATE;
+        if (TRACING(self))
+            trace(self, "register", -1.0, self->cache->trace_cause);
     }
 
     return 0;
@@ -770,11 +906,13 @@ Per_dealloc(cPersistentObject *self)
         */
         if (self->ring.r_next != NULL)
         {
+            Py_ssize_t size = CACHE_OBJECT_SIZE(self->cache, self);
+
             /* if we're ghostifying an object, we better have some non-ghosts */
             assert(self->cache->non_ghost_count > 0);
             self->cache->non_ghost_count--;
-            self->cache->total_estimated_size -=
-                _estimated_size_in_bytes(self->estimated_size);
+            self->cache->total_estimated_size -= size;
+            CACHE_ACCOUNT(self->cache, self, -1, -size);
             ring_del(&self->ring);
         }
     }
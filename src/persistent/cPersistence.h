@@ -16,20 +16,74 @@
 #define CPERSISTENCE_H
 
 #include "_compat.h"
+#include <stdint.h>
 #include "bytesobject.h"
 
 #include "ring.h"
 
+/* ring_insert is the node in front of which newly loaded objects are
+   linked into the ring. For a plain LRU cache that is ring_home (so new
+   objects become the most recently used); segmented eviction policies
+   point it at the boundary between their probationary and protected
+   segments. access_count counts the accesses to non-ghost objects in
+   the cache, for the cache's statistics.
+
+   A cache using the "clock" eviction policy doesn't reorder its ring
+   on accesses. Instead, accessed() calls its reference hook, which
+   marks the object as referenced and returns 1, or returns 0 if it
+   can't, in which case the object is moved as usual. The hook is NULL
+   for the other policies.
+
+   If account is not NULL, it is called (through CACHE_ACCOUNT) for
+   every change an object makes to non_ghost_count and
+   total_estimated_size, with the object and the amounts of the
+   change. The cache uses it to keep statistics per class.
+
+   While unghostify() loads an object's state, loading is the object
+   (a borrowed reference). The cache uses it to note which objects
+   refer to ghosts.
+
+   If loaded is not NULL, unghostify() calls it after loading an
+   object's state. The cache uses it to estimate the size of the state;
+   it returns -1 (with an exception set) for errors.
+
+   If object_size is not NULL, it returns the estimated size in bytes
+   of an object in the cache, to be used instead of the one in its
+   estimated_size field (see CACHE_OBJECT_SIZE). The cache uses it to
+   keep exact sizes in a table of its own. It must not fail or call
+   Python code. */
 #define CACHE_HEAD \
     PyObject_HEAD \
     CPersistentRing ring_home; \
     int non_ghost_count; \
-    Py_ssize_t total_estimated_size;
+    Py_ssize_t total_estimated_size; \
+    CPersistentRing *ring_insert; \
+    Py_ssize_t access_count; \
+    int (*reference)(PerCache *, PyObject *); \
+    void (*account)(PerCache *, PyObject *, int, Py_ssize_t); \
+    PyObject *loading; \
+    int (*loaded)(PerCache *, PyObject *); \
+    Py_ssize_t (*object_size)(PerCache *, PyObject *); \
+    PyObject **access_buffer; \
+    int access_buffer_size; \
+    int access_buffer_used; \
+    void (*drain_accesses)(PerCache *); \
+    PyObject *trace_hook; \
+    const char *trace_cause; \
+    PyObject *activation_histogram; \
+    void (*record_activation)(PerCache *, PyObject *, double);
 
 struct ccobject_head_struct;
 
 typedef struct ccobject_head_struct PerCache;
 
+#define CACHE_ACCOUNT(CACHE, O, COUNT, BYTES) \
+    do { \
+        if ((CACHE)->account) \
+            (CACHE)->account((PerCache *)(CACHE), (PyObject *)(O), \
+                             (COUNT), (BYTES)); \
+    } while (0)
+
 /* How big is a persistent object?
 
    12  PyGC_Head is two pointers and an int
@@ -83,6 +137,13 @@ typedef struct ccobject_head_struct PerCache;
 #define _estimated_size_in_24_bits(I) ((I) > 1073741696 ? 16777215 : (I)/64+1)
 #define _estimated_size_in_bytes(I) ((I)*64)
 
+/* The estimated size in bytes that cache CACHE counts for object O. */
+#define CACHE_OBJECT_SIZE(CACHE, O) \
+    ((CACHE)->object_size \
+     ? (CACHE)->object_size((PerCache *)(CACHE), (PyObject *)(O)) \
+     : (Py_ssize_t)_estimated_size_in_bytes( \
+         ((cPersistentObject *)(O))->estimated_size))
+
 #define cPersistent_GHOST_STATE -1
 #define cPersistent_UPTODATE_STATE 0
 #define cPersistent_CHANGED_STATE 1
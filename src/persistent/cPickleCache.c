@@ -85,6 +85,126 @@
   the ring, however they can not be deactivated. The garbage collection
   process must skip such objects, rather than deactivating them.
 
+  Eviction Policies
+
+  By default the ring is a plain LRU list. A cache can instead be
+  created with one of the segmented eviction policies ("slru", "2q" or
+  "arc"). These keep one permanent marker node, ring_segment, in the
+  ring. Objects between the home position and the marker form the
+  probationary segment, objects between the marker and the home
+  position form the protected segment:
+
+     home -> probation (LRU ... MRU) -> marker -> protected (LRU ... MRU)
+
+  Newly loaded objects are linked in just before the marker (this is
+  what ring_insert in the CACHE_HEAD points at), and are only moved to
+  the protected segment when they are accessed again after some other
+  object has been loaded. A single large scan therefore only churns the
+  probationary segment, which the garbage collection process ghostifies
+  first. When it runs out of probationary objects, it demotes the least
+  recently used protected objects that exceed the protected segment's
+  target size and continues with those.
+
+  The "2q" and "arc" policies also remember the oids of recently
+  ghostified objects. An object found in that history when the garbage
+  collection process reaches it in the probationary segment was loaded
+  again soon after being evicted, so it is promoted instead of
+  ghostified. The "arc" policy additionally adapts the target size of
+  the segments to which history the hits come from.
+
+  The marker is never a persistent object; code walking the ring has to
+  skip it.
+
+  The "clock" policy keeps the plain ring, but accessing an object only
+  sets the reference bit in its entry of the oid index (through the
+  reference hook of the CACHE_HEAD) instead of moving it to the most
+  recently used end of the ring. When an incremental garbage collection
+  process gets to an up-to-date object whose bit is set, it clears the
+  bit and moves the object to the most recently used end, giving it a
+  second chance. Objects with oids the index can't hold are moved on
+  every access, as with "lru". Read-heavy code
+  thus avoids relinking the ring on every attribute access, at the price
+  of a ring that is only roughly in LRU order.
+
+  Access Buffers
+
+  With the other policies, set_access_buffer() can give the cache an
+  access buffer, a small array of object pointers in the CACHE_HEAD.
+  Accessing an object then only appends it to the buffer, and the
+  objects are moved to the most recently used end of the ring in
+  batches, in the order they were accessed: when the buffer is full,
+  before a garbage collection process and before listing the ring. The
+  buffer doesn't hold references; it is drained before an object can
+  leave the cache (cc_del_item) or be deallocated (cc_oid_unreferenced),
+  so the objects in it are alive and in this cache.
+
+  Activation Histograms
+
+  set_activation_histogram() makes the cache count how long loading
+  the state of its objects takes, per class. unghostify() in
+  cPersistence.c measures the jar.setstate() call and passes the class
+  and the duration to the record_activation hook of the CACHE_HEAD. The
+  durations are counted in buckets whose upper bounds are powers of two
+  microseconds, from 1 microsecond to about 17 seconds, and a last
+  bucket for anything longer. The activation_histogram dict maps each
+  class to a list of its total count followed by the bucket counts.
+
+  Class Quotas
+
+  The cache counts the non-ghost objects of each class and their
+  estimated size, through the account hook of the CACHE_HEAD. A class
+  can be given a quota, a maximum number of non-ghost objects. Before
+  an incremental garbage collection process applies the eviction
+  policy, it ghostifies the least recently used objects of the classes
+  over their quotas until they aren't anymore.
+
+  Pins and Priorities
+
+  The priorities dict maps oids to priorities given with pin() (None)
+  and set_priority() (ints above 0); other objects have priority 0.
+  Garbage collection processes never ghostify pinned objects. Incremental
+  ones leave the objects with a priority above 0 alone while they apply
+  the eviction policy (and quotas and the ghost limit) to the others.
+  If the cache is still over its target size after that, they ghostify
+  the least recently used up-to-date objects with the lowest priority,
+  then those with the next priority and so on (see evict_by_priority()).
+  The dict is keyed by oid, so objects keep their priority when they
+  leave the cache and come back.
+
+  Budgeted Collection
+
+  The incrgc, full_sweep and minimize methods accept a time limit
+  (max_seconds) and a limit on the number of objects examined
+  (max_objects). When a garbage collection process runs out of either,
+  it links another permanent node, ring_cursor, into the ring in front
+  of the next object it would have examined and stops. The next garbage
+  collection process starts from ring_cursor (and unlinks it) instead of
+  from the least recently used object, so that a series of limited calls
+  makes progress through the whole ring. Like the segment marker, code
+  walking the ring has to skip ring_cursor.
+
+  Ring Iterators
+
+  The iterators returned by iter_lru_items() link two nodes of their own
+  into the ring when they are created: one at the most recently used
+  end, where the iteration stops, and one in front of the next object to
+  produce, which they move along. Objects can thus be loaded, accessed
+  and ghostified while an iteration is in progress, and the iteration
+  still ends (objects accessed meanwhile move past its end). The cache
+  keeps a list of its live iterators so that code walking the ring can
+  recognize their nodes (IS_CACHE_MARKER).
+
+  The OID Index
+
+  Persistent objects (but not classes) with 8-byte oids, which is what
+  ZODB uses, aren't kept in self->data, but in self->index, an open
+  addressing hash table keyed by the oids read as 64-bit integers. Its
+  entries are just that integer and the object, and looking an object up
+  doesn't need the hash of the oid. self->data holds everything else.
+  The data_* functions below treat the two as one mapping, and take care
+  of references the same way a dictionary does, so that the stolen
+  reference scheme described above works the same for both.
+
 */
 
 static char cPickleCache_doc_string[] =
@@ -97,17 +217,29 @@ static char cPickleCache_doc_string[] =
 #include "structmember.h"
 #include <time.h>
 #include <stddef.h>
+#include <math.h>
 #undef Py_FindMethod
 
 
 /* Python string objects to speed lookups; set by module init. */
 static PyObject *py__p_changed;
 static PyObject *py__p_deactivate;
+static PyObject *py__p_invalidate;
 static PyObject *py__p_jar;
 static PyObject *py__p_oid;
 
+/* collections.OrderedDict, for the eviction history; set by module init. */
+static PyObject *OrderedDict;
+
 static cPersistenceCAPIstruct *cPersistenceCAPI;
 
+/* The non-ghost objects of one class in the cache. */
+typedef struct {
+    Py_ssize_t non_ghost_count;
+    Py_ssize_t estimated_size;
+    Py_ssize_t quota;       /* maximum non_ghost_count, or -1 for none */
+} class_record;
+
 /* This object is the pickle cache.  The CACHE_HEAD macro guarantees
    that layout of this struct is the same as the start of
    ccobject_head in cPersistence.c */
@@ -116,6 +248,10 @@ typedef struct
     CACHE_HEAD
     int klass_count;                     /* count of persistent classes */
     PyObject *data;                      /* oid -> object dict */
+    struct oid_entry_struct *index;      /* 8-byte oid -> object table */
+    Py_ssize_t index_mask;               /* its size - 1 */
+    Py_ssize_t index_used;               /* its number of objects */
+    int index_shift;                     /* 64 - log2(its size) */
     PyObject *jar;                       /* Connection object */
     int cache_size;                      /* target number of items in cache */
     Py_ssize_t cache_size_bytes;       /* target total estimated size of
@@ -140,692 +276,3667 @@ typedef struct
 
     int cache_drain_resistance;
 
+    /* The eviction policy, one of the POLICY_ constants. */
+    int policy;
+
+    /* The boundary between the probationary and the protected segments
+       of the ring for the segmented policies. It is not linked into the
+       ring for POLICY_LRU and POLICY_CLOCK. */
+    CPersistentRing ring_segment;
+
+    /* OrderedDicts of the oids of recently ghostified objects (used as
+       ordered sets), or NULL if the policy doesn't keep them. The
+       probation history records objects ghostified from the
+       probationary segment, the protected history (POLICY_ARC only)
+       records those ghostified from the protected segment. */
+    PyObject *history_probation;
+    PyObject *history_protected;
+
+    /* POLICY_ARC: the adaptive target size of the probationary segment. */
+    int arc_p;
+
+    /* Where an interrupted garbage collection process should resume. It
+       is only linked into the ring while there is such a process; its
+       r_next is NULL otherwise. cursor_in_probation records whether the
+       objects following it belong to the probationary segment. */
+    CPersistentRing ring_cursor;
+    int cursor_in_probation;
+
+    /* The persistent.picklecache.CacheSweeper started by start_sweeper(),
+       or NULL. */
+    PyObject *sweeper;
+
+    /* The persistent.picklecache.MemoryPressureController set by
+       enable_memory_controller(), or NULL. incrgc() lets it adjust
+       cache_size_bytes. */
+    PyObject *memory_controller;
+
+    /* The functions set by set_size_estimator(), keyed by class (or None
+       for all the other classes), or NULL. While there are any, the
+       CACHE_HEAD's loaded hook is cache_loaded(). */
+    PyObject *size_estimators;
+
+    /* Whether we keep exact sizes (see cache_object_size()). */
+    int exact_sizes;
+
+    /* A persistent.picklecache.PickleStateStore shared with other caches,
+       or NULL (or None). invalidate() passes the oids on to it. */
+    PyObject *state_store;
+
+    /* oid -> None (pinned) or priority, or NULL. See "Pins and
+       Priorities" above. */
+    PyObject *priorities;
+
+    /* Statistics reported by cache_stats(). The count of accesses is
+       kept in the CACHE_HEAD because cPersistence maintains it. */
+    Py_ssize_t stat_hits;           /* successful get() and [] lookups */
+    Py_ssize_t stat_misses;         /* failed get() and [] lookups */
+    Py_ssize_t stat_new_ghosts;     /* objects added by new_ghost() */
+    Py_ssize_t stat_incrgc_calls;   /* incremental collections */
+    Py_ssize_t stat_evictions;      /* objects ghostified by collections */
+    Py_ssize_t stat_invalidations;  /* cached objects invalidated */
+    Py_ssize_t stat_bytes_reclaimed; /* estimated size of the evictions */
+    Py_ssize_t stat_ghost_limit_exceeded; /* incrgc() calls finding too
+                                             many ghosts */
+    Py_ssize_t stat_ghost_releases; /* objects ghostified to free ghosts */
+
+    /* The most ghosts we want in the cache, or -1 for no limit, and
+       whether collections ghostify objects referring to ghosts to get
+       below it (see release_ghosts()). */
+    Py_ssize_t ghost_limit;
+    int ghost_release;
+
+    /* Per-class accounting. class_index maps each class that had
+       non-ghost objects in the cache or was given a quota to the index
+       of its record in classes. */
+    PyObject *class_index;
+    class_record *classes;
+    Py_ssize_t classes_used;
+    Py_ssize_t classes_allocated;
+
+    /* The live iterators returned by iter_lru_items(). */
+    struct ringiter_struct *iterators;
+
+    /* The state of the random number generator of sample(). */
+    uint64_t random_state;
+
 } ccobject;
 
-static int cc_ass_sub(ccobject *self, PyObject *key, PyObject *v);
+/* An entry of the oid index; value is NULL for an empty entry. If the
+   cache keeps exact sizes, size is the object's estimated size in bytes
+   (or -1 if we don't know it). referenced is the reference bit of the
+   "clock" policy. refers_to_ghosts is set when the object looks up or
+   creates a ghost while it is loaded, until it is a ghost again (see
+   release_ghosts()). */
+typedef struct oid_entry_struct
+{
+    uint64_t key;
+    PyObject *value;
+    Py_ssize_t size;
+    unsigned char referenced;
+    unsigned char refers_to_ghosts;
+} oid_entry;
 
-/* ---------------------------------------------------------------- */
+#define INDEX_MIN_BITS 3
 
-#define OBJECT_FROM_RING(SELF, HERE)                                    \
-  ((cPersistentObject *)(((char *)here) - offsetof(cPersistentObject, ring)))
+/* If the oid is one the index can hold, store its key in *key and
+   return 1. Otherwise, return 0. */
+static int
+oid_key(PyObject *oid, uint64_t *key)
+{
+    const unsigned char *s;
 
-/* Insert self into the ring, following after. */
-static void
-insert_after(CPersistentRing *self, CPersistentRing *after)
+    if (!PyBytes_CheckExact(oid) || PyBytes_GET_SIZE(oid) != 8)
+        return 0;
+    s = (const unsigned char *)PyBytes_AS_STRING(oid);
+    *key = ((uint64_t)s[0] << 56) | ((uint64_t)s[1] << 48)
+           | ((uint64_t)s[2] << 40) | ((uint64_t)s[3] << 32)
+           | ((uint64_t)s[4] << 24) | ((uint64_t)s[5] << 16)
+           | ((uint64_t)s[6] << 8) | (uint64_t)s[7];
+    return 1;
+}
+
+/* Where the search for the key starts. Oids are mostly consecutive
+   numbers, so mix them up (Fibonacci hashing). */
+#define INDEX_SLOT(self, key) \
+    ((Py_ssize_t)(((key) * 0x9E3779B97F4A7C15ULL) >> (self)->index_shift))
+
+static oid_entry *
+index_lookup(ccobject *self, uint64_t key)
 {
-    assert(self != NULL);
-    assert(after != NULL);
-    self->r_prev = after;
-    self->r_next = after->r_next;
-    after->r_next->r_prev = self;
-    after->r_next = self;
+    Py_ssize_t i;
+
+    if (self->index == NULL)
+        return NULL;
+    for (i = INDEX_SLOT(self, key);
+         self->index[i].value;
+         i = (i + 1) & self->index_mask)
+        if (self->index[i].key == key)
+            return &self->index[i];
+    return NULL;
 }
 
-/* Remove self from the ring. */
+/* Store the entry, whose key mustn't be in the index yet, in the first
+   empty entry for it. */
 static void
-unlink_from_ring(CPersistentRing *self)
+index_place(ccobject *self, const oid_entry *entry)
 {
-    assert(self != NULL);
-    self->r_prev->r_next = self->r_next;
-    self->r_next->r_prev = self->r_prev;
+    Py_ssize_t i = INDEX_SLOT(self, entry->key);
+
+    while (self->index[i].value)
+        i = (i + 1) & self->index_mask;
+    self->index[i] = *entry;
 }
 
 static int
-scan_gc_items(ccobject *self, int target, Py_ssize_t target_bytes)
+index_resize(ccobject *self, int bits)
 {
-    /* This function must only be called with the ring lock held,
-        because it places non-object placeholders in the ring.
-    */
-    cPersistentObject *object;
-    CPersistentRing *here;
-    CPersistentRing before_original_home;
-    int result = -1;   /* guilty until proved innocent */
+    oid_entry *old = self->index;
+    Py_ssize_t old_size = old ? self->index_mask + 1 : 0;
+    Py_ssize_t i;
 
-    /* Scan the ring, from least to most recently used, deactivating
-    * up-to-date objects, until we either find the ring_home again or
-    * or we've ghosted enough objects to reach the target size.
-    * Tricky:  __getattr__ and __del__ methods can do anything, and in
-    * particular if we ghostify an object with a __del__ method, that method
-    * can load the object again, putting it back into the MRU part of the
-    * ring.  Waiting to find ring_home again can thus cause an infinite
-    * loop (Collector #1208).  So before_original_home records the MRU
-    * position we start with, and we stop the scan when we reach that.
-    */
-    insert_after(&before_original_home, self->ring_home.r_prev);
-    here = self->ring_home.r_next;   /* least recently used object */
-    /* All objects should be deactivated when the objects count parameter
-     * (target) is zero and the size limit parameter in bytes(target_bytes)
-     * is also zero.
-     *
-     * Otherwise the objects should be collect while one of the following
-     * conditions are True:
-     *  - the ghost count is bigger than the number of objects limit(target).
-     *  - the estimated size in bytes is bigger than the size limit in
-     *    bytes(target_bytes).
-     */
-    while (here != &before_original_home &&
-            (
-             (!target && !target_bytes) ||
-             (
-              (target && self->non_ghost_count > target) ||
-              (target_bytes && self->total_estimated_size > target_bytes)
-             )
-            )
-          )
+    self->index = PyMem_Calloc((size_t)1 << bits, sizeof(oid_entry));
+    if (self->index == NULL)
     {
-        assert(self->ring_lock);
-        assert(here != &self->ring_home);
-
-        /* At this point we know that the ring only contains nodes
-            from persistent objects, plus our own home node.  We know
-            this because the ring lock is held.  We can safely assume
-            the current ring node is a persistent object now we know it
-            is not the home */
-        object = OBJECT_FROM_RING(self, here);
-
-        if (object->state == cPersistent_UPTODATE_STATE)
-        {
-            CPersistentRing placeholder;
-            PyObject *method;
-            PyObject *temp;
-            int error_occurred = 0;
-            /* deactivate it. This is the main memory saver. */
-
-            /* Add a placeholder, a dummy node in the ring.  We need
-                to do this to mark our position in the ring.  It is
-                possible that the PyObject_GetAttr() call below will
-                invoke a __getattr__() hook in Python.  Also possible
-                that deactivation will lead to a __del__ method call.
-                So another thread might run, and mutate the ring as a side
-                effect of object accesses.  There's no predicting then where
-                in the ring here->next will point after that.  The
-                placeholder won't move as a side effect of calling Python
-                code.
-            */
-            insert_after(&placeholder, here);
-            method = PyObject_GetAttr((PyObject *)object, py__p_deactivate);
-            if (method == NULL)
-                error_occurred = 1;
-            else
-            {
-                temp = PyObject_CallObject(method, NULL);
-                Py_DECREF(method);
-                if (temp == NULL)
-                    error_occurred = 1;
-                else
-                    Py_DECREF(temp);
-            }
-
-            here = placeholder.r_next;
-            unlink_from_ring(&placeholder);
-            if (error_occurred)
-                goto Done;
-        }
-        else
-            here = here->r_next;
+        self->index = old;
+        PyErr_NoMemory();
+        return -1;
     }
-    result = 0;
-Done:
-    unlink_from_ring(&before_original_home);
-    return result;
+    self->index_mask = ((Py_ssize_t)1 << bits) - 1;
+    self->index_shift = 64 - bits;
+    for (i = 0; i < old_size; i++)
+        if (old[i].value)
+            index_place(self, &old[i]);
+    PyMem_Free(old);
+    return 0;
 }
 
-static PyObject *
-lockgc(ccobject *self, int target_size, Py_ssize_t target_size_bytes)
+static int
+index_insert(ccobject *self, uint64_t key, PyObject *value)
 {
-    /* This is thread-safe because of the GIL, and there's nothing
-    * in between checking the ring_lock and acquiring it that calls back
-    * into Python.
-    */
-    if (self->ring_lock)
-    {
-        Py_INCREF(Py_None);
-        return Py_None;
-    }
+    oid_entry entry;
 
-    self->ring_lock = 1;
-    if (scan_gc_items(self, target_size, target_size_bytes) < 0)
+    /* Keep the index at most three quarters full. */
+    if (self->index == NULL
+        || (self->index_used + 1) * 4 > (self->index_mask + 1) * 3)
     {
-        self->ring_lock = 0;
-        return NULL;
+        if (index_resize(self, self->index ? 65 - self->index_shift
+                                           : INDEX_MIN_BITS) < 0)
+            return -1;
     }
-    self->ring_lock = 0;
-
-    Py_INCREF(Py_None);
-    return Py_None;
+    entry.key = key;
+    entry.value = value;
+    entry.size = -1;
+    entry.referenced = 0;
+    entry.refers_to_ghosts = 0;
+    index_place(self, &entry);
+    self->index_used++;
+    return 0;
 }
 
-static PyObject *
-cc_incrgc(ccobject *self, PyObject *args)
+/* Make room for extra more entries at once, rather than growing the
+   index again and again while they are inserted. */
+static int
+index_reserve(ccobject *self, Py_ssize_t extra)
 {
-    int obsolete_arg = -999;
-    int starting_size = self->non_ghost_count;
-    int target_size = self->cache_size;
-    Py_ssize_t target_size_bytes = self->cache_size_bytes;
-
-    if (self->cache_drain_resistance >= 1)
-    {
-        /* This cache will gradually drain down to a small size. Check
-            a (small) number of objects proportional to the current size */
-
-        int target_size_2 = (starting_size - 1
-                            - starting_size / self->cache_drain_resistance);
-        if (target_size_2 < target_size)
-            target_size = target_size_2;
-    }
-
-
-    if (!PyArg_ParseTuple(args, "|i:incrgc", &obsolete_arg))
-        return NULL;
-
-    if (obsolete_arg != -999
-        &&
-        (PyErr_Warn(PyExc_DeprecationWarning,
-                    "No argument expected")
-        < 0))
-        return NULL;
+    Py_ssize_t needed = self->index_used + extra;
+    int bits = self->index ? 64 - self->index_shift : INDEX_MIN_BITS;
 
-    return lockgc(self, target_size, target_size_bytes);
+    if (extra == 0
+        || (self->index && needed * 4 <= (self->index_mask + 1) * 3))
+        return 0;
+    while ((((Py_ssize_t)1 << bits) * 3) < needed * 4)
+        bits++;
+    return index_resize(self, bits);
 }
 
-static PyObject *
-cc_full_sweep(ccobject *self, PyObject *args)
+static void
+index_remove(ccobject *self, oid_entry *entry)
 {
-    int dt = -999;
+    oid_entry *index = self->index;
+    Py_ssize_t mask = self->index_mask;
+    Py_ssize_t i = entry - index, j = i, k;
 
-    /* TODO:  This should be deprecated;  */
-
-    if (!PyArg_ParseTuple(args, "|i:full_sweep", &dt))
-        return NULL;
-    if (dt == -999)
-        return lockgc(self, 0, 0);
-    else
-        return cc_incrgc(self, args);
+    /* Move later entries of the same run back into the hole, if that
+       doesn't put them in front of where their searches start. */
+    for (;;)
+    {
+        j = (j + 1) & mask;
+        if (index[j].value == NULL)
+            break;
+        k = INDEX_SLOT(self, index[j].key);
+        if (i <= j ? (k <= i || k > j) : (k <= i && k > j))
+        {
+            index[i] = index[j];
+            i = j;
+        }
+    }
+    index[i].value = NULL;
+    self->index_used--;
 }
 
+/* Return the (borrowed) object with the oid, or NULL without setting an
+   exception (like PyDict_GetItem). */
 static PyObject *
-cc_minimize(ccobject *self, PyObject *args)
+data_get(ccobject *self, PyObject *oid)
 {
-    int ignored = -999;
-
-    if (!PyArg_ParseTuple(args, "|i:minimize", &ignored))
-        return NULL;
+    uint64_t key;
+    oid_entry *entry;
 
-    if (ignored != -999
-        &&
-        (PyErr_Warn(PyExc_DeprecationWarning,
-                    "No argument expected")
-        < 0))
+    if (oid_key(oid, &key) && (entry = index_lookup(self, key)))
+        return entry->value;
+    if (PyDict_GET_SIZE(self->data) == 0)
         return NULL;
-
-    return lockgc(self, 0, 0);
+    return PyDict_GetItem(self->data, oid);
 }
 
+/* Add the object, which must not be there yet, with a new reference
+   (like PyDict_SetItem). */
 static int
-_invalidate(ccobject *self, PyObject *key)
+data_set(ccobject *self, PyObject *oid, PyObject *v)
 {
-    static PyObject *_p_invalidate = NULL;
-    PyObject *meth, *v;
-
-    v = PyDict_GetItem(self->data, key);
-    if (v == NULL)
-        return 0;
+    uint64_t key;
 
-    if (_p_invalidate == NULL)
+    if (oid_key(oid, &key) && !PyType_Check(v) && PER_TypeCheck(v))
     {
-        _p_invalidate = INTERN("_p_invalidate");
-        if (_p_invalidate == NULL)
-        {
-            /* It doesn't make any sense to ignore this error, but
-                the caller ignores all errors.
-
-                TODO: and why does it do that? This should be fixed
-            */
+        if (index_insert(self, key, v) < 0)
             return -1;
-        }
+        Py_INCREF(v);
+        return 0;
     }
+    if (PyDict_SetItem(self->data, oid, v) < 0)
+        return -1;
+    /* The dict contains uncounted references; see cc_init. */
+    PyObject_GC_UnTrack((void *)self->data);
+    return 0;
+}
 
-    if (Py_REFCNT(v) <= 1 && PyType_Check(v))
-    {
-        /* This looks wrong, but it isn't. We use strong references to types
-            because they don't have the ring members.
+/* Remove the object, releasing a reference (like PyDict_DelItem). */
+static int
+data_del(ccobject *self, PyObject *oid)
+{
+    uint64_t key;
+    oid_entry *entry;
+    PyObject *v;
 
-            The result is that we *never* remove classes unless
-            they are modified.  We can fix this by using wekrefs uniformly.
-        */
-        self->klass_count--;
-        return PyDict_DelItem(self->data, key);
+    if (oid_key(oid, &key) && (entry = index_lookup(self, key)))
+    {
+        v = entry->value;
+        index_remove(self, entry);
+        Py_DECREF(v);
+        return 0;
     }
+    return PyDict_DelItem(self->data, oid);
+}
 
-    meth = PyObject_GetAttr(v, _p_invalidate);
-    if (meth == NULL)
-        return -1;
-
-    v = PyObject_CallObject(meth, NULL);
-    Py_DECREF(meth);
-    if (v == NULL)
-        return -1;
-    Py_DECREF(v);
-    return 0;
+static Py_ssize_t
+data_len(ccobject *self)
+{
+    return self->index_used + PyDict_GET_SIZE(self->data);
 }
 
-static PyObject *
-cc_invalidate(ccobject *self, PyObject *inv)
+/* Like PyDict_Next, for the index and then self->data; *pos starts at
+   0. The cache must not change during the iteration. */
+static int
+data_next(ccobject *self, Py_ssize_t *pos, PyObject **oid, PyObject **v)
 {
-    PyObject *key, *v;
-    Py_ssize_t i = 0;
+    Py_ssize_t size = self->index ? self->index_mask + 1 : 0;
+    Py_ssize_t dict_pos;
+    int result;
 
-    if (PyDict_Check(inv))
+    while (*pos < size)
     {
-        while (PyDict_Next(inv, &i, &key, &v))
+        oid_entry *entry = &self->index[(*pos)++];
+        if (entry->value)
         {
-            if (_invalidate(self, key) < 0)
-                return NULL;
+            *oid = ((cPersistentObject *)entry->value)->oid;
+            *v = entry->value;
+            return 1;
         }
-        PyDict_Clear(inv);
     }
-    else
-    {
-        if (PyBytes_Check(inv))
-        {
-            if (_invalidate(self, inv) < 0)
-                return NULL;
-        }
-        else
-        {
-            int l, r;
+    dict_pos = *pos - size;
+    result = PyDict_Next(self->data, &dict_pos, oid, v);
+    *pos = dict_pos + size;
+    return result;
+}
 
-            l = PyObject_Length(inv);
-            if (l < 0)
-                return NULL;
-            for (i=l; --i >= 0; )
-            {
-                key = PySequence_GetItem(inv, i);
-                if (!key)
-                    return NULL;
-                r = _invalidate(self, key);
-                Py_DECREF(key);
-                if (r < 0)
-                    return NULL;
-            }
-            /* Dubious:  modifying the input may be an unexpected side effect. */
-            PySequence_DelSlice(inv, 0, l);
-        }
-    }
+/* Exact sizes.
+
+   The estimated_size field of persistent objects counts 64-byte blocks
+   in 24 bits, so it rounds small objects up and caps big ones at about
+   1GB. A cache created with exact_sizes=True keeps the sizes given to
+   update_object_size_estimation() (or returned by size estimators) in
+   the index entries of the objects, and counts those instead, through
+   the CACHE_HEAD's object_size hook. An exact size is only used while
+   it matches the estimated_size field, which may be set without telling
+   the cache. Objects with oids the index can't hold keep using the
+   field. */
+
+/* The index entry of the object, or NULL. */
+static oid_entry *
+object_entry(ccobject *self, cPersistentObject *p)
+{
+    uint64_t key;
+    oid_entry *entry;
 
-    Py_INCREF(Py_None);
-    return Py_None;
+    if (p->oid && oid_key(p->oid, &key)
+        && (entry = index_lookup(self, key))
+        && entry->value == (PyObject *)p)
+        return entry;
+    return NULL;
 }
 
-static PyObject *
-cc_get(ccobject *self, PyObject *args)
+/* Note that the object being loaded, if any, refers to v, if v is a
+   ghost. */
+static void
+note_referent(ccobject *self, PyObject *v)
 {
-    PyObject *r, *key, *d = NULL;
-
-    if (!PyArg_ParseTuple(args, "O|O:get", &key, &d))
-        return NULL;
+    oid_entry *entry;
 
-    r = PyDict_GetItem(self->data, key);
-    if (!r)
-    {
-        if (d)
-            r = d;
-        else
-            r = Py_None;
-    }
-    Py_INCREF(r);
-    return r;
+    if (self->loading == NULL || PyType_Check(v)
+        || ((cPersistentObject *)v)->state != cPersistent_GHOST_STATE)
+        return;
+    entry = object_entry(self, (cPersistentObject *)self->loading);
+    if (entry)
+        entry->refers_to_ghosts = 1;
 }
 
-static PyObject *
-cc_items(ccobject *self)
+/* The reference hook of caches using the "clock" policy. */
+static int
+reference_object(PerCache *cache, PyObject *o)
 {
-    return PyObject_CallMethod(self->data, "items", "");
+    oid_entry *entry = object_entry((ccobject *)cache,
+                                    (cPersistentObject *)o);
+
+    if (entry == NULL)
+        return 0;
+    entry->referenced = 1;
+    return 1;
 }
 
-static PyObject *
-cc_klass_items(ccobject *self)
+/* The object_size hook. */
+static Py_ssize_t
+cache_object_size(PerCache *cache, PyObject *o)
 {
-    PyObject *l,*k,*v;
-    Py_ssize_t p = 0;
+    cPersistentObject *p = (cPersistentObject *)o;
+    oid_entry *entry = object_entry((ccobject *)cache, p);
+
+    if (entry && entry->size >= 0
+        && (unsigned)_estimated_size_in_24_bits(entry->size)
+           == p->estimated_size)
+        return entry->size;
+    return _estimated_size_in_bytes((Py_ssize_t)p->estimated_size);
+}
 
-    l = PyList_New(0);
-    if (l == NULL)
-        return NULL;
+/* Make size bytes the object's estimated size, updating our totals if
+   it is in the ring. If set_field is true, also set its estimated_size
+   field (otherwise the caller is expected to do that by setting
+   _p_estimated_size). */
+static void
+set_object_size(ccobject *self, cPersistentObject *p, Py_ssize_t size,
+                int set_field)
+{
+    oid_entry *entry = self->exact_sizes ? object_entry(self, p) : NULL;
+    Py_ssize_t delta;
 
-    while (PyDict_Next(self->data, &p, &k, &v))
+    if (p->ring.r_next)
     {
-        if(PyType_Check(v))
+        if (entry)
+            delta = size;
+        else
+            delta = _estimated_size_in_bytes(
+                (Py_ssize_t)_estimated_size_in_24_bits(size));
+        delta -= CACHE_OBJECT_SIZE(self, p);
+        self->total_estimated_size += delta;
+        CACHE_ACCOUNT(self, p, 0, delta);
+    }
+    if (entry)
+        entry->size = size;
+    if (set_field)
+        p->estimated_size = _estimated_size_in_24_bits(size);
+}
+
+/* An iterator over the ring, from least to most recently used. */
+typedef struct ringiter_struct
+{
+    PyObject_HEAD
+    ccobject *cache;        /* NULL once exhausted */
+    CPersistentRing here;   /* in front of the next object to produce */
+    CPersistentRing end;    /* where the iteration stops */
+    Py_ssize_t limit;       /* how many more objects to produce, or -1 */
+    struct ringiter_struct *next_iterator;  /* in cache->iterators */
+} ringiter;
+
+/* Is the ring node one of the nodes of the cache's iterators? */
+static int
+is_iterator_node(ccobject *self, CPersistentRing *here)
+{
+    ringiter *it;
+
+    for (it = self->iterators; it; it = it->next_iterator)
+        if (here == &it->here || here == &it->end)
+            return 1;
+    return 0;
+}
+
+#define POLICY_LRU 0
+#define POLICY_SLRU 1
+#define POLICY_2Q 2
+#define POLICY_ARC 3
+#define POLICY_CLOCK 4
+
+/* Indexed by the POLICY_ constants. */
+static const char *policy_names[] = {"lru", "slru", "2q", "arc", "clock",
+                                     NULL};
+
+/* Is the ring node one of the cache's own markers rather than a
+   persistent object? */
+#define IS_CACHE_MARKER(self, here) \
+    ((here) == &(self)->ring_segment || (here) == &(self)->ring_cursor \
+     || ((self)->iterators && is_iterator_node((self), (here))))
+
+/* The limits on a single garbage collection process; negative values
+   mean no limit. */
+typedef struct {
+    double max_seconds;
+    Py_ssize_t max_objects;
+} gc_budget;
+
+static const gc_budget NO_BUDGET = {-1.0, -1};
+
+/* Seconds from the performance counter, for measuring durations. */
+static double
+perf_counter(void)
+{
+#if PY_VERSION_HEX >= 0x030D0000
+    PyTime_t t;
+
+    if (PyTime_PerfCounterRaw(&t) < 0)
+    {
+        PyErr_Clear();
+        return 0.0;
+    }
+    return PyTime_AsSecondsDouble(t);
+#else
+    return _PyTime_AsSecondsDouble(_PyTime_GetPerfCounter());
+#endif
+}
+
+static int cc_ass_sub(ccobject *self, PyObject *key, PyObject *v);
+
+/* ---------------------------------------------------------------- */
+
+#define OBJECT_FROM_RING(SELF, HERE)                                    \
+  ((cPersistentObject *)(((char *)here) - offsetof(cPersistentObject, ring)))
+
+/* Insert self into the ring, following after. */
+static void
+insert_after(CPersistentRing *self, CPersistentRing *after)
+{
+    assert(self != NULL);
+    assert(after != NULL);
+    self->r_prev = after;
+    self->r_next = after->r_next;
+    after->r_next->r_prev = self;
+    after->r_next = self;
+}
+
+/* Remove self from the ring. */
+static void
+unlink_from_ring(CPersistentRing *self)
+{
+    assert(self != NULL);
+    self->r_prev->r_next = self->r_next;
+    self->r_next->r_prev = self->r_prev;
+}
+
+/* The target number of objects in the protected segment, given the
+   number of non-ghost objects the cache should hold. */
+static int
+protected_target(ccobject *self, int capacity)
+{
+    switch (self->policy)
+    {
+        case POLICY_SLRU:
+            return capacity - capacity / 5;
+        case POLICY_2Q:
+            return capacity - capacity / 4;
+        case POLICY_ARC:
+            return capacity - self->arc_p;
+    }
+    return capacity;
+}
+
+/* Move the segment boundary past (at most) count objects towards the
+   most recently used end of the ring, never past stop. This turns the
+   least recently used objects of the protected segment into the most
+   recently used objects of the probationary segment. Returns the
+   number of objects demoted.
+*/
+static int
+demote_protected(ccobject *self, int count, CPersistentRing *stop)
+{
+    CPersistentRing *last = &self->ring_segment;
+    int demoted = 0;
+
+    while (demoted < count
+           && last->r_next != stop
+           && last->r_next != &self->ring_home)
+    {
+        last = last->r_next;
+        if (!IS_CACHE_MARKER(self, last))
+            demoted++;
+    }
+    if (demoted)
+    {
+        unlink_from_ring(&self->ring_segment);
+        insert_after(&self->ring_segment, last);
+    }
+    return demoted;
+}
+
+/* Return the record of the given class, or NULL if there is none. If
+   create is true, a missing record is added; NULL then means an
+   error. */
+static class_record *
+get_class_record(ccobject *self, PyObject *klass, int create)
+{
+    PyObject *index;
+    class_record *record;
+    Py_ssize_t allocated;
+
+    index = PyDict_GetItem(self->class_index, klass);
+    if (index != NULL)
+        return &self->classes[PyLong_AsSsize_t(index)];
+    if (!create)
+        return NULL;
+
+    if (self->classes_used == self->classes_allocated)
+    {
+        allocated = self->classes_allocated ? self->classes_allocated * 2
+                                            : 8;
+        record = PyMem_Realloc(self->classes,
+                               allocated * sizeof(class_record));
+        if (record == NULL)
+        {
+            PyErr_NoMemory();
+            return NULL;
+        }
+        self->classes = record;
+        self->classes_allocated = allocated;
+    }
+    index = PyLong_FromSsize_t(self->classes_used);
+    if (index == NULL)
+        return NULL;
+    if (PyDict_SetItem(self->class_index, klass, index) < 0)
+    {
+        Py_DECREF(index);
+        return NULL;
+    }
+    Py_DECREF(index);
+    record = &self->classes[self->classes_used++];
+    record->non_ghost_count = 0;
+    record->estimated_size = 0;
+    record->quota = -1;
+    return record;
+}
+
+/* The account hook of the CACHE_HEAD. */
+static void
+account_object(PerCache *cache, PyObject *object, int count,
+               Py_ssize_t bytes)
+{
+    ccobject *self = (ccobject *)cache;
+    class_record *record;
+    oid_entry *entry;
+    PyObject *t, *v, *tb;
+
+    if (count)
+    {
+        /* It is about to be loaded or it is a ghost now; either way, it
+           no longer refers to the ghosts it did. */
+        entry = object_entry(self, (cPersistentObject *)object);
+        if (entry)
+            entry->refers_to_ghosts = 0;
+    }
+
+    record = get_class_record(self, (PyObject *)Py_TYPE(object), 0);
+    if (record == NULL && count > 0)
+    {
+        /* We may be called while an exception is pending, and we can't
+           report a failure; the class just goes uncounted. */
+        PyErr_Fetch(&t, &v, &tb);
+        record = get_class_record(self, (PyObject *)Py_TYPE(object), 1);
+        if (record == NULL)
+            PyErr_Clear();
+        PyErr_Restore(t, v, tb);
+    }
+    if (record != NULL)
+    {
+        record->non_ghost_count += count;
+        record->estimated_size += bytes;
+    }
+}
+
+/* Is any class over its quota? */
+static int
+over_quota(ccobject *self)
+{
+    Py_ssize_t i;
+
+    for (i = 0; i < self->classes_used; i++)
+        if (self->classes[i].quota >= 0
+            && self->classes[i].non_ghost_count > self->classes[i].quota)
+            return 1;
+    return 0;
+}
+
+/* Record that the object with the given oid was ghostified. */
+static int
+remember_evicted(ccobject *self, PyObject *oid, int from_probation,
+                 int capacity)
+{
+    PyObject *history, *popped;
+    Py_ssize_t limit = self->policy == POLICY_2Q ? capacity / 2 : capacity;
+
+    history = from_probation ? self->history_probation
+                             : self->history_protected;
+    if (history == NULL)
+        return 0;
+
+    if (PyObject_SetItem(history, oid, Py_None) < 0)
+        return -1;
+    while (PyDict_GET_SIZE(history) > limit && PyDict_GET_SIZE(history))
+    {
+        popped = PyObject_CallMethod(history, "popitem", "O", Py_False);
+        if (popped == NULL)
+            return -1;
+        Py_DECREF(popped);
+    }
+    return 0;
+}
+
+/* Check whether a probationary object was ghostified recently (and so
+   has been loaded again since). If so, forget about it and return 1;
+   the caller should promote it rather than ghostify it. Return 0 if
+   not and -1 on error.
+*/
+static int
+take_from_history(ccobject *self, PyObject *oid, int capacity)
+{
+    PyObject *hit = NULL;
+    Py_ssize_t b1, b2;
+    int r;
+
+    if (self->history_probation == NULL)
+        return 0;
+
+    r = PyDict_Contains(self->history_probation, oid);
+    if (r < 0)
+        return -1;
+    if (r)
+        hit = self->history_probation;
+    else if (self->history_protected)
+    {
+        r = PyDict_Contains(self->history_protected, oid);
+        if (r < 0)
+            return -1;
+        if (r)
+            hit = self->history_protected;
+    }
+    if (hit == NULL)
+        return 0;
+
+    if (self->policy == POLICY_ARC)
+    {
+        /* Grow the probationary segment on hits in its history, shrink
+           it on hits in the protected history. */
+        b1 = PyDict_GET_SIZE(self->history_probation);
+        b2 = PyDict_GET_SIZE(self->history_protected);
+        if (hit == self->history_probation)
+        {
+            self->arc_p += (int)(b2 > b1 ? b2 / b1 : 1);
+            if (self->arc_p > capacity)
+                self->arc_p = capacity;
+        }
+        else
+        {
+            self->arc_p -= (int)(b1 > b2 ? b1 / b2 : 1);
+            if (self->arc_p < 0)
+                self->arc_p = 0;
+        }
+    }
+
+    if (PyObject_DelItem(hit, oid) < 0)
+        return -1;
+    return 1;
+}
+
+/* Ghostify the up-to-date object whose ring node is *here, and advance
+   *here to the node that followed it. Return -1 on error. */
+static int
+evict(ccobject *self, cPersistentObject *object, CPersistentRing **here)
+{
+    CPersistentRing placeholder;
+    PyObject *method;
+    PyObject *temp;
+    int non_ghost_count;
+    Py_ssize_t total_estimated_size;
+    int result = 0;
+
+    /* Add a placeholder, a dummy node in the ring.  We need
+        to do this to mark our position in the ring.  It is
+        possible that the PyObject_GetAttr() call below will
+        invoke a __getattr__() hook in Python.  Also possible
+        that deactivation will lead to a __del__ method call.
+        So another thread might run, and mutate the ring as a side
+        effect of object accesses.  There's no predicting then where
+        in the ring here->next will point after that.  The
+        placeholder won't move as a side effect of calling Python
+        code.
+    */
+    insert_after(&placeholder, *here);
+    /* Deactivating it may well free it. */
+    non_ghost_count = self->non_ghost_count;
+    total_estimated_size = self->total_estimated_size;
+    method = PyObject_GetAttr((PyObject *)object, py__p_deactivate);
+    if (method == NULL)
+        result = -1;
+    else
+    {
+        temp = PyObject_CallObject(method, NULL);
+        Py_DECREF(method);
+        if (temp == NULL)
+            result = -1;
+        else
+            Py_DECREF(temp);
+    }
+
+    *here = placeholder.r_next;
+    unlink_from_ring(&placeholder);
+    if (self->non_ghost_count < non_ghost_count)
+    {
+        self->stat_evictions++;
+        if (self->total_estimated_size < total_estimated_size)
+            self->stat_bytes_reclaimed +=
+                total_estimated_size - self->total_estimated_size;
+    }
+    return result;
+}
+
+/* The priority of pinned objects. */
+#define PINNED PY_SSIZE_T_MAX
+
+/* The priority of the object, 0 unless it was given one. */
+static Py_ssize_t
+object_priority(ccobject *self, cPersistentObject *object)
+{
+    PyObject *v;
+
+    if (self->priorities == NULL || PyDict_GET_SIZE(self->priorities) == 0
+        || object->oid == NULL)
+        return 0;
+    v = PyDict_GetItem(self->priorities, object->oid);
+    if (v == NULL)
+        return 0;
+    return v == Py_None ? PINNED : PyLong_AsSsize_t(v);
+}
+
+/* The smallest priority above priority given to any oid (other than
+   the pinned ones), or 0 if there is none. */
+static Py_ssize_t
+next_priority(ccobject *self, Py_ssize_t priority)
+{
+    PyObject *oid, *v;
+    Py_ssize_t pos = 0, p, next = 0;
+
+    if (self->priorities == NULL)
+        return 0;
+    while (PyDict_Next(self->priorities, &pos, &oid, &v))
+    {
+        if (v == Py_None)
+            continue;
+        p = PyLong_AsSsize_t(v);
+        if (p > priority && (next == 0 || p < next))
+            next = p;
+    }
+    return next;
+}
+
+/* Whether an incremental garbage collection process has more to do. */
+#define OVER_TARGET(self, target, target_bytes) \
+    (((target) && (self)->non_ghost_count > (target)) \
+     || ((target_bytes) && (self)->total_estimated_size > (target_bytes)))
+
+/* While the cache is over the targets, ghostify the least recently used
+   up-to-date objects with the lowest priority above 0, then those with
+   the next priority and so on, not going past stop. This counts the
+   objects it examines in *examined, stopping when it runs out of
+   budget. */
+static int
+evict_by_priority(ccobject *self, int target, Py_ssize_t target_bytes,
+                  CPersistentRing *stop, gc_budget budget, double deadline,
+                  Py_ssize_t *examined)
+{
+    CPersistentRing *here;
+    cPersistentObject *object;
+    Py_ssize_t priority = 0;
+
+    while (OVER_TARGET(self, target, target_bytes)
+           && (priority = next_priority(self, priority)))
+    {
+        here = self->ring_home.r_next;
+        while (here != stop && OVER_TARGET(self, target, target_bytes))
+        {
+            if ((budget.max_objects >= 0 && *examined >= budget.max_objects)
+                || (budget.max_seconds >= 0 && perf_counter() >= deadline))
+                return 0;
+            if (IS_CACHE_MARKER(self, here))
+            {
+                here = here->r_next;
+                continue;
+            }
+            object = OBJECT_FROM_RING(self, here);
+            (*examined)++;
+            if (object->state == cPersistent_UPTODATE_STATE
+                && object_priority(self, object) == priority)
+            {
+                if (evict(self, object, &here) < 0)
+                    return -1;
+            }
+            else
+                here = here->r_next;
+        }
+    }
+    return 0;
+}
+
+/* Ghostify the least recently used up-to-date objects of the classes
+   over their quotas, not going past stop. This counts the objects it
+   examines in *examined, stopping when it runs out of budget. */
+static int
+enforce_quotas(ccobject *self, CPersistentRing *stop, gc_budget budget,
+               double deadline, Py_ssize_t *examined)
+{
+    CPersistentRing *here = self->ring_home.r_next;
+    cPersistentObject *object;
+    class_record *record;
+
+    while (here != stop && over_quota(self))
+    {
+        if ((budget.max_objects >= 0 && *examined >= budget.max_objects)
+            || (budget.max_seconds >= 0 && perf_counter() >= deadline))
+            break;
+        if (IS_CACHE_MARKER(self, here))
+        {
+            here = here->r_next;
+            continue;
+        }
+        object = OBJECT_FROM_RING(self, here);
+        (*examined)++;
+        record = get_class_record(self, (PyObject *)Py_TYPE(object), 0);
+        if (object->state == cPersistent_UPTODATE_STATE
+            && record != NULL
+            && record->quota >= 0
+            && record->non_ghost_count > record->quota
+            && object_priority(self, object) != PINNED)
+        {
+            if (evict(self, object, &here) < 0)
+                return -1;
+        }
+        else
+            here = here->r_next;
+    }
+    return 0;
+}
+
+/* The number of ghosts in the cache. Ghosts leave the cache when their
+   last reference goes away (cc_oid_unreferenced). */
+#define GHOST_COUNT(self) \
+    (data_len(self) - (self)->non_ghost_count - (self)->klass_count)
+
+/* While there are more ghosts than the ghost limit, ghostify the least
+   recently used up-to-date objects that refer to ghosts, not going past
+   stop. Ghostifying them releases their references, so the ghosts
+   nobody else refers to go away (think of the internal nodes of a BTree
+   and their children). This counts the objects it examines in
+   *examined, stopping when it runs out of budget.
+
+   Rather than looking at the references of every object, we go by the
+   refers_to_ghosts bits of their index entries, which note_referent()
+   sets for the objects that looked up or created ghosts while they were
+   loaded, like a jar does for the persistent references in their
+   state. That misses references added otherwise, and references to
+   objects that only became ghosts after the object was loaded. */
+static int
+release_ghosts(ccobject *self, CPersistentRing *stop, gc_budget budget,
+               double deadline, Py_ssize_t *examined)
+{
+    CPersistentRing *here = self->ring_home.r_next;
+    cPersistentObject *object;
+    oid_entry *entry;
+
+    while (here != stop && GHOST_COUNT(self) > self->ghost_limit)
+    {
+        if ((budget.max_objects >= 0 && *examined >= budget.max_objects)
+            || (budget.max_seconds >= 0 && perf_counter() >= deadline))
+            break;
+        if (IS_CACHE_MARKER(self, here))
+        {
+            here = here->r_next;
+            continue;
+        }
+        object = OBJECT_FROM_RING(self, here);
+        (*examined)++;
+        entry = object_entry(self, object);
+        if (object->state == cPersistent_UPTODATE_STATE
+            && object_priority(self, object) != PINNED
+            && entry && entry->refers_to_ghosts)
+        {
+            if (evict(self, object, &here) < 0)
+                return -1;
+            self->stat_ghost_releases++;
+        }
+        else
+            here = here->r_next;
+    }
+    return 0;
+}
+
+static int
+scan_gc_items(ccobject *self, int target, Py_ssize_t target_bytes,
+              gc_budget budget)
+{
+    /* This function must only be called with the ring lock held,
+        because it places non-object placeholders in the ring.
+    */
+    cPersistentObject *object;
+    CPersistentRing *here;
+    CPersistentRing before_original_home;
+    int result = -1;   /* guilty until proved innocent */
+    /* Only incremental collections apply the eviction policy; a full
+       sweep ghostifies everything it can. */
+    int partial = target || target_bytes;
+    /* Whether here is (still) in the probationary segment. */
+    int in_probation = self->ring_insert != &self->ring_home;
+    int probation_survivors = 0;
+    int capacity = self->cache_size > 0 ? self->cache_size
+                                         : self->non_ghost_count;
+    double deadline = budget.max_seconds >= 0
+                      ? perf_counter() + budget.max_seconds : 0.0;
+    Py_ssize_t examined = 0;
+    CPersistentRing *resume = NULL;
+
+    /* Scan the ring, from least to most recently used, deactivating
+    * up-to-date objects, until we either find the ring_home again or
+    * or we've ghosted enough objects to reach the target size.
+    * Tricky:  __getattr__ and __del__ methods can do anything, and in
+    * particular if we ghostify an object with a __del__ method, that method
+    * can load the object again, putting it back into the MRU part of the
+    * ring.  Waiting to find ring_home again can thus cause an infinite
+    * loop (Collector #1208).  So before_original_home records the MRU
+    * position we start with, and we stop the scan when we reach that.
+    */
+    insert_after(&before_original_home, self->ring_home.r_prev);
+    /* Quotas and the ghost limit come first. */
+    if (partial
+        && enforce_quotas(self, &before_original_home, budget, deadline,
+                          &examined) < 0)
+        goto Done;
+    if (partial
+        && self->ghost_limit >= 0
+        && self->ghost_release
+        && release_ghosts(self, &before_original_home, budget, deadline,
+                          &examined) < 0)
+        goto Done;
+    if (self->ring_cursor.r_next)
+    {
+        /* Carry on where the last (interrupted) process stopped, unless
+           that was at the end of the ring. */
+        if (self->ring_cursor.r_next != &before_original_home)
+        {
+            resume = self->ring_cursor.r_next;
+            in_probation = self->cursor_in_probation;
+        }
+        unlink_from_ring(&self->ring_cursor);
+        self->ring_cursor.r_next = self->ring_cursor.r_prev = NULL;
+    }
+    /* otherwise, start with the least recently used object */
+    here = resume ? resume : self->ring_home.r_next;
+    /* All objects should be deactivated when the objects count parameter
+     * (target) is zero and the size limit parameter in bytes(target_bytes)
+     * is also zero.
+     *
+     * Otherwise the objects should be collect while one of the following
+     * conditions are True:
+     *  - the ghost count is bigger than the number of objects limit(target).
+     *  - the estimated size in bytes is bigger than the size limit in
+     *    bytes(target_bytes).
+     */
+    while (here != &before_original_home &&
+            (
+             (!target && !target_bytes) ||
+             (
+              (target && self->non_ghost_count > target) ||
+              (target_bytes && self->total_estimated_size > target_bytes)
+             )
+            )
+          )
+    {
+        assert(self->ring_lock);
+        assert(here != &self->ring_home);
+
+        if ((budget.max_objects >= 0 && examined >= budget.max_objects)
+            || (budget.max_seconds >= 0 && perf_counter() >= deadline))
+        {
+            /* Out of budget; remember where to carry on. */
+            insert_after(&self->ring_cursor, here->r_prev);
+            self->cursor_in_probation = in_probation;
+            break;
+        }
+
+        if (here == &self->ring_segment)
+        {
+            /* We've seen all of the probationary segment. If the
+                protected segment is over its target size, demote its
+                least recently used objects and carry on with them. */
+            here = here->r_next;
+            if (!(in_probation
+                  && partial
+                  && demote_protected(self,
+                                      self->non_ghost_count
+                                      - probation_survivors
+                                      - protected_target(self, capacity),
+                                      &before_original_home)))
+                in_probation = 0;
+            continue;
+        }
+
+        if (IS_CACHE_MARKER(self, here))
+        {
+            /* An iterator's node. */
+            here = here->r_next;
+            continue;
+        }
+
+        /* At this point we know that the ring only contains nodes
+            from persistent objects, plus our own home node and
+            markers.  We know this because the ring lock is held.  We
+            can safely assume the current ring node is a persistent
+            object now we know it is none of those. */
+        object = OBJECT_FROM_RING(self, here);
+        examined++;
+
+        if (object->state == cPersistent_UPTODATE_STATE)
+        {
+            PyObject *oid;
+            int error_occurred;
+            Py_ssize_t priority = object_priority(self, object);
+
+            if (priority == PINNED || (partial && priority))
+            {
+                /* Pinned, or left for evict_by_priority(). */
+                if (in_probation)
+                    probation_survivors++;
+                here = here->r_next;
+                continue;
+            }
+
+            if (self->reference && partial)
+            {
+                oid_entry *entry = object_entry(self, object);
+
+                if (entry && entry->referenced)
+                {
+                    /* Accessed since we last got here; give it a second
+                       chance. */
+                    entry->referenced = 0;
+                    here = here->r_next;
+                    ring_move_to_head(&self->ring_home, &object->ring);
+                    continue;
+                }
+            }
+
+            if (in_probation && partial)
+            {
+                int promote = take_from_history(self, object->oid, capacity);
+                if (promote < 0)
+                    goto Done;
+                if (promote)
+                {
+                    /* This moves it behind before_original_home, so we
+                       won't see it again. */
+                    here = here->r_next;
+                    ring_move_to_head(&self->ring_home, &object->ring);
+                    continue;
+                }
+            }
+
+            /* deactivate it. This is the main memory saver. */
+            oid = object->oid;
+            Py_INCREF(oid);
+            error_occurred = evict(self, object, &here) < 0;
+            if (!error_occurred && partial
+                && remember_evicted(self, oid, in_probation, capacity) < 0)
+                error_occurred = 1;
+            Py_DECREF(oid);
+            if (error_occurred)
+                goto Done;
+        }
+        else
+        {
+            if (in_probation)
+                probation_survivors++;
+            here = here->r_next;
+        }
+    }
+    if (partial
+        && evict_by_priority(self, target, target_bytes, &before_original_home,
+                             budget, deadline, &examined) < 0)
+        goto Done;
+    result = 0;
+Done:
+    unlink_from_ring(&before_original_home);
+    return result;
+}
+
+/* Convert the max_seconds and max_objects arguments, either of which
+   may be None (or NULL) for no limit. */
+static int
+parse_budget(PyObject *max_seconds, PyObject *max_objects, gc_budget *budget)
+{
+    *budget = NO_BUDGET;
+    if (max_seconds && max_seconds != Py_None)
+    {
+        budget->max_seconds = PyFloat_AsDouble(max_seconds);
+        if (budget->max_seconds == -1.0 && PyErr_Occurred())
+            return -1;
+        if (budget->max_seconds < 0)
+        {
+            PyErr_SetString(PyExc_ValueError,
+                            "max_seconds must not be negative");
+            return -1;
+        }
+    }
+    if (max_objects && max_objects != Py_None)
+    {
+        budget->max_objects = PyNumber_AsSsize_t(max_objects,
+                                                 PyExc_OverflowError);
+        if (budget->max_objects == -1 && PyErr_Occurred())
+            return -1;
+        if (budget->max_objects < 0)
+        {
+            PyErr_SetString(PyExc_ValueError,
+                            "max_objects must not be negative");
+            return -1;
+        }
+    }
+    return 0;
+}
+
+/* Move the objects in the access buffer to the most recently used end
+   of the ring, as accessed() in cPersistence.c would have (see "Access
+   Buffers" above), and empty it. This is the CACHE_HEAD's
+   drain_accesses hook; in the free-threaded build, callers hold the
+   cache's critical section. */
+static void
+drain_accesses(PerCache *cache)
+{
+    ccobject *self = (ccobject *)cache;
+    int i;
+
+    for (i = 0; i < self->access_buffer_used; i++)
+    {
+        cPersistentObject *o = (cPersistentObject *)self->access_buffer[i];
+
+        /* It may have been ghostified since. */
+        if (o->state >= 0 && o->ring.r_next
+            && o->ring.r_next != self->ring_insert)
+            ring_move_to_head(&self->ring_home, &o->ring);
+    }
+    self->access_buffer_used = 0;
+}
+
+static void
+flush_accesses(ccobject *self)
+{
+    if (!self->access_buffer_used)
+        return;
+#ifdef Py_GIL_DISABLED
+    Py_BEGIN_CRITICAL_SECTION(self);
+#endif
+    drain_accesses((PerCache *)self);
+#ifdef Py_GIL_DISABLED
+    Py_END_CRITICAL_SECTION();
+#endif
+}
+
+static PyObject *
+lockgc(ccobject *self, int target_size, Py_ssize_t target_size_bytes,
+       gc_budget budget)
+{
+    /* This is thread-safe because of the GIL, and there's nothing
+    * in between checking the ring_lock and acquiring it that calls back
+    * into Python. Without the GIL, the critical section only makes the
+    * check-and-set atomic: the sweep itself still races with the
+    * threads moving objects in the ring, which is why CacheSweeper
+    * refuses to start without the GIL.
+    */
+    int busy, error;
+    const char *cause;
+
+#ifdef Py_GIL_DISABLED
+    Py_BEGIN_CRITICAL_SECTION(self);
+#endif
+    busy = self->ring_lock;
+    self->ring_lock = 1;
+#ifdef Py_GIL_DISABLED
+    Py_END_CRITICAL_SECTION();
+#endif
+    if (busy)
+    {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+
+    flush_accesses(self);
+    cause = self->trace_cause;
+    self->trace_cause = "evict";
+    error = scan_gc_items(self, target_size, target_size_bytes, budget) < 0;
+    self->trace_cause = cause;
+    self->ring_lock = 0;
+    if (error)
+        return NULL;
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static PyObject *
+cc_incrgc(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"", "max_seconds", "max_objects", NULL};
+    PyObject *max_seconds = NULL, *max_objects = NULL;
+    gc_budget budget;
+    int obsolete_arg = -999;
+    int starting_size = self->non_ghost_count;
+    int target_size = self->cache_size;
+    Py_ssize_t target_size_bytes;
+
+    if (self->cache_drain_resistance >= 1)
+    {
+        /* This cache will gradually drain down to a small size. Check
+            a (small) number of objects proportional to the current size */
+
+        int target_size_2 = (starting_size - 1
+                            - starting_size / self->cache_drain_resistance);
+        if (target_size_2 < target_size)
+            target_size = target_size_2;
+    }
+
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|i$OO:incrgc", kwlist,
+                                     &obsolete_arg, &max_seconds,
+                                     &max_objects))
+        return NULL;
+    if (parse_budget(max_seconds, max_objects, &budget) < 0)
+        return NULL;
+
+    self->stat_incrgc_calls++;
+
+    if (obsolete_arg != -999
+        &&
+        (PyErr_Warn(PyExc_DeprecationWarning,
+                    "No argument expected")
+        < 0))
+        return NULL;
+
+    if (self->memory_controller)
+    {
+        PyObject *r = PyObject_CallMethod(self->memory_controller,
+                                          "adjust", "O", self);
+        if (r == NULL)
+            return NULL;
+        Py_DECREF(r);
+    }
+    target_size_bytes = self->cache_size_bytes;
+
+    if (self->ghost_limit >= 0 && GHOST_COUNT(self) > self->ghost_limit)
+        self->stat_ghost_limit_exceeded++;
+
+    return lockgc(self, target_size, target_size_bytes, budget);
+}
+
+static PyObject *
+cc_full_sweep(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"", "max_seconds", "max_objects", NULL};
+    PyObject *max_seconds = NULL, *max_objects = NULL;
+    gc_budget budget;
+    int dt = -999;
+
+    /* TODO:  This should be deprecated;  */
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|i$OO:full_sweep", kwlist,
+                                     &dt, &max_seconds, &max_objects))
+        return NULL;
+    if (dt == -999)
+    {
+        if (parse_budget(max_seconds, max_objects, &budget) < 0)
+            return NULL;
+        return lockgc(self, 0, 0, budget);
+    }
+    else
+        return cc_incrgc(self, args, kwds);
+}
+
+/* Sweep to an explicit target; used by the sweeper thread. */
+static PyObject *
+cc__sweep(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"target", "target_size_bytes",
+                             "max_seconds", "max_objects", NULL};
+    int target;
+    Py_ssize_t target_size_bytes = 0;
+    PyObject *max_seconds = NULL, *max_objects = NULL;
+    gc_budget budget;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "i|nOO:_sweep", kwlist,
+                                     &target, &target_size_bytes,
+                                     &max_seconds, &max_objects))
+        return NULL;
+    if (parse_budget(max_seconds, max_objects, &budget) < 0)
+        return NULL;
+
+    return lockgc(self, target, target_size_bytes, budget);
+}
+
+static int
+stop_sweeper(ccobject *self)
+{
+    PyObject *sweeper = self->sweeper;
+    PyObject *r;
+
+    if (sweeper == NULL)
+        return 0;
+    self->sweeper = NULL;
+    r = PyObject_CallMethod(sweeper, "stop", NULL);
+    Py_DECREF(sweeper);
+    if (r == NULL)
+        return -1;
+    Py_DECREF(r);
+    return 0;
+}
+
+static PyObject *
+cc_stop_sweeper(ccobject *self)
+{
+    if (stop_sweeper(self) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+/* Call the function (or class) with the given name from
+   persistent.picklecache, passing the cache followed by args and kwds.
+   This is how we provide the methods that are implemented in Python
+   for both implementations. */
+static PyObject *
+call_python_helper(ccobject *self, const char *name,
+                   PyObject *args, PyObject *kwds)
+{
+    PyObject *module, *func, *func_args, *result;
+    Py_ssize_t i, n;
+
+    module = PyImport_ImportModule("persistent.picklecache");
+    if (module == NULL)
+        return NULL;
+    func = PyObject_GetAttrString(module, name);
+    Py_DECREF(module);
+    if (func == NULL)
+        return NULL;
+
+    n = PyTuple_GET_SIZE(args);
+    func_args = PyTuple_New(n + 1);
+    if (func_args == NULL)
+    {
+        Py_DECREF(func);
+        return NULL;
+    }
+    Py_INCREF(self);
+    PyTuple_SET_ITEM(func_args, 0, (PyObject *)self);
+    for (i = 0; i < n; i++)
+    {
+        PyObject *arg = PyTuple_GET_ITEM(args, i);
+        Py_INCREF(arg);
+        PyTuple_SET_ITEM(func_args, i + 1, arg);
+    }
+    result = PyObject_Call(func, func_args, kwds);
+    Py_DECREF(func);
+    Py_DECREF(func_args);
+    return result;
+}
+
+static PyObject *
+cc_start_sweeper(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    PyObject *sweeper, *r;
+
+    if (stop_sweeper(self) < 0)
+        return NULL;
+
+    sweeper = call_python_helper(self, "CacheSweeper", args, kwds);
+    if (sweeper == NULL)
+        return NULL;
+
+    r = PyObject_CallMethod(sweeper, "start", NULL);
+    if (r == NULL)
+    {
+        Py_DECREF(sweeper);
+        return NULL;
+    }
+    Py_DECREF(r);
+    Py_INCREF(sweeper);
+    self->sweeper = sweeper;
+    return sweeper;
+}
+
+static int
+disable_memory_controller(ccobject *self)
+{
+    PyObject *controller = self->memory_controller;
+    PyObject *initial;
+    Py_ssize_t initial_bytes;
+
+    if (controller == NULL)
+        return 0;
+    self->memory_controller = NULL;
+    initial = PyObject_GetAttrString(controller, "initial_bytes");
+    Py_DECREF(controller);
+    if (initial == NULL)
+        return -1;
+    initial_bytes = PyLong_AsSsize_t(initial);
+    Py_DECREF(initial);
+    if (initial_bytes == -1 && PyErr_Occurred())
+        return -1;
+    self->cache_size_bytes = initial_bytes;
+    return 0;
+}
+
+static PyObject *
+cc_disable_memory_controller(ccobject *self)
+{
+    if (disable_memory_controller(self) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+cc_enable_memory_controller(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    PyObject *controller;
+
+    if (disable_memory_controller(self) < 0)
+        return NULL;
+
+    controller = call_python_helper(self, "MemoryPressureController",
+                                    args, kwds);
+    if (controller == NULL)
+        return NULL;
+    Py_INCREF(controller);
+    self->memory_controller = controller;
+    return controller;
+}
+
+static PyObject *
+cc_snapshot_hot(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    return call_python_helper(self, "_snapshot_hot", args, kwds);
+}
+
+static PyObject *
+cc_prewarm(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    return call_python_helper(self, "_prewarm", args, kwds);
+}
+
+static PyObject *
+cc_minimize(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"", "max_seconds", "max_objects", NULL};
+    PyObject *max_seconds = NULL, *max_objects = NULL;
+    gc_budget budget;
+    int ignored = -999;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|i$OO:minimize", kwlist,
+                                     &ignored, &max_seconds, &max_objects))
+        return NULL;
+    if (parse_budget(max_seconds, max_objects, &budget) < 0)
+        return NULL;
+
+    if (ignored != -999
+        &&
+        (PyErr_Warn(PyExc_DeprecationWarning,
+                    "No argument expected")
+        < 0))
+        return NULL;
+
+    return lockgc(self, 0, 0, budget);
+}
+
+/* What invalidate() did, returned as a dict. */
+typedef struct
+{
+    Py_ssize_t ghosted; /* objects found and ghostified */
+    Py_ssize_t missing; /* oids not in the cache */
+    Py_ssize_t classes; /* persistent classes found */
+} invalidate_summary;
+
+/* Does the type invalidate its instances the way Persistent does? Then
+   we can ghostify them directly instead of calling _p_invalidate, which
+   calls _p_deactivate and then ghostifies them. */
+static int
+has_plain_invalidate(PyTypeObject *type)
+{
+    PyTypeObject *base = cPersistenceCAPI->pertype;
+
+    return (type == base
+            || (_PyType_Lookup(type, py__p_invalidate)
+                == _PyType_Lookup(base, py__p_invalidate)
+                && _PyType_Lookup(type, py__p_deactivate)
+                == _PyType_Lookup(base, py__p_deactivate)));
+}
+
+/* Call the object's _p_invalidate method, or do what it does. */
+static int
+invalidate_object(PyObject *v)
+{
+    PyObject *meth, *r;
+
+    if (PER_TypeCheck(v) && has_plain_invalidate(Py_TYPE(v)))
+    {
+        /* What Persistent._p_invalidate does. */
+        cPersistentObject *p = (cPersistentObject *)v;
+        PyObject **dictptr;
+
+        if (p->state == cPersistent_GHOST_STATE)
+            return 0;
+        Py_INCREF(p);
+        p->state = cPersistent_UPTODATE_STATE;
+        if (p->jar)
+        {
+            dictptr = _PyObject_GetDictPtr(v);
+            if (dictptr && *dictptr)
+            {
+                PyDict_Clear(*dictptr);
+                Py_CLEAR(*dictptr);
+            }
+        }
+        cPersistenceCAPI->ghostify(p);
+        Py_DECREF(p);
+        return PyErr_Occurred() ? -1 : 0;
+    }
+
+    meth = PyObject_GetAttr(v, py__p_invalidate);
+    if (meth == NULL)
+        return -1;
+    r = PyObject_CallObject(meth, NULL);
+    Py_DECREF(meth);
+    if (r == NULL)
+        return -1;
+    Py_DECREF(r);
+    return 0;
+}
+
+static int
+_invalidate(ccobject *self, PyObject *key, invalidate_summary *summary)
+{
+    PyObject *v;
+
+    v = data_get(self, key);
+    if (v == NULL)
+    {
+        summary->missing++;
+        return 0;
+    }
+
+    self->stat_invalidations++;
+
+    if (!PyType_Check(v))
+    {
+        summary->ghosted++;
+        return invalidate_object(v);
+    }
+
+    summary->classes++;
+    if (Py_REFCNT(v) <= 1)
+    {
+        /* This looks wrong, but it isn't. We use strong references to types
+            because they don't have the ring members.
+
+            The result is that we *never* remove classes unless
+            they are modified.  We can fix this by using wekrefs uniformly.
+        */
+        self->klass_count--;
+        return data_del(self, key);
+    }
+    return invalidate_object(v);
+}
+
+/* Pass the oids to invalidate to the state store. We do that first, so
+   that nobody loads the old states again. */
+static int
+invalidate_state_store(ccobject *self, PyObject *oids)
+{
+    PyObject *r;
+
+    if (self->state_store == NULL || self->state_store == Py_None)
+        return 0;
+    r = PyObject_CallMethod(self->state_store, "invalidate", "O", oids);
+    if (r == NULL)
+        return -1;
+    Py_DECREF(r);
+    return 0;
+}
+
+static PyObject *
+invalidate_oids(ccobject *self, PyObject *inv)
+{
+    PyObject *keys, **items;
+    Py_ssize_t i, n;
+    invalidate_summary summary = {0, 0, 0};
+
+    if (PyBytes_Check(inv))
+    {
+        if (invalidate_state_store(self, inv) < 0
+            || _invalidate(self, inv, &summary) < 0)
+            return NULL;
+    }
+    else
+    {
+        /* Take all the oids (the keys of a dict) at once, so that
+           _p_invalidate methods changing inv don't disturb us. */
+        keys = PySequence_Fast(inv, "expected an oid or an iterable of oids");
+        if (keys == NULL)
+            return NULL;
+        if (invalidate_state_store(self, keys) < 0)
+        {
+            Py_DECREF(keys);
+            return NULL;
+        }
+        n = PySequence_Fast_GET_SIZE(keys);
+        items = PySequence_Fast_ITEMS(keys);
+        for (i = n; --i >= 0; )
+        {
+            if (_invalidate(self, items[i], &summary) < 0)
+            {
+                Py_DECREF(keys);
+                return NULL;
+            }
+        }
+        Py_DECREF(keys);
+
+        /* Dubious:  modifying the input may be an unexpected side effect. */
+        if (PyDict_Check(inv))
+            PyDict_Clear(inv);
+        else if (PyList_Check(inv) && PyList_SetSlice(inv, 0, n, NULL) < 0)
+            return NULL;
+    }
+
+    return Py_BuildValue("{s:n,s:n,s:n}",
+                         "ghosted", summary.ghosted,
+                         "missing", summary.missing,
+                         "classes", summary.classes);
+}
+
+static PyObject *
+cc_invalidate(ccobject *self, PyObject *inv)
+{
+    const char *cause = self->trace_cause;
+    PyObject *result;
+
+    self->trace_cause = "invalidate";
+    result = invalidate_oids(self, inv);
+    self->trace_cause = cause;
+    return result;
+}
+
+/* Invalidate the non-ghost objects that are instances of one of the
+   classes or, if classes is NULL, for which predicate(object) is true,
+   returning how many there were. Ghosts have no state to invalidate, so
+   we only need to look at the ring. */
+static PyObject *
+_invalidate_matching(ccobject *self, PyObject *classes, PyObject *predicate)
+{
+    PyObject *matches, *v, *r;
+    CPersistentRing *here;
+    Py_ssize_t i, j, n, count = 0;
+    int match;
+
+    /* Take the objects first: calling the predicate and invalidating
+       objects changes the ring. */
+    matches = PyList_New(0);
+    if (matches == NULL)
+        return NULL;
+    for (here = self->ring_home.r_next;
+         here != &self->ring_home;
+         here = here->r_next)
+    {
+        if (IS_CACHE_MARKER(self, here))
+            continue;
+        v = (PyObject *)OBJECT_FROM_RING(self, here);
+        if (classes)
+        {
+            match = 0;
+            for (j = 0; j < PyTuple_GET_SIZE(classes) && !match; j++)
+                match = PyType_IsSubtype(
+                    Py_TYPE(v), (PyTypeObject *)PyTuple_GET_ITEM(classes, j));
+            if (!match)
+                continue;
+        }
+        if (PyList_Append(matches, v) < 0)
+            goto err;
+    }
+
+    n = PyList_GET_SIZE(matches);
+    for (i = 0; i < n; i++)
+    {
+        v = PyList_GET_ITEM(matches, i);
+        /* An earlier invalidation or call of the predicate may have
+           ghostified it. */
+        if (((cPersistentObject *)v)->state == cPersistent_GHOST_STATE
+            || ((cPersistentObject *)v)->cache != (PerCache *)self)
+            continue;
+        if (predicate)
+        {
+            r = PyObject_CallOneArg(predicate, v);
+            if (r == NULL)
+                goto err;
+            match = PyObject_IsTrue(r);
+            Py_DECREF(r);
+            if (match < 0)
+                goto err;
+            if (!match
+                || ((cPersistentObject *)v)->state == cPersistent_GHOST_STATE)
+                continue;
+        }
+        self->stat_invalidations++;
+        count++;
+        if (invalidate_object(v) < 0)
+            goto err;
+    }
+    Py_DECREF(matches);
+    return PyLong_FromSsize_t(count);
+err:
+    Py_DECREF(matches);
+    return NULL;
+}
+
+static PyObject *
+invalidate_matching(ccobject *self, PyObject *classes, PyObject *predicate)
+{
+    const char *cause = self->trace_cause;
+    PyObject *result;
+
+    self->trace_cause = "invalidate";
+    result = _invalidate_matching(self, classes, predicate);
+    self->trace_cause = cause;
+    return result;
+}
+
+static PyObject *
+cc_invalidate_classes(ccobject *self, PyObject *classes)
+{
+    PyObject *result;
+    Py_ssize_t i;
+
+    classes = PySequence_Tuple(classes);
+    if (classes == NULL)
+        return NULL;
+    for (i = 0; i < PyTuple_GET_SIZE(classes); i++)
+    {
+        if (!PyType_Check(PyTuple_GET_ITEM(classes, i)))
+        {
+            PyErr_SetString(PyExc_TypeError, "expected classes");
+            Py_DECREF(classes);
+            return NULL;
+        }
+    }
+    result = invalidate_matching(self, classes, NULL);
+    Py_DECREF(classes);
+    return result;
+}
+
+static PyObject *
+cc_invalidate_where(ccobject *self, PyObject *predicate)
+{
+    if (!PyCallable_Check(predicate))
+    {
+        PyErr_SetString(PyExc_TypeError, "predicate must be callable");
+        return NULL;
+    }
+    return invalidate_matching(self, NULL, predicate);
+}
+
+static PyObject *
+cc_get(ccobject *self, PyObject *args)
+{
+    PyObject *r, *key, *d = NULL;
+
+    if (!PyArg_ParseTuple(args, "O|O:get", &key, &d))
+        return NULL;
+
+    r = data_get(self, key);
+    if (!r)
+    {
+        self->stat_misses++;
+        if (d)
+            r = d;
+        else
+            r = Py_None;
+    }
+    else
+    {
+        self->stat_hits++;
+        note_referent(self, r);
+    }
+    Py_INCREF(r);
+    return r;
+}
+
+static PyObject *cc_iter_items(ccobject *self, PyObject *args,
+                               PyObject *kwds);
+
+static PyObject *
+cc_items(ccobject *self)
+{
+    PyObject *it, *l;
+
+    it = cc_iter_items(self, NULL, NULL);
+    if (it == NULL)
+        return NULL;
+    l = PySequence_List(it);
+    Py_DECREF(it);
+    return l;
+}
+
+static PyObject *
+cc_klass_items(ccobject *self)
+{
+    PyObject *l,*k,*v;
+    Py_ssize_t p = 0;
+
+    l = PyList_New(0);
+    if (l == NULL)
+        return NULL;
+
+    while (data_next(self, &p, &k, &v))
+    {
+        if(PyType_Check(v))
+        {
+            v = Py_BuildValue("OO", k, v);
+            if (v == NULL)
+            {
+                Py_DECREF(l);
+                return NULL;
+            }
+            if (PyList_Append(l, v) < 0)
+            {
+                Py_DECREF(v);
+                Py_DECREF(l);
+                return NULL;
+            }
+            Py_DECREF(v);
+        }
+    }
+
+    return l;
+}
+
+static PyObject *
+cc_debug_info(ccobject *self)
+{
+    PyObject *l,*k,*v;
+    Py_ssize_t p = 0;
+
+    l = PyList_New(0);
+    if (l == NULL)
+        return NULL;
+
+    while (data_next(self, &p, &k, &v))
+    {
+        if (Py_REFCNT(v) <= 0)
+            v = Py_BuildValue("On", k, Py_REFCNT(v));
+
+        else if (! PyType_Check(v) &&
+                PER_TypeCheck(v)
+                )
+            v = Py_BuildValue("Onsi",
+                            k, Py_REFCNT(v), Py_TYPE(v)->tp_name,
+                            ((cPersistentObject*)v)->state);
+        else
+            v = Py_BuildValue("Ons", k, Py_REFCNT(v), Py_TYPE(v)->tp_name);
+
+        if (v == NULL)
+            goto err;
+
+        if (PyList_Append(l, v) < 0)
+            goto err;
+    }
+
+    return l;
+
+err:
+    Py_DECREF(l);
+    return NULL;
+}
+
+static PyObject *
+cc_lru_items(ccobject *self)
+{
+    PyObject *l;
+    CPersistentRing *here;
+
+    if (self->ring_lock)
+    {
+        /* When the ring lock is held, we have no way of know which
+            ring nodes belong to persistent objects, and which a
+            placeholders. */
+        PyErr_SetString(PyExc_ValueError,
+                        ".lru_items() is unavailable during garbage collection");
+        return NULL;
+    }
+
+    flush_accesses(self);
+    l = PyList_New(0);
+    if (l == NULL)
+        return NULL;
+
+    here = self->ring_home.r_next;
+    while (here != &self->ring_home)
+    {
+        PyObject *v;
+        cPersistentObject *object;
+
+        if (IS_CACHE_MARKER(self, here))
+        {
+            here = here->r_next;
+            continue;
+        }
+
+        object = OBJECT_FROM_RING(self, here);
+        if (object == NULL)
+        {
+            Py_DECREF(l);
+            return NULL;
+        }
+        v = Py_BuildValue("OO", object->oid, object);
+        if (v == NULL)
+        {
+            Py_DECREF(l);
+            return NULL;
+        }
+        if (PyList_Append(l, v) < 0)
+        {
+            Py_DECREF(v);
+            Py_DECREF(l);
+            return NULL;
+        }
+        Py_DECREF(v);
+        here = here->r_next;
+    }
+
+    return l;
+}
+
+/* Unlink the iterator's nodes from its cache's ring and let go of the
+   cache. */
+static void
+ringiter_detach(ringiter *it)
+{
+    ringiter **link;
+
+    if (it->cache == NULL)
+        return;
+    if (it->here.r_next)
+    {
+        unlink_from_ring(&it->here);
+        unlink_from_ring(&it->end);
+        it->here.r_next = it->here.r_prev = NULL;
+    }
+    for (link = &it->cache->iterators; *link; link = &(*link)->next_iterator)
+        if (*link == it)
+        {
+            *link = it->next_iterator;
+            break;
+        }
+    Py_CLEAR(it->cache);
+}
+
+static PyObject *
+ringiter_next(ringiter *it)
+{
+    ccobject *self = it->cache;
+    CPersistentRing *here;
+    cPersistentObject *object;
+
+    if (self == NULL)
+        return NULL;
+    if (it->here.r_next == NULL || it->limit == 0)
+        goto exhausted;
+    if (self->ring_lock)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "Cannot iterate the cache during garbage collection");
+        return NULL;
+    }
+
+    here = it->here.r_next;
+    while (here != &it->end && IS_CACHE_MARKER(self, here))
+        here = here->r_next;
+    if (here == &it->end || here == &self->ring_home)
+        goto exhausted;
+
+    object = OBJECT_FROM_RING(self, here);
+    unlink_from_ring(&it->here);
+    insert_after(&it->here, here);
+    if (it->limit > 0)
+        it->limit--;
+    return Py_BuildValue("OO", object->oid, object);
+
+exhausted:
+    ringiter_detach(it);
+    return NULL;
+}
+
+static int
+ringiter_traverse(ringiter *it, visitproc visit, void *arg)
+{
+    Py_VISIT(it->cache);
+    return 0;
+}
+
+static int
+ringiter_clear(ringiter *it)
+{
+    ringiter_detach(it);
+    return 0;
+}
+
+static void
+ringiter_dealloc(ringiter *it)
+{
+    PyObject_GC_UnTrack((PyObject *)it);
+    ringiter_detach(it);
+    PyObject_GC_Del(it);
+}
+
+static PyTypeObject RingIterType =
+{
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "persistent.PickleCacheIterator",   /* tp_name */
+    sizeof(ringiter),                   /* tp_basicsize */
+    0,                                  /* tp_itemsize */
+    (destructor)ringiter_dealloc,       /* tp_dealloc */
+    0,                                  /* tp_print */
+    0,                                  /* tp_getattr */
+    0,                                  /* tp_setattr */
+    0,                                  /* tp_compare */
+    0,                                  /* tp_repr */
+    0,                                  /* tp_as_number */
+    0,                                  /* tp_as_sequence */
+    0,                                  /* tp_as_mapping */
+    0,                                  /* tp_hash */
+    0,                                  /* tp_call */
+    0,                                  /* tp_str */
+    0,                                  /* tp_getattro */
+    0,                                  /* tp_setattro */
+    0,                                  /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC, /* tp_flags */
+    0,                                  /* tp_doc */
+    (traverseproc)ringiter_traverse,    /* tp_traverse */
+    (inquiry)ringiter_clear,            /* tp_clear */
+    0,                                  /* tp_richcompare */
+    0,                                  /* tp_weaklistoffset */
+    PyObject_SelfIter,                  /* tp_iter */
+    (iternextfunc)ringiter_next,        /* tp_iternext */
+};
+
+/* Convert a limit argument, which may be None for no limit, to a
+   count, or -1 for no limit. */
+static int
+parse_limit(PyObject *limit, Py_ssize_t *result)
+{
+    *result = -1;
+    if (limit == NULL || limit == Py_None)
+        return 0;
+    *result = PyNumber_AsSsize_t(limit, PyExc_OverflowError);
+    if (*result == -1 && PyErr_Occurred())
+        return -1;
+    if (*result < 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "limit must not be negative");
+        return -1;
+    }
+    return 0;
+}
+
+static PyObject *
+cc_iter_lru_items(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"limit", NULL};
+    PyObject *limit = Py_None;
+    ringiter *it;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|O:iter_lru_items",
+                                     kwlist, &limit))
+        return NULL;
+
+    if (self->ring_lock)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        ".iter_lru_items() is unavailable during garbage collection");
+        return NULL;
+    }
+
+    flush_accesses(self);
+    it = PyObject_GC_New(ringiter, &RingIterType);
+    if (it == NULL)
+        return NULL;
+    it->cache = NULL;
+    it->here.r_next = it->here.r_prev = NULL;
+    it->next_iterator = NULL;
+    if (parse_limit(limit, &it->limit) < 0)
+    {
+        Py_DECREF(it);
+        return NULL;
+    }
+
+    Py_INCREF(self);
+    it->cache = self;
+    insert_after(&it->end, self->ring_home.r_prev);
+    insert_after(&it->here, &self->ring_home);
+    it->next_iterator = self->iterators;
+    self->iterators = it;
+    PyObject_GC_Track((PyObject *)it);
+    return (PyObject *)it;
+}
+
+/* An iterator over the oid index and data, in no particular order. */
+typedef struct
+{
+    PyObject_HEAD
+    ccobject *cache;        /* NULL once exhausted */
+    Py_ssize_t pos;         /* for data_next() */
+    Py_ssize_t limit;       /* how many more items to produce, or -1 */
+    oid_entry *index;       /* the cache's index and ... */
+    Py_ssize_t len;         /* ... length when we started */
+} itemsiter;
+
+static PyObject *
+itemsiter_next(itemsiter *it)
+{
+    ccobject *self = it->cache;
+    PyObject *k, *v;
+
+    if (self == NULL)
+        return NULL;
+    if (self->index != it->index || data_len(self) != it->len)
+    {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "cache changed size during iteration");
+        return NULL;
+    }
+    if (it->limit != 0 && data_next(self, &it->pos, &k, &v))
+    {
+        if (it->limit > 0)
+            it->limit--;
+        return Py_BuildValue("OO", k, v);
+    }
+    Py_CLEAR(it->cache);
+    return NULL;
+}
+
+static int
+itemsiter_traverse(itemsiter *it, visitproc visit, void *arg)
+{
+    Py_VISIT(it->cache);
+    return 0;
+}
+
+static int
+itemsiter_clear(itemsiter *it)
+{
+    Py_CLEAR(it->cache);
+    return 0;
+}
+
+static void
+itemsiter_dealloc(itemsiter *it)
+{
+    PyObject_GC_UnTrack((PyObject *)it);
+    Py_CLEAR(it->cache);
+    PyObject_GC_Del(it);
+}
+
+static PyTypeObject ItemsIterType =
+{
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "persistent.PickleCacheItemsIterator", /* tp_name */
+    sizeof(itemsiter),                  /* tp_basicsize */
+    0,                                  /* tp_itemsize */
+    (destructor)itemsiter_dealloc,      /* tp_dealloc */
+    0,                                  /* tp_print */
+    0,                                  /* tp_getattr */
+    0,                                  /* tp_setattr */
+    0,                                  /* tp_compare */
+    0,                                  /* tp_repr */
+    0,                                  /* tp_as_number */
+    0,                                  /* tp_as_sequence */
+    0,                                  /* tp_as_mapping */
+    0,                                  /* tp_hash */
+    0,                                  /* tp_call */
+    0,                                  /* tp_str */
+    0,                                  /* tp_getattro */
+    0,                                  /* tp_setattro */
+    0,                                  /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC, /* tp_flags */
+    0,                                  /* tp_doc */
+    (traverseproc)itemsiter_traverse,   /* tp_traverse */
+    (inquiry)itemsiter_clear,           /* tp_clear */
+    0,                                  /* tp_richcompare */
+    0,                                  /* tp_weaklistoffset */
+    PyObject_SelfIter,                  /* tp_iter */
+    (iternextfunc)itemsiter_next,       /* tp_iternext */
+};
+
+static PyObject *
+cc_iter_items(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"limit", NULL};
+    PyObject *limit = Py_None;
+    itemsiter *it;
+
+    if (args && !PyArg_ParseTupleAndKeywords(args, kwds, "|O:iter_items",
+                                             kwlist, &limit))
+        return NULL;
+
+    it = PyObject_GC_New(itemsiter, &ItemsIterType);
+    if (it == NULL)
+        return NULL;
+    it->cache = NULL;
+    if (parse_limit(limit, &it->limit) < 0)
+    {
+        Py_DECREF(it);
+        return NULL;
+    }
+    Py_INCREF(self);
+    it->cache = self;
+    it->pos = 0;
+    it->index = self->index;
+    it->len = data_len(self);
+    PyObject_GC_Track((PyObject *)it);
+    return (PyObject *)it;
+}
+
+static void
+cc_oid_unreferenced(ccobject *self, PyObject *oid)
+{
+    /* This is called by the persistent object deallocation function
+        when the reference count on a persistent object reaches
+        zero. We need to fix up our dictionary; its reference is now
+        dangling because we stole its reference count. Be careful to
+        not release the global interpreter lock (or, in the free-threaded
+        build, not to trigger re-entrant deallocation) until this is
+        complete. */
+
+    cPersistentObject *dead_pers_obj;
+    ccobject* dead_pers_obj_ref_to_self;
+
+    /* If the cache has been cleared by GC, data will be NULL. */
+    if (!self->data)
+        return;
+
+    /* The object may be in the access buffer. */
+    flush_accesses(self);
+
+    dead_pers_obj = (cPersistentObject*)data_get(self, oid);
+    assert(dead_pers_obj);
+
+    /* In the free-threaded build, Per_dealloc temporarily sets refcount
+       to 2 before calling us, to prevent PyDict_GetItem's internal
+       INCREF/DECREF from triggering recursive deallocation.
+       In the standard (GIL) build, refcount is 0 at this point. */
+#ifdef Py_GIL_DISABLED
+    assert(Py_REFCNT(dead_pers_obj) == 2);
+#else
+    assert(Py_REFCNT(dead_pers_obj) == 0);
+#endif
+
+    dead_pers_obj_ref_to_self = (ccobject*)dead_pers_obj->cache;
+    assert(dead_pers_obj_ref_to_self == self);
+
+    /* Need to be very hairy here because a dictionary is about
+        to decref an already deleted object.
+    */
+
+    Py_INCREF(dead_pers_obj);
+    /* Incremement the refcount again, because delitem is going to
+        DECREF it.  If its refcount reached zero again, we'd call back to
+        the dealloc function that called us.
+    */
+    Py_INCREF(dead_pers_obj);
+
+    if (data_del(self, oid) < 0)
+    {
+        /* Almost ignore errors if it wasn't already present (somehow;
+           that shouldn't be possible since we literally just got it out
+           of this dict and there should be no concurrent modification).
+           We still need to finish the cleanup.
+
+           Just write an unraisable error (like an exception from __del__,
+           because that's basically what this is).
+        */
+        PyErr_WriteUnraisable((PyObject*)dead_pers_obj);
+        PyErr_Clear();
+        /* Have the same side effect of clearing a ref count as the dict would have.*/
+        Py_DECREF(dead_pers_obj);
+    }
+    /* Now remove the dead object's reference to self. Note that this could
+       cause self to be dealloced.
+    */
+    Py_DECREF(dead_pers_obj_ref_to_self);
+    dead_pers_obj->cache = NULL;
+
+    /* After 2 INCREFs and 1 DECREF (from PyDict_DelItem), the refcount
+       is base + 1 (1 in standard build, 3 in free-threaded build). */
+#ifdef Py_GIL_DISABLED
+    assert(Py_REFCNT(dead_pers_obj) == 3);
+#else
+    assert(Py_REFCNT(dead_pers_obj) == 1);
+#endif
+
+    /* Don't DECREF the object, because this function is called from
+        the object's dealloc function. If the refcnt reaches zero (again), it
+        will all be invoked recursively.
+    */
+}
+
+static PyObject *
+cc_ringlen(ccobject *self)
+{
+    CPersistentRing *here;
+    int c = 0;
+
+    for (here = self->ring_home.r_next; here != &self->ring_home;
+        here = here->r_next)
+        if (!IS_CACHE_MARKER(self, here))
+            c++;
+    return INT_FROM_LONG(c);
+}
+
+/* The loaded hook: let the size estimator for the object's class (or
+   the one for all classes) estimate the size of the object loaded.
+   Errors of the estimator are reported as unraisable, like those of the
+   trace hook, and the object keeps the jar's estimate; its state has
+   been loaded after all. */
+static int
+cache_loaded(PerCache *cache, PyObject *o)
+{
+    ccobject *self = (ccobject *)cache;
+    cPersistentObject *p = (cPersistentObject *)o;
+    PyObject *estimator, *r;
+    Py_ssize_t size;
+
+    estimator = PyDict_GetItemWithError(self->size_estimators,
+                                        (PyObject *)Py_TYPE(o));
+    if (estimator == NULL && !PyErr_Occurred())
+        estimator = PyDict_GetItemWithError(self->size_estimators, Py_None);
+    if (estimator == NULL)
+        return PyErr_Occurred() ? -1 : 0;
+
+    /* It might remove itself. */
+    Py_INCREF(estimator);
+    r = PyObject_CallOneArg(estimator, o);
+    if (r == NULL)
+        goto Error;
+    if (r == Py_None)
+    {
+        /* Keep the jar's estimate. */
+        Py_DECREF(r);
+        Py_DECREF(estimator);
+        return 0;
+    }
+    size = PyNumber_AsSsize_t(r, PyExc_OverflowError);
+    Py_DECREF(r);
+    if (size == -1 && PyErr_Occurred())
+        goto Error;
+    if (size < 0)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "size estimators must not return negative sizes");
+        goto Error;
+    }
+    Py_DECREF(estimator);
+
+    /* What update_object_size_estimation() and setting _p_estimated_size
+       do. */
+    set_object_size(self, p, size, 1);
+    return 0;
+
+Error:
+    PyErr_WriteUnraisable(estimator);
+    Py_DECREF(estimator);
+    return 0;
+}
+
+static PyObject *
+cc_set_size_estimator(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"estimator", "klass", NULL};
+    PyObject *estimator, *klass = Py_None;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|O:set_size_estimator",
+                                     kwlist, &estimator, &klass))
+        return NULL;
+    if (klass != Py_None && !PyType_Check(klass))
+    {
+        PyErr_SetString(PyExc_TypeError, "klass must be a class or None");
+        return NULL;
+    }
+    if (estimator == Py_None)
+    {
+        if (self->size_estimators
+            && PyDict_Contains(self->size_estimators, klass) == 1
+            && PyDict_DelItem(self->size_estimators, klass) < 0)
+            return NULL;
+    }
+    else
+    {
+        if (!PyCallable_Check(estimator))
+        {
+            PyErr_SetString(PyExc_TypeError, "estimator must be callable");
+            return NULL;
+        }
+        if (self->size_estimators == NULL)
+        {
+            self->size_estimators = PyDict_New();
+            if (self->size_estimators == NULL)
+                return NULL;
+        }
+        if (PyDict_SetItem(self->size_estimators, klass, estimator) < 0)
+            return NULL;
+    }
+    if (self->size_estimators && PyDict_GET_SIZE(self->size_estimators))
+        self->loaded = cache_loaded;
+    else
+        self->loaded = NULL;
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+cc_update_object_size_estimation(ccobject *self, PyObject *args)
+{
+    PyObject *oid;
+    cPersistentObject *v;
+    Py_ssize_t new_size;
+    if (!PyArg_ParseTuple(args, "On:updateObjectSizeEstimation",
+                            &oid, &new_size))
+        return NULL;
+    if (new_size < 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "new_size must not be negative");
+        return NULL;
+    }
+    /* Note: reference borrowed */
+    v = (cPersistentObject *)data_get(self, oid);
+    if (v && !PyType_Check(v))
+    {
+        /* we know this object -- update our "total_size_estimation"
+            (only if the object is in the ring) and its exact size.
+
+            We don't set v->estimated_size: we do this in "Connection" as
+            we need it even when the object is not in the cache.
+        */
+        set_object_size(self, v, new_size, 0);
+    }
+    Py_RETURN_NONE;
+}
+
+/* Check that v can be added to the cache as a new ghost for key. */
+static int
+check_new_ghost(ccobject *self, PyObject *key, PyObject *v)
+{
+    PyObject *tmp;
+
+    /* Sanity check the value given to make sure it is allowed in the cache */
+    if (PyType_Check(v))
+    {
+        /* Its a persistent class, such as a ZClass. Thats ok. */
+    }
+    else if (! PER_TypeCheck(v))
+    {
+        /* If it's not an instance of a persistent class, (ie Python
+            classes that derive from persistent.Persistent, BTrees,
+            etc), report an error.
+
+        */
+        PyErr_SetString(PyExc_TypeError,
+                        "Cache values must be persistent objects.");
+        return -1;
+    }
+
+    /* Can't access v->oid directly if the object is a persistent
+    *  class.
+    */
+    if (PyType_Check(v))
+    {
+        tmp = PyObject_GetAttr(v, py__p_oid);
+        if (tmp == NULL)
+            return -1;
+        Py_DECREF(tmp);
+    }
+    else
+        tmp = ((cPersistentObject *)v)->oid;
+    if (tmp != NULL && tmp != Py_None)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "New ghost object must not have an oid");
+        return -1;
+    }
+
+    /* useful sanity check, but not strictly an invariant of this class */
+    if (PyType_Check(v))
+    {
+        tmp = PyObject_GetAttr(v, py__p_jar);
+        if (tmp == NULL)
+            return -1;
+        Py_DECREF(tmp);
+    }
+    else
+        tmp = ((cPersistentObject *)v)->jar;
+    if (tmp != NULL && tmp != Py_None)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "New ghost object must not have a jar");
+        return -1;
+    }
+
+    /* (PyDict_GetItem returns a borrowed reference.) */
+    if (data_get(self, key))
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "The given oid is already in the cache");
+        return -1;
+    }
+
+    if (!PyType_Check(v) && ((cPersistentObject *)v)->cache != NULL)
+    {
+        PyErr_SetString(PyExc_AssertionError, "Already in a cache");
+        return -1;
+    }
+    return 0;
+}
+
+/* Add v, which check_new_ghost() accepted, to the cache as a ghost. */
+static int
+add_new_ghost(ccobject *self, PyObject *key, PyObject *v)
+{
+    if (PyType_Check(v))
+    {
+        if (PyObject_SetAttr(v, py__p_jar, self->jar) < 0)
+            return -1;
+        if (PyObject_SetAttr(v, py__p_oid, key) < 0)
+            return -1;
+        if (data_set(self, key, v) < 0)
+            return -1;
+        self->klass_count++;
+    }
+    else
+    {
+        cPersistentObject *p = (cPersistentObject *)v;
+
+        if (data_set(self, key, v) < 0)
+            return -1;
+        /* the dict should have a borrowed reference */
+        Py_DECREF(v);
+
+        Py_INCREF(self);
+        p->cache = (PerCache *)self;
+        Py_INCREF(self->jar);
+        p->jar = self->jar;
+        Py_INCREF(key);
+        p->oid = key;
+        p->state = cPersistent_GHOST_STATE;
+        note_referent(self, v);
+    }
+
+    self->stat_new_ghosts++;
+    return 0;
+}
+
+static int cc_del_item(ccobject *self, PyObject *key);
+
+/* Undo add_new_ghost(), which may have only partly succeeded.  Without
+   a jar, an instance is up-to-date again.  The current error, if any,
+   is kept. */
+static void
+discard_new_ghost(ccobject *self, PyObject *key, PyObject *v)
+{
+    PyObject *t, *value, *tb;
+
+    PyErr_Fetch(&t, &value, &tb);
+    if (data_get(self, key) == v)
+    {
+        /* add_new_ghost() got as far as adding it, so it finished. */
+        Py_INCREF(v);
+        if (cc_del_item(self, key) < 0)
+            PyErr_Clear();
+        self->stat_new_ghosts--;
+        if (!PyType_Check(v))
+        {
+            cPersistentObject *p = (cPersistentObject *)v;
+
+            Py_CLEAR(p->jar);
+            Py_CLEAR(p->oid);
+            p->state = cPersistent_UPTODATE_STATE;
+        }
+        Py_DECREF(v);
+    }
+    if (PyType_Check(v))
+    {
+        if (PyObject_SetAttr(v, py__p_jar, Py_None) < 0)
+            PyErr_Clear();
+        if (PyObject_SetAttr(v, py__p_oid, Py_None) < 0)
+            PyErr_Clear();
+    }
+    PyErr_Restore(t, value, tb);
+}
+
+static PyObject*
+cc_new_ghost(ccobject *self, PyObject *args)
+{
+    PyObject *key, *v;
+
+    if (!PyArg_ParseTuple(args, "OO:new_ghost", &key, &v))
+        return NULL;
+
+    if (check_new_ghost(self, key, v) < 0 || add_new_ghost(self, key, v) < 0)
+        return NULL;
+
+    Py_RETURN_NONE;
+}
+
+/* Whether v, which check_new_ghost() accepted before new_ghost_many()
+   started adding, has been added since: it was given more than once. */
+static int
+added_new_ghost(PyObject *v)
+{
+    PyObject *oid;
+
+    if (!PyType_Check(v))
+        return ((cPersistentObject *)v)->cache != NULL;
+    oid = PyObject_GetAttr(v, py__p_oid);
+    if (oid == NULL)
+        return -1;
+    Py_DECREF(oid);
+    return oid != Py_None;
+}
+
+static PyObject*
+cc_new_ghost_many(ccobject *self, PyObject *pairs)
+{
+    PyObject *seq, *item, *key, *v, *result = NULL;
+    PyObject **items;
+    Py_ssize_t i, n;
+    int r, repeated;
+
+    seq = PySequence_Fast(pairs, "new_ghost_many() expects an iterable");
+    if (seq == NULL)
+        return NULL;
+    n = PySequence_Fast_GET_SIZE(seq);
+    items = PySequence_Fast_ITEMS(seq);
+
+    /* Check each of them first, so that we add either all of them or
+       none. */
+    for (i = 0; i < n; i++)
+    {
+        item = items[i];
+        if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != 2)
+        {
+            PyErr_SetString(PyExc_TypeError,
+                            "new_ghost_many() expects (oid, object) tuples");
+            goto Done;
+        }
+        if (check_new_ghost(self, PyTuple_GET_ITEM(item, 0),
+                            PyTuple_GET_ITEM(item, 1)) < 0)
+            goto Done;
+    }
+
+    if (index_reserve(self, n) < 0)
+        goto Done;
+    for (i = 0; i < n; i++)
+    {
+        key = PyTuple_GET_ITEM(items[i], 0);
+        v = PyTuple_GET_ITEM(items[i], 1);
+        /* An oid or object given twice shows up once we have added the
+           first; that costs less than checking for that beforehand. */
+        repeated = data_get(self, key) != NULL;
+        if (repeated)
+            PyErr_SetString(PyExc_ValueError,
+                            "The same oid is given more than once");
+        else if ((repeated = added_new_ghost(v)) > 0)
+            PyErr_SetString(PyExc_ValueError,
+                            "The same object is given more than once");
+        r = repeated ? -1 : add_new_ghost(self, key, v);
+        if (r < 0)
+        {
+            /* Adding can still fail part-way, say setting the jar of a
+               persistent class. Take back what we added; a repeated
+               one was added as an earlier pair. */
+            if (repeated)
+                i--;
+            for (; i >= 0; i--)
+                discard_new_ghost(self, PyTuple_GET_ITEM(items[i], 0),
+                                  PyTuple_GET_ITEM(items[i], 1));
+            goto Done;
+        }
+    }
+
+    Py_INCREF(Py_None);
+    result = Py_None;
+Done:
+    Py_DECREF(seq);
+    return result;
+}
+
+/* Activate one object that isn't a ghost instance of Persistent, such
+   as a persistent class, the way the Python implementation does. */
+static int
+reify_other(PyObject *v)
+{
+    PyObject *state, *r;
+    long is_ghost;
+
+    state = PyObject_GetAttrString(v, "_p_state");
+    if (state == NULL)
+    {
+        if (!PyErr_ExceptionMatches(PyExc_AttributeError))
+            return -1;
+        PyErr_Clear();
+        return 0;
+    }
+    is_ghost = PyLong_Check(state) &&
+        PyLong_AsLong(state) == cPersistent_GHOST_STATE;
+    Py_DECREF(state);
+    if (!is_ghost)
+        return 0;
+    r = PyObject_CallMethod(v, "_p_activate", NULL);
+    if (r == NULL)
+        return -1;
+    Py_DECREF(r);
+    return 0;
+}
+
+/* Call the trace hook for an event of the object; see trace() in
+   cPersistence.c. */
+static void
+trace_object(ccobject *self, cPersistentObject *p, const char *event,
+             double duration, const char *cause)
+{
+    PyObject *errtype, *errvalue, *errtb, *r;
+
+    PyErr_Fetch(&errtype, &errvalue, &errtb);
+    Py_INCREF(self->trace_hook);
+    r = PyObject_CallFunction(self->trace_hook, "sOOdz", event,
+                              p->oid ? p->oid : Py_None,
+                              (PyObject *)Py_TYPE(p), duration, cause);
+    if (r == NULL)
+        PyErr_WriteUnraisable(self->trace_hook);
+    else
+        Py_DECREF(r);
+    Py_DECREF(self->trace_hook);
+    PyErr_Restore(errtype, errvalue, errtb);
+}
+
+/* The number of buckets of the activation histograms (see "Activation
+   Histograms" above). */
+#define ACTIVATION_BUCKETS 26
+
+/* The index of the bucket counting an activation of duration seconds. */
+static int
+activation_bucket(double duration)
+{
+    double us = duration * 1e6;
+    int e;
+
+    if (us <= 1.0)
+        return 0;
+    /* The smallest e with us <= 2**e. */
+    if (frexp(us, &e) == 0.5)
+        e--;
+    return e < ACTIVATION_BUCKETS - 1 ? e : ACTIVATION_BUCKETS - 1;
+}
+
+/* The upper bound of a bucket, in seconds. */
+static double
+activation_bound(int bucket)
+{
+    if (bucket == ACTIVATION_BUCKETS - 1)
+        return Py_HUGE_VAL;
+    return ldexp(1.0, bucket) / 1e6;
+}
+
+/* Add one to the int at index i of list. */
+static int
+increment_item(PyObject *list, Py_ssize_t i)
+{
+    Py_ssize_t count = PyLong_AsSsize_t(PyList_GET_ITEM(list, i));
+    PyObject *v;
+
+    if (count == -1 && PyErr_Occurred())
+        return -1;
+    v = PyLong_FromSsize_t(count + 1);
+    if (v == NULL)
+        return -1;
+    return PyList_SetItem(list, i, v);
+}
+
+static int
+count_activation(PyObject *histogram, PyObject *klass, int bucket)
+{
+    PyObject *counts, *zero;
+    Py_ssize_t i;
+
+    counts = PyDict_GetItemWithError(histogram, klass);
+    if (counts == NULL)
+    {
+        if (PyErr_Occurred())
+            return -1;
+        counts = PyList_New(ACTIVATION_BUCKETS + 1);
+        if (counts == NULL)
+            return -1;
+        for (i = 0; i <= ACTIVATION_BUCKETS; i++)
         {
-            v = Py_BuildValue("OO", k, v);
-            if (v == NULL)
-            {
-                Py_DECREF(l);
-                return NULL;
-            }
-            if (PyList_Append(l, v) < 0)
+            zero = PyLong_FromLong(0);
+            if (zero == NULL)
             {
-                Py_DECREF(v);
-                Py_DECREF(l);
-                return NULL;
+                Py_DECREF(counts);
+                return -1;
             }
-            Py_DECREF(v);
+            PyList_SET_ITEM(counts, i, zero);
         }
+        i = PyDict_SetItem(histogram, klass, counts);
+        Py_DECREF(counts);
+        if (i < 0)
+            return -1;
     }
+    if (increment_item(counts, 0) < 0 || increment_item(counts, bucket + 1) < 0)
+        return -1;
+    return 0;
+}
 
-    return l;
+/* Count an activation of an object of the class in the activation
+   histogram. This is the CACHE_HEAD's record_activation hook; it is
+   only called when there is a histogram. */
+static void
+record_activation(PerCache *cache, PyObject *klass, double duration)
+{
+    ccobject *self = (ccobject *)cache;
+
+#ifdef Py_GIL_DISABLED
+    Py_BEGIN_CRITICAL_SECTION(self->activation_histogram);
+#endif
+    if (count_activation(self->activation_histogram, klass,
+                         activation_bucket(duration)) < 0)
+        PyErr_WriteUnraisable((PyObject *)self);
+#ifdef Py_GIL_DISABLED
+    Py_END_CRITICAL_SECTION();
+#endif
 }
 
 static PyObject *
-cc_debug_info(ccobject *self)
+reify_oids(ccobject *self, PyObject *to_reify)
 {
-    PyObject *l,*k,*v;
-    Py_ssize_t p = 0;
+    PyObject *seq, *key, *v, *r;
+    PyObject *ghosts = NULL, *seen = NULL, *setstate_many = NULL;
+    PyObject *result = NULL;
+    PyObject **items;
+    cPersistentObject *p;
+    Py_ssize_t i, n;
+    double start = 0.0;
+    int dup;
 
-    l = PyList_New(0);
-    if (l == NULL)
+    if (PyBytes_Check(to_reify))
+        seq = PyTuple_Pack(1, to_reify);
+    else
+        seq = PySequence_Fast(to_reify, "reify() expects an oid or "
+                              "an iterable of oids");
+    if (seq == NULL)
         return NULL;
+    n = PySequence_Fast_GET_SIZE(seq);
+    items = PySequence_Fast_ITEMS(seq);
+
+    /* Collect the ghosts to load, each of them once even if its oid is
+       given more than once. */
+    ghosts = PyList_New(0);
+    seen = PySet_New(NULL);
+    if (ghosts == NULL || seen == NULL)
+        goto Done;
+    for (i = 0; i < n; i++)
+    {
+        key = items[i];
+        v = data_get(self, key);
+        if (v == NULL)
+        {
+            PyErr_SetObject(PyExc_KeyError, key);
+            goto Done;
+        }
+        if (!PER_TypeCheck(v))
+        {
+            if (reify_other(v) < 0)
+                goto Done;
+            continue;
+        }
+        p = (cPersistentObject *)v;
+        if (p->state != cPersistent_GHOST_STATE || p->jar == NULL)
+            continue;
+        dup = PySet_Contains(seen, key);
+        if (dup < 0)
+            goto Done;
+        if (dup)
+            continue;
+        if (PySet_Add(seen, key) < 0 || PyList_Append(ghosts, v) < 0)
+            goto Done;
+    }
+    n = PyList_GET_SIZE(ghosts);
+    if (n == 0)
+        goto Success;
 
-    while (PyDict_Next(self->data, &p, &k, &v))
+    if (self->jar != NULL)
     {
-        if (Py_REFCNT(v) <= 0)
-            v = Py_BuildValue("On", k, Py_REFCNT(v));
+        setstate_many = PyObject_GetAttrString(self->jar, "setstate_many");
+        if (setstate_many == NULL)
+        {
+            if (!PyErr_ExceptionMatches(PyExc_AttributeError))
+                goto Done;
+            PyErr_Clear();
+        }
+    }
 
-        else if (! PyType_Check(v) &&
-                PER_TypeCheck(v)
-                )
-            v = Py_BuildValue("Onsi",
-                            k, Py_REFCNT(v), Py_TYPE(v)->tp_name,
-                            ((cPersistentObject*)v)->state);
-        else
-            v = Py_BuildValue("Ons", k, Py_REFCNT(v), Py_TYPE(v)->tp_name);
+    if (setstate_many == NULL)
+    {
+        /* The jar can only load one object at a time. */
+        for (i = 0; i < n; i++)
+        {
+            r = PyObject_CallMethod(PyList_GET_ITEM(ghosts, i),
+                                    "_p_activate", NULL);
+            if (r == NULL)
+                goto Done;
+            Py_DECREF(r);
+        }
+        goto Success;
+    }
 
-        if (v == NULL)
-            goto err;
+    /* Do for all of the ghosts what unghostify() does for one of them
+       before calling jar.setstate(): link them into the ring and count
+       them, and mark them changed while their state is being set. */
+    for (i = 0; i < n; i++)
+    {
+        p = (cPersistentObject *)PyList_GET_ITEM(ghosts, i);
+        self->non_ghost_count++;
+        self->total_estimated_size += CACHE_OBJECT_SIZE(self, p);
+        CACHE_ACCOUNT(self, p, 1, CACHE_OBJECT_SIZE(self, p));
+        ring_add(self->ring_insert, &p->ring);
+        Py_INCREF(p);
+        p->state = cPersistent_CHANGED_STATE;
+    }
 
-        if (PyList_Append(l, v) < 0)
-            goto err;
+    if (self->trace_hook || self->activation_histogram)
+        start = perf_counter();
+    r = PyObject_CallFunctionObjArgs(setstate_many, ghosts, NULL);
+    if (r == NULL)
+    {
+        /* Like unghostify(), turn all of them back into ghosts, even
+           those whose state may have been set. */
+        for (i = 0; i < n; i++)
+            cPersistenceCAPI->ghostify(
+                (cPersistentObject *)PyList_GET_ITEM(ghosts, i));
+        goto Done;
+    }
+    Py_DECREF(r);
+    for (i = 0; i < n; i++)
+    {
+        p = (cPersistentObject *)PyList_GET_ITEM(ghosts, i);
+        if (p->state == cPersistent_CHANGED_STATE)
+            p->state = cPersistent_UPTODATE_STATE;
+    }
+    /* Let the size estimators have their say, as unghostify() does. */
+    for (i = 0; i < n && self->loaded; i++)
+        if (self->loaded((PerCache *)self, PyList_GET_ITEM(ghosts, i)) < 0)
+            goto Done;
+    if (self->trace_hook || self->activation_histogram)
+    {
+        /* Each reports how long loading all of them took, but the
+           histogram counts each with its share of the time. */
+        double duration = perf_counter() - start;
+
+        for (i = 0; i < n && self->activation_histogram; i++)
+            record_activation((PerCache *)self,
+                              (PyObject *)Py_TYPE(PyList_GET_ITEM(ghosts, i)),
+                              duration / n);
+        for (i = 0; i < n && self->trace_hook; i++)
+            trace_object(self, (cPersistentObject *)PyList_GET_ITEM(ghosts, i),
+                         "activate", duration, "reify");
     }
 
-    return l;
+Success:
+    Py_INCREF(Py_None);
+    result = Py_None;
+Done:
+    Py_XDECREF(setstate_many);
+    Py_XDECREF(ghosts);
+    Py_XDECREF(seen);
+    Py_DECREF(seq);
+    return result;
+}
 
-err:
-    Py_DECREF(l);
-    return NULL;
+static PyObject *
+cc_reify(ccobject *self, PyObject *to_reify)
+{
+    const char *cause = self->trace_cause;
+    PyObject *result;
+
+    self->trace_cause = "reify";
+    result = reify_oids(self, to_reify);
+    self->trace_cause = cause;
+    return result;
 }
 
 static PyObject *
-cc_lru_items(ccobject *self)
+cc_cache_stats(ccobject *self, PyObject *args, PyObject *kwds)
 {
-    PyObject *l;
-    CPersistentRing *here;
+    static char *kwlist[] = {"reset", NULL};
+    int reset = 0;
+    PyObject *result;
 
-    if (self->ring_lock)
-    {
-        /* When the ring lock is held, we have no way of know which
-            ring nodes belong to persistent objects, and which a
-            placeholders. */
-        PyErr_SetString(PyExc_ValueError,
-                        ".lru_items() is unavailable during garbage collection");
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|p:cache_stats", kwlist,
+                                     &reset))
         return NULL;
+
+    result = Py_BuildValue(
+        "{s:n,s:n,s:n,s:n,s:n,s:n,s:n,s:n,s:n,s:n}",
+        "hits", self->stat_hits,
+        "misses", self->stat_misses,
+        "accesses", self->access_count,
+        "new_ghosts", self->stat_new_ghosts,
+        "incrgc_calls", self->stat_incrgc_calls,
+        "evictions", self->stat_evictions,
+        "invalidations", self->stat_invalidations,
+        "bytes_reclaimed", self->stat_bytes_reclaimed,
+        "ghost_limit_exceeded", self->stat_ghost_limit_exceeded,
+        "ghost_releases", self->stat_ghost_releases);
+
+    if (result != NULL && reset)
+    {
+        self->stat_hits = 0;
+        self->stat_misses = 0;
+        self->access_count = 0;
+        self->stat_new_ghosts = 0;
+        self->stat_incrgc_calls = 0;
+        self->stat_evictions = 0;
+        self->stat_invalidations = 0;
+        self->stat_bytes_reclaimed = 0;
+        self->stat_ghost_limit_exceeded = 0;
+        self->stat_ghost_releases = 0;
     }
+    return result;
+}
 
-    l = PyList_New(0);
-    if (l == NULL)
-        return NULL;
+/* Add the histograms of the classes to the classes dict, counting
+   their activations in *total. */
+static int
+add_activation_histograms(PyObject *histogram, PyObject *classes,
+                          Py_ssize_t *total)
+{
+    PyObject *klass, *counts, *buckets, *bound, *count, *v;
+    Py_ssize_t pos = 0;
+    int i;
 
-    here = self->ring_home.r_next;
-    while (here != &self->ring_home)
+    while (PyDict_Next(histogram, &pos, &klass, &counts))
     {
-        PyObject *v;
-        cPersistentObject *object = OBJECT_FROM_RING(self, here);
-
-        if (object == NULL)
+        buckets = PyDict_New();
+        if (buckets == NULL)
+            return -1;
+        for (i = 0; i < ACTIVATION_BUCKETS; i++)
         {
-            Py_DECREF(l);
-            return NULL;
+            count = PyList_GET_ITEM(counts, i + 1);
+            if (!PyObject_IsTrue(count))
+                continue;
+            bound = PyFloat_FromDouble(activation_bound(i));
+            if (bound == NULL || PyDict_SetItem(buckets, bound, count) < 0)
+            {
+                Py_XDECREF(bound);
+                Py_DECREF(buckets);
+                return -1;
+            }
+            Py_DECREF(bound);
         }
-        v = Py_BuildValue("OO", object->oid, object);
-        if (v == NULL)
+        count = PyList_GET_ITEM(counts, 0);
+        *total += PyLong_AsSsize_t(count);
+        v = Py_BuildValue("{s:O,s:N}", "activations", count,
+                          "buckets", buckets);
+        if (v == NULL || PyDict_SetItem(classes, klass, v) < 0)
         {
-            Py_DECREF(l);
-            return NULL;
+            Py_XDECREF(v);
+            return -1;
         }
-        if (PyList_Append(l, v) < 0)
+        Py_DECREF(v);
+    }
+    return 0;
+}
+
+static PyObject *
+cc_activation_histogram(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"reset", NULL};
+    int reset = 0, error = 0;
+    Py_ssize_t total = 0;
+    PyObject *classes;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|p:activation_histogram",
+                                     kwlist, &reset))
+        return NULL;
+
+    classes = PyDict_New();
+    if (classes == NULL)
+        return NULL;
+    if (self->activation_histogram)
+    {
+#ifdef Py_GIL_DISABLED
+        Py_BEGIN_CRITICAL_SECTION(self->activation_histogram);
+#endif
+        error = add_activation_histograms(self->activation_histogram,
+                                          classes, &total);
+        if (!error && reset)
+            PyDict_Clear(self->activation_histogram);
+#ifdef Py_GIL_DISABLED
+        Py_END_CRITICAL_SECTION();
+#endif
+    }
+    if (error)
+    {
+        Py_DECREF(classes);
+        return NULL;
+    }
+    return Py_BuildValue("{s:n,s:N}", "activations", total,
+                         "classes", classes);
+}
+
+static PyObject *
+cc_set_activation_histogram(ccobject *self, PyObject *enabled)
+{
+    int enable = PyObject_IsTrue(enabled);
+
+    if (enable < 0)
+        return NULL;
+    if (!enable)
+        Py_CLEAR(self->activation_histogram);
+    else if (self->activation_histogram == NULL)
+    {
+        self->activation_histogram = PyDict_New();
+        if (self->activation_histogram == NULL)
+            return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+cc_class_stats(ccobject *self)
+{
+    PyObject *result, *klass, *index, *v;
+    class_record *record;
+    Py_ssize_t pos = 0;
+
+    result = PyDict_New();
+    if (result == NULL)
+        return NULL;
+    while (PyDict_Next(self->class_index, &pos, &klass, &index))
+    {
+        record = &self->classes[PyLong_AsSsize_t(index)];
+        if (record->non_ghost_count == 0 && record->estimated_size == 0)
+            continue;
+        v = Py_BuildValue("nn", record->non_ghost_count,
+                          record->estimated_size);
+        if (v == NULL || PyDict_SetItem(result, klass, v) < 0)
         {
-            Py_DECREF(v);
-            Py_DECREF(l);
+            Py_XDECREF(v);
+            Py_DECREF(result);
             return NULL;
         }
         Py_DECREF(v);
-        here = here->r_next;
     }
+    return result;
+}
 
-    return l;
+/* A random number from the splitmix64 generator, for sample(). */
+static uint64_t
+next_random(ccobject *self)
+{
+    uint64_t z = (self->random_state += 0x9e3779b97f4a7c15ULL);
+
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    return z ^ (z >> 31);
 }
 
-static void
-cc_oid_unreferenced(ccobject *self, PyObject *oid)
+/* Reservoir sampling: the count-th object offered (from 0) replaces a
+   random one of those in sample, once it has k of them. */
+static int
+offer_sample(ccobject *self, PyObject *sample, Py_ssize_t k,
+             Py_ssize_t count, PyObject *v)
 {
-    /* This is called by the persistent object deallocation function
-        when the reference count on a persistent object reaches
-        zero. We need to fix up our dictionary; its reference is now
-        dangling because we stole its reference count. Be careful to
-        not release the global interpreter lock (or, in the free-threaded
-        build, not to trigger re-entrant deallocation) until this is
-        complete. */
+    Py_ssize_t i;
 
-    cPersistentObject *dead_pers_obj;
-    ccobject* dead_pers_obj_ref_to_self;
+    if (count < k)
+        return PyList_Append(sample, v);
+    i = (Py_ssize_t)(next_random(self) % (uint64_t)(count + 1));
+    if (i < k)
+    {
+        Py_INCREF(v);
+        PyList_SetItem(sample, i, v);
+    }
+    return 0;
+}
 
-    /* If the cache has been cleared by GC, data will be NULL. */
-    if (!self->data)
-        return;
+/* A list of up to k objects chosen at random from the non-ghost objects
+   (the ring) or, if ghosts is true, from all persistent objects in the
+   cache. This looks at all of them once, without calling Python code. */
+static PyObject *
+sample_objects(ccobject *self, Py_ssize_t k, int ghosts)
+{
+    PyObject *sample, *oid, *v;
+    CPersistentRing *here;
+    Py_ssize_t count = 0, pos = 0;
 
-    dead_pers_obj = (cPersistentObject*)PyDict_GetItem(self->data, oid);
-    assert(dead_pers_obj);
+    if (k < 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "k must not be negative");
+        return NULL;
+    }
+    if (!ghosts && self->ring_lock)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        ".sample() is unavailable during garbage collection");
+        return NULL;
+    }
+    sample = PyList_New(0);
+    if (sample == NULL || k == 0)
+        return sample;
 
-    /* In the free-threaded build, Per_dealloc temporarily sets refcount
-       to 2 before calling us, to prevent PyDict_GetItem's internal
-       INCREF/DECREF from triggering recursive deallocation.
-       In the standard (GIL) build, refcount is 0 at this point. */
-#ifdef Py_GIL_DISABLED
-    assert(Py_REFCNT(dead_pers_obj) == 2);
-#else
-    assert(Py_REFCNT(dead_pers_obj) == 0);
-#endif
+    if (ghosts)
+    {
+        while (data_next(self, &pos, &oid, &v))
+        {
+            if (PyType_Check(v) || !PER_TypeCheck(v))
+                continue;
+            if (offer_sample(self, sample, k, count++, v) < 0)
+                goto err;
+        }
+        return sample;
+    }
 
-    dead_pers_obj_ref_to_self = (ccobject*)dead_pers_obj->cache;
-    assert(dead_pers_obj_ref_to_self == self);
+    for (here = self->ring_home.r_next; here != &self->ring_home;
+         here = here->r_next)
+    {
+        if (IS_CACHE_MARKER(self, here))
+            continue;
+        v = (PyObject *)OBJECT_FROM_RING(self, here);
+        if (offer_sample(self, sample, k, count++, v) < 0)
+            goto err;
+    }
+    return sample;
+err:
+    Py_DECREF(sample);
+    return NULL;
+}
 
-    /* Need to be very hairy here because a dictionary is about
-        to decref an already deleted object.
-    */
+static PyObject *
+cc_sample(ccobject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"k", "ghosts", NULL};
+    Py_ssize_t k;
+    int ghosts = 0;
 
-    Py_INCREF(dead_pers_obj);
-    /* Incremement the refcount again, because delitem is going to
-        DECREF it.  If its refcount reached zero again, we'd call back to
-        the dealloc function that called us.
-    */
-    Py_INCREF(dead_pers_obj);
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "n|p:sample", kwlist,
+                                     &k, &ghosts))
+        return NULL;
+    return sample_objects(self, k, ghosts);
+}
 
-    if (PyDict_DelItem(self->data, oid) < 0)
-    {
-        /* Almost ignore errors if it wasn't already present (somehow;
-           that shouldn't be possible since we literally just got it out
-           of this dict and there should be no concurrent modification).
-           We still need to finish the cleanup.
+static PyObject *
+cc_estimate_composition(ccobject *self, PyObject *args)
+{
+    PyObject *sample, *counts, *result = NULL, *klass, *v;
+    Py_ssize_t k, i, n, pos = 0, count, size;
+    cPersistentObject *p;
+    double scale;
 
-           Just write an unraisable error (like an exception from __del__,
-           because that's basically what this is).
-        */
-        PyErr_WriteUnraisable((PyObject*)dead_pers_obj);
-        PyErr_Clear();
-        /* Have the same side effect of clearing a ref count as the dict would have.*/
-        Py_DECREF(dead_pers_obj);
+    if (!PyArg_ParseTuple(args, "n:estimate_composition", &k))
+        return NULL;
+    sample = sample_objects(self, k, 0);
+    if (sample == NULL)
+        return NULL;
+    /* class -> [count, size] of the sample */
+    counts = PyDict_New();
+    if (counts == NULL)
+        goto Done;
+    n = PyList_GET_SIZE(sample);
+    for (i = 0; i < n; i++)
+    {
+        p = (cPersistentObject *)PyList_GET_ITEM(sample, i);
+        count = size = 0;
+        v = PyDict_GetItem(counts, (PyObject *)Py_TYPE(p));
+        if (v && !PyArg_ParseTuple(v, "nn", &count, &size))
+            goto Done;
+        v = Py_BuildValue("nn", count + 1,
+                          size + CACHE_OBJECT_SIZE(self, p));
+        if (v == NULL)
+            goto Done;
+        if (PyDict_SetItem(counts, (PyObject *)Py_TYPE(p), v) < 0)
+        {
+            Py_DECREF(v);
+            goto Done;
+        }
+        Py_DECREF(v);
     }
-    /* Now remove the dead object's reference to self. Note that this could
-       cause self to be dealloced.
-    */
-    Py_DECREF(dead_pers_obj_ref_to_self);
-    dead_pers_obj->cache = NULL;
-
-    /* After 2 INCREFs and 1 DECREF (from PyDict_DelItem), the refcount
-       is base + 1 (1 in standard build, 3 in free-threaded build). */
-#ifdef Py_GIL_DISABLED
-    assert(Py_REFCNT(dead_pers_obj) == 3);
-#else
-    assert(Py_REFCNT(dead_pers_obj) == 1);
-#endif
 
-    /* Don't DECREF the object, because this function is called from
-        the object's dealloc function. If the refcnt reaches zero (again), it
-        will all be invoked recursively.
-    */
+    /* Each object of the sample stands for scale objects. */
+    scale = n ? (double)self->non_ghost_count / n : 0.0;
+    result = PyDict_New();
+    if (result == NULL)
+        goto Done;
+    while (PyDict_Next(counts, &pos, &klass, &v))
+    {
+        if (!PyArg_ParseTuple(v, "nn", &count, &size))
+            goto err;
+        v = Py_BuildValue("nn", (Py_ssize_t)(count * scale + 0.5),
+                          (Py_ssize_t)(size * scale + 0.5));
+        if (v == NULL)
+            goto err;
+        if (PyDict_SetItem(result, klass, v) < 0)
+        {
+            Py_DECREF(v);
+            goto err;
+        }
+        Py_DECREF(v);
+    }
+    goto Done;
+err:
+    Py_CLEAR(result);
+Done:
+    Py_XDECREF(counts);
+    Py_DECREF(sample);
+    return result;
 }
 
 static PyObject *
-cc_ringlen(ccobject *self)
+cc_ghost_stats(ccobject *self)
 {
-    CPersistentRing *here;
-    int c = 0;
+    PyObject *result, *k, *v, *counts;
+    Py_ssize_t pos = 0, count, size;
 
-    for (here = self->ring_home.r_next; here != &self->ring_home;
-        here = here->r_next)
-        c++;
-    return INT_FROM_LONG(c);
+    result = PyDict_New();
+    if (result == NULL)
+        return NULL;
+    while (data_next(self, &pos, &k, &v))
+    {
+        if (PyType_Check(v)
+            || !PER_TypeCheck(v)
+            || ((cPersistentObject *)v)->state != cPersistent_GHOST_STATE)
+            continue;
+        count = size = 0;
+        counts = PyDict_GetItem(result, (PyObject *)Py_TYPE(v));
+        if (counts
+            && !PyArg_ParseTuple(counts, "nn", &count, &size))
+            goto err;
+        counts = Py_BuildValue("nn", count + 1,
+                               size + Py_TYPE(v)->tp_basicsize);
+        if (counts == NULL)
+            goto err;
+        if (PyDict_SetItem(result, (PyObject *)Py_TYPE(v), counts) < 0)
+        {
+            Py_DECREF(counts);
+            goto err;
+        }
+        Py_DECREF(counts);
+    }
+    return result;
+err:
+    Py_DECREF(result);
+    return NULL;
 }
 
 static PyObject *
-cc_update_object_size_estimation(ccobject *self, PyObject *args)
+cc_set_ghost_limit(ccobject *self, PyObject *args, PyObject *kwds)
 {
-    PyObject *oid;
-    cPersistentObject *v;
-    unsigned int new_size;
-    if (!PyArg_ParseTuple(args, "OI:updateObjectSizeEstimation",
-                            &oid, &new_size))
+    static char *kwlist[] = {"limit", "release", NULL};
+    PyObject *limit;
+    int release = 1;
+    Py_ssize_t ghost_limit = -1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|p:set_ghost_limit",
+                                     kwlist, &limit, &release))
         return NULL;
-    /* Note: reference borrowed */
-    v = (cPersistentObject *)PyDict_GetItem(self->data, oid);
-    if (v)
+    if (limit != Py_None)
     {
-        /* we know this object -- update our "total_size_estimation"
-            we must only update when the object is in the ring
-        */
-        if (v->ring.r_next)
+        ghost_limit = PyNumber_AsSsize_t(limit, PyExc_OverflowError);
+        if (ghost_limit == -1 && PyErr_Occurred())
+            return NULL;
+        if (ghost_limit < 0)
         {
-            self->total_estimated_size += _estimated_size_in_bytes(
-                (int)(_estimated_size_in_24_bits(new_size))
-                    - (int)(v->estimated_size)
-                );
-            /* we do this in "Connection" as we need it even when the
-                object is not in the cache (or not the ring)
-            */
-            /* v->estimated_size = new_size; */
+            PyErr_SetString(PyExc_ValueError, "limit must not be negative");
+            return NULL;
         }
     }
+    self->ghost_limit = ghost_limit;
+    self->ghost_release = release;
     Py_RETURN_NONE;
 }
 
-static PyObject*
-cc_new_ghost(ccobject *self, PyObject *args)
+static PyObject *
+cc_set_access_buffer(ccobject *self, PyObject *args)
 {
-    PyObject *tmp, *key, *v;
+    int size;
+    PyObject **buffer = NULL;
 
-    if (!PyArg_ParseTuple(args, "OO:new_ghost", &key, &v))
+    if (!PyArg_ParseTuple(args, "i:set_access_buffer", &size))
         return NULL;
-
-    /* Sanity check the value given to make sure it is allowed in the cache */
-    if (PyType_Check(v))
+    if (size < 0)
     {
-        /* Its a persistent class, such as a ZClass. Thats ok. */
+        PyErr_SetString(PyExc_ValueError, "size must not be negative");
+        return NULL;
     }
-    else if (! PER_TypeCheck(v))
+    if (size)
     {
-        /* If it's not an instance of a persistent class, (ie Python
-            classes that derive from persistent.Persistent, BTrees,
-            etc), report an error.
-
-        */
-        PyErr_SetString(PyExc_TypeError,
-                        "Cache values must be persistent objects.");
-        return NULL;
+        buffer = PyMem_New(PyObject *, size);
+        if (buffer == NULL)
+            return PyErr_NoMemory();
     }
+    flush_accesses(self);
+    PyMem_Free(self->access_buffer);
+    self->access_buffer = buffer;
+    self->access_buffer_size = size;
+    Py_RETURN_NONE;
+}
 
-    /* Can't access v->oid directly because the object might be a
-    *  persistent class.
-    */
-    tmp = PyObject_GetAttr(v, py__p_oid);
-    if (tmp == NULL)
-        return NULL;
-    Py_DECREF(tmp);
-    if (tmp != Py_None)
+static PyObject *
+cc_set_trace_hook(ccobject *self, PyObject *hook)
+{
+    if (hook == Py_None)
+        hook = NULL;
+    else if (!PyCallable_Check(hook))
     {
-        PyErr_SetString(PyExc_ValueError,
-                        "New ghost object must not have an oid");
+        PyErr_SetString(PyExc_TypeError, "hook must be callable");
         return NULL;
     }
+    Py_XINCREF(hook);
+    Py_XSETREF(self->trace_hook, hook);
+    Py_RETURN_NONE;
+}
 
-    /* useful sanity check, but not strictly an invariant of this class */
-    tmp = PyObject_GetAttr(v, py__p_jar);
-    if (tmp == NULL)
+static PyObject *
+cc_access_buffer_size(ccobject *self, void *context)
+{
+    return PyLong_FromLong(self->access_buffer_size);
+}
+
+static PyObject *
+cc_ghost_count(ccobject *self, void *context)
+{
+    return PyLong_FromSsize_t(GHOST_COUNT(self));
+}
+
+static PyObject *
+cc_class_quotas(ccobject *self)
+{
+    PyObject *result, *klass, *index, *v;
+    class_record *record;
+    Py_ssize_t pos = 0;
+
+    result = PyDict_New();
+    if (result == NULL)
         return NULL;
-    Py_DECREF(tmp);
-    if (tmp != Py_None)
+    while (PyDict_Next(self->class_index, &pos, &klass, &index))
     {
-        PyErr_SetString(PyExc_ValueError,
-                        "New ghost object must not have a jar");
-        return NULL;
+        record = &self->classes[PyLong_AsSsize_t(index)];
+        if (record->quota < 0)
+            continue;
+        v = PyLong_FromSsize_t(record->quota);
+        if (v == NULL || PyDict_SetItem(result, klass, v) < 0)
+        {
+            Py_XDECREF(v);
+            Py_DECREF(result);
+            return NULL;
+        }
+        Py_DECREF(v);
     }
+    return result;
+}
+
+static PyObject *
+cc_set_class_quota(ccobject *self, PyObject *args)
+{
+    PyObject *klass, *max_count;
+    class_record *record;
+    Py_ssize_t quota = -1;
 
-    tmp = PyDict_GetItem(self->data, key);
-    if (tmp)
+    if (!PyArg_ParseTuple(args, "OO:set_class_quota", &klass, &max_count))
+        return NULL;
+    if (!PyType_Check(klass))
     {
-        Py_DECREF(tmp);
-        PyErr_SetString(PyExc_ValueError,
-                        "The given oid is already in the cache");
+        PyErr_SetString(PyExc_TypeError, "Quotas are set for classes");
         return NULL;
     }
-
-    if (PyType_Check(v))
+    if (max_count != Py_None)
     {
-        if (PyObject_SetAttr(v, py__p_jar, self->jar) < 0)
+        quota = PyNumber_AsSsize_t(max_count, PyExc_OverflowError);
+        if (quota == -1 && PyErr_Occurred())
             return NULL;
-        if (PyObject_SetAttr(v, py__p_oid, key) < 0)
+        if (quota < 0)
+        {
+            PyErr_SetString(PyExc_ValueError,
+                            "max_count must not be negative");
             return NULL;
-        if (PyDict_SetItem(self->data, key, v) < 0)
+        }
+    }
+    record = get_class_record(self, klass, quota >= 0);
+    if (record == NULL)
+    {
+        if (PyErr_Occurred())
             return NULL;
-        PyObject_GC_UnTrack((void *)self->data);
-        self->klass_count++;
     }
     else
-    {
-        cPersistentObject *p = (cPersistentObject *)v;
+        record->quota = quota;
+    Py_RETURN_NONE;
+}
 
-        if(p->cache != NULL)
-        {
-            PyErr_SetString(PyExc_AssertionError, "Already in a cache");
+static PyObject *
+cc_pin(ccobject *self, PyObject *oid)
+{
+    if (self->priorities == NULL)
+    {
+        self->priorities = PyDict_New();
+        if (self->priorities == NULL)
             return NULL;
-        }
+    }
+    if (PyDict_SetItem(self->priorities, oid, Py_None) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
 
-        if (PyDict_SetItem(self->data, key, v) < 0)
-            return NULL;
-        /* the dict should have a borrowed reference */
-        PyObject_GC_UnTrack((void *)self->data);
-        Py_DECREF(v);
+static PyObject *
+cc_unpin(ccobject *self, PyObject *oid)
+{
+    PyObject *v;
 
-        Py_INCREF(self);
-        p->cache = (PerCache *)self;
-        Py_INCREF(self->jar);
-        p->jar = self->jar;
-        Py_INCREF(key);
-        p->oid = key;
-        p->state = cPersistent_GHOST_STATE;
-    }
+    if (self->priorities == NULL)
+        Py_RETURN_NONE;
+    v = PyDict_GetItemWithError(self->priorities, oid);
+    if (v == NULL && PyErr_Occurred())
+        return NULL;
+    if (v == Py_None && PyDict_DelItem(self->priorities, oid) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+cc_set_priority(ccobject *self, PyObject *args)
+{
+    PyObject *oid, *v;
+    Py_ssize_t priority;
+    int found;
 
+    if (!PyArg_ParseTuple(args, "On:set_priority", &oid, &priority))
+        return NULL;
+    if (priority < 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "priority must not be negative");
+        return NULL;
+    }
+    if (self->priorities == NULL)
+    {
+        if (priority == 0)
+            Py_RETURN_NONE;
+        self->priorities = PyDict_New();
+        if (self->priorities == NULL)
+            return NULL;
+    }
+    if (priority == 0)
+    {
+        found = PyDict_Contains(self->priorities, oid);
+        if (found < 0
+            || (found && PyDict_DelItem(self->priorities, oid) < 0))
+            return NULL;
+        Py_RETURN_NONE;
+    }
+    v = PyLong_FromSsize_t(priority);
+    if (v == NULL)
+        return NULL;
+    found = PyDict_SetItem(self->priorities, oid, v);
+    Py_DECREF(v);
+    if (found < 0)
+        return NULL;
     Py_RETURN_NONE;
 }
 
+static PyObject *
+cc_priorities(ccobject *self)
+{
+    if (self->priorities == NULL)
+        return PyDict_New();
+    return PyDict_Copy(self->priorities);
+}
+
 static struct PyMethodDef cc_methods[] = {
     {"items", (PyCFunction)cc_items, METH_NOARGS,
      "Return list of oid, object pairs for all items in cache."},
@@ -833,19 +3944,31 @@ static struct PyMethodDef cc_methods[] = {
     {"lru_items", (PyCFunction)cc_lru_items, METH_NOARGS,
      "List (oid, object) pairs from the lru list, as 2-tuples."},
 
+    {"iter_items", (PyCFunction)cc_iter_items, METH_VARARGS | METH_KEYWORDS,
+     "iter_items(limit=None) -- "
+     "Iterate over (oid, object) pairs for the items in the cache."},
+
+    {"iter_lru_items", (PyCFunction)cc_iter_lru_items,
+     METH_VARARGS | METH_KEYWORDS,
+     "iter_lru_items(limit=None) -- "
+     "Iterate over (oid, object) pairs from the lru list."},
+
     {"klass_items", (PyCFunction)cc_klass_items, METH_NOARGS,
      "List (oid, object) pairs of cached persistent classes."},
 
-    {"full_sweep", (PyCFunction)cc_full_sweep, METH_VARARGS,
-     "full_sweep() -- Perform a full sweep of the cache."},
+    {"full_sweep", (PyCFunction)cc_full_sweep, METH_VARARGS | METH_KEYWORDS,
+     "full_sweep(*, max_seconds=None, max_objects=None) -- "
+     "Perform a full sweep of the cache."},
 
-    {"minimize",    (PyCFunction)cc_minimize, METH_VARARGS,
-     "minimize([ignored]) -- Remove as many objects as possible\n\n"
+    {"minimize", (PyCFunction)cc_minimize, METH_VARARGS | METH_KEYWORDS,
+     "minimize([ignored], *, max_seconds=None, max_objects=None) -- "
+     "Remove as many objects as possible\n\n"
      "Ghostify all objects that are not modified.  Takes an optional\n"
      "argument, but ignores it."},
 
-    {"incrgc", (PyCFunction)cc_incrgc, METH_VARARGS,
-     "incrgc() -- Perform incremental garbage collection\n\n"
+    {"incrgc", (PyCFunction)cc_incrgc, METH_VARARGS | METH_KEYWORDS,
+     "incrgc(*, max_seconds=None, max_objects=None) -- "
+     "Perform incremental garbage collection\n\n"
      "This method had been depricated!"
      "Some other implementations support an optional parameter 'n' which\n"
      "indicates a repetition count; this value is ignored."},
@@ -853,6 +3976,14 @@ static struct PyMethodDef cc_methods[] = {
     {"invalidate", (PyCFunction)cc_invalidate, METH_O,
      "invalidate(oids) -- invalidate one, many, or all ids"},
 
+    {"invalidate_classes", (PyCFunction)cc_invalidate_classes, METH_O,
+     "invalidate_classes(classes) -- invalidate the instances of the\n"
+     "classes"},
+
+    {"invalidate_where", (PyCFunction)cc_invalidate_where, METH_O,
+     "invalidate_where(predicate) -- invalidate the objects for which\n"
+     "predicate(object) is true"},
+
     {"get", (PyCFunction)cc_get, METH_VARARGS,
      "get(key [, default]) -- get an item, or a default"},
 
@@ -868,21 +3999,159 @@ static struct PyMethodDef cc_methods[] = {
      "update the caches size estimation for *oid* "
      "(if this is known to the cache)."},
 
+    {"set_size_estimator", (PyCFunction)cc_set_size_estimator,
+     METH_VARARGS | METH_KEYWORDS,
+     "set_size_estimator(estimator, klass=None) -- Estimate the size of\n"
+     "the objects of the class (or of all classes) with estimator(object)\n"
+     "when they are loaded (None removes the estimator)."},
+
     {"new_ghost", (PyCFunction)cc_new_ghost, METH_VARARGS,
      "new_ghost() -- Initialize a ghost and add it to the cache."},
 
+    {"new_ghost_many", (PyCFunction)cc_new_ghost_many, METH_O,
+     "new_ghost_many(pairs) -- Initialize ghosts from an iterable of\n"
+     "(oid, object) pairs and add them to the cache.\n\n"
+     "Either all of them are added, or (in case of an error) none."},
+
+    {"class_stats", (PyCFunction)cc_class_stats, METH_NOARGS,
+     "class_stats() -- Return a dict mapping the classes of the non-ghost\n"
+     "objects to their number and total estimated size."},
+
+    {"pin", (PyCFunction)cc_pin, METH_O,
+     "pin(oid) -- Never let garbage collection ghostify the object."},
+
+    {"unpin", (PyCFunction)cc_unpin, METH_O,
+     "unpin(oid) -- Undo pin(oid)."},
+
+    {"set_priority", (PyCFunction)cc_set_priority, METH_VARARGS,
+     "set_priority(oid, priority) -- Make incremental garbage collection\n"
+     "ghostify the object only after those with lower priorities."},
+
+    {"priorities", (PyCFunction)cc_priorities, METH_NOARGS,
+     "priorities() -- Return a dict mapping the oids given a priority\n"
+     "to it (None for pinned ones)."},
+
+    {"sample", (PyCFunction)cc_sample, METH_VARARGS | METH_KEYWORDS,
+     "sample(k, ghosts=False) -- Return a list of up to k objects chosen\n"
+     "at random from the non-ghost objects, or all objects if ghosts is\n"
+     "true."},
+
+    {"estimate_composition", (PyCFunction)cc_estimate_composition,
+     METH_VARARGS,
+     "estimate_composition(k) -- Estimate class_stats() from a sample of\n"
+     "k non-ghost objects."},
+
+    {"set_class_quota", (PyCFunction)cc_set_class_quota, METH_VARARGS,
+     "set_class_quota(klass, max_count) -- Limit the number of non-ghost\n"
+     "objects of the class (None removes the limit)."},
+
+    {"class_quotas", (PyCFunction)cc_class_quotas, METH_NOARGS,
+     "class_quotas() -- Return a dict mapping classes to their quotas."},
+
+    {"ghost_stats", (PyCFunction)cc_ghost_stats, METH_NOARGS,
+     "ghost_stats() -- Return a dict mapping the classes of the ghosts\n"
+     "to their number and total size."},
+
+    {"set_ghost_limit", (PyCFunction)cc_set_ghost_limit,
+     METH_VARARGS | METH_KEYWORDS,
+     "set_ghost_limit(limit, release=True) -- Limit the number of ghosts\n"
+     "in the cache (None removes the limit)."},
+
+    {"set_trace_hook", (PyCFunction)cc_set_trace_hook, METH_O,
+     "set_trace_hook(hook) -- Call hook(event, oid, class, duration,\n"
+     "cause) when objects are activated, ghostified or registered\n"
+     "(None removes it)."},
+
+    {"set_activation_histogram", (PyCFunction)cc_set_activation_histogram,
+     METH_O,
+     "set_activation_histogram(enabled) -- Start or stop counting how long\n"
+     "activating objects takes, per class."},
+
+    {"activation_histogram", (PyCFunction)cc_activation_histogram,
+     METH_VARARGS | METH_KEYWORDS,
+     "activation_histogram(reset=False) -- Return a dict with the number\n"
+     "of activations and their durations per class.\n\n"
+     "If reset is true, the counts are set back to zero."},
+
+    {"set_access_buffer", (PyCFunction)cc_set_access_buffer, METH_VARARGS,
+     "set_access_buffer(size) -- Record up to size accesses before moving\n"
+     "the objects in the ring (0 moves them right away)."},
+
+    {"reify", (PyCFunction)cc_reify, METH_O,
+     "reify(to_reify) -- Activate the ghosts among the given oids.\n\n"
+     "If the jar has a setstate_many() method, it is called once with\n"
+     "all of them; otherwise they are activated one at a time."},
+
+    {"start_sweeper", (PyCFunction)cc_start_sweeper,
+     METH_VARARGS | METH_KEYWORDS,
+     "start_sweeper(high_water=None, low_water=None, high_water_bytes=None,\n"
+     "              low_water_bytes=None, interval=1.0, max_seconds=0.01)\n"
+     "-- Start a thread that keeps the cache between the water marks."},
+
+    {"stop_sweeper", (PyCFunction)cc_stop_sweeper, METH_NOARGS,
+     "stop_sweeper() -- Stop the thread started by start_sweeper()."},
+
+    {"enable_memory_controller", (PyCFunction)cc_enable_memory_controller,
+     METH_VARARGS | METH_KEYWORDS,
+     "enable_memory_controller(min_bytes=1 << 20, max_bytes=None,\n"
+     "                         low_watermark=0.7, high_watermark=0.85,\n"
+     "                         step=0.1, interval=1.0)\n"
+     "-- Let incrgc() adjust cache_size_bytes to the memory available."},
+
+    {"disable_memory_controller", (PyCFunction)cc_disable_memory_controller,
+     METH_NOARGS,
+     "disable_memory_controller() -- "
+     "Stop adjusting cache_size_bytes, restoring it."},
+
+    {"snapshot_hot", (PyCFunction)cc_snapshot_hot,
+     METH_VARARGS | METH_KEYWORDS,
+     "snapshot_hot(path, limit=None) -- Write the oids of the most\n"
+     "recently used objects to a file, as packed 8-byte oids."},
+
+    {"prewarm", (PyCFunction)cc_prewarm, METH_VARARGS | METH_KEYWORDS,
+     "prewarm(path, limit=None, factory=None) -- Load the objects whose\n"
+     "oids snapshot_hot() wrote to the file."},
+
+    {"_sweep", (PyCFunction)cc__sweep, METH_VARARGS | METH_KEYWORDS,
+     "_sweep(target, target_size_bytes=0, max_seconds=None, "
+     "max_objects=None)\n"
+     "-- Ghostify objects until the given targets are met."},
+
+    {"cache_stats", (PyCFunction)cc_cache_stats, METH_VARARGS | METH_KEYWORDS,
+     "cache_stats(reset=False) -- Return a dict of usage counters.\n\n"
+     "If reset is true, the counters are set back to zero."},
+
     {NULL, NULL}        /* sentinel */
 };
 
 static int
 cc_init(ccobject *self, PyObject *args, PyObject *kwds)
 {
+    static char *kwlist[] = {"jar", "target_size", "cache_size_bytes",
+                             "eviction_policy", "exact_sizes", "state_store",
+                             NULL};
     int cache_size = 100;
     Py_ssize_t cache_size_bytes = 0;
-    PyObject *jar;
+    const char *policy_name = policy_names[POLICY_LRU];
+    int policy;
+    PyObject *jar, *state_store = NULL;
+    int exact_sizes = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|inspO:PickleCache",
+                                     kwlist, &jar, &cache_size,
+                                     &cache_size_bytes, &policy_name,
+                                     &exact_sizes, &state_store))
+        return -1;
 
-    if (!PyArg_ParseTuple(args, "O|in", &jar, &cache_size, &cache_size_bytes))
+    for (policy = 0; policy_names[policy]; policy++)
+        if (!strcmp(policy_name, policy_names[policy]))
+            break;
+    if (!policy_names[policy])
+    {
+        PyErr_Format(PyExc_ValueError, "Unknown eviction policy '%s'",
+                     policy_name);
         return -1;
+    }
 
     self->jar = NULL;
     self->data = PyDict_New();
@@ -911,8 +4180,44 @@ cc_init(ccobject *self, PyObject *args, PyObject *kwds)
     self->klass_count = 0;
     self->cache_drain_resistance = 0;
     self->ring_lock = 0;
+    self->iterators = NULL;
     self->ring_home.r_next = &self->ring_home;
     self->ring_home.r_prev = &self->ring_home;
+    self->ring_insert = &self->ring_home;
+    self->policy = policy;
+    self->arc_p = 0;
+    self->ghost_limit = -1;
+    self->ghost_release = 1;
+    self->class_index = PyDict_New();
+    if (self->class_index == NULL)
+        return -1;
+    self->account = account_object;
+    self->loaded = NULL;
+    self->exact_sizes = exact_sizes;
+    Py_XINCREF(state_store);
+    self->state_store = state_store;
+    self->object_size = exact_sizes ? cache_object_size : NULL;
+    self->drain_accesses = drain_accesses;
+    self->record_activation = record_activation;
+    self->random_state = (uint64_t)(uintptr_t)self ^ (uint64_t)time(NULL);
+    self->reference = policy == POLICY_CLOCK ? reference_object : NULL;
+    if (policy != POLICY_LRU && policy != POLICY_CLOCK)
+    {
+        insert_after(&self->ring_segment, &self->ring_home);
+        self->ring_insert = &self->ring_segment;
+    }
+    if (policy == POLICY_2Q || policy == POLICY_ARC)
+    {
+        self->history_probation = PyObject_CallNoArgs(OrderedDict);
+        if (self->history_probation == NULL)
+            return -1;
+    }
+    if (policy == POLICY_ARC)
+    {
+        self->history_protected = PyObject_CallNoArgs(OrderedDict);
+        if (self->history_protected == NULL)
+            return -1;
+    }
     return 0;
 }
 
@@ -922,6 +4227,19 @@ cc_dealloc(ccobject *self)
     PyObject_GC_UnTrack((PyObject *)self);
     Py_XDECREF(self->data);
     Py_XDECREF(self->jar);
+    Py_XDECREF(self->history_probation);
+    Py_XDECREF(self->history_protected);
+    Py_XDECREF(self->sweeper);
+    Py_XDECREF(self->memory_controller);
+    Py_XDECREF(self->size_estimators);
+    Py_XDECREF(self->state_store);
+    Py_XDECREF(self->trace_hook);
+    Py_XDECREF(self->activation_histogram);
+    Py_XDECREF(self->priorities);
+    PyMem_Free(self->access_buffer);
+    Py_XDECREF(self->class_index);
+    PyMem_Free(self->classes);
+    PyMem_Free(self->index);
     PyObject_GC_Del(self);
 }
 
@@ -949,6 +4267,45 @@ cc_clear(ccobject *self)
     */
     assert(! self->ring_lock);
 
+    self->account = NULL;
+    Py_CLEAR(self->class_index);
+    self->classes_used = 0;
+    /* The objects are going away; don't move them. */
+    self->access_buffer_used = 0;
+
+    while (self->iterators)
+    {
+        /* The iterators hold on to the cache, so these are going away
+           too. Leave them exhausted. */
+        ringiter *it = self->iterators;
+
+        unlink_from_ring(&it->here);
+        unlink_from_ring(&it->end);
+        it->here.r_next = it->here.r_prev = NULL;
+        self->iterators = it->next_iterator;
+    }
+
+    if (self->ring_insert != &self->ring_home)
+    {
+        unlink_from_ring(&self->ring_segment);
+        self->ring_insert = &self->ring_home;
+    }
+    if (self->ring_cursor.r_next)
+    {
+        unlink_from_ring(&self->ring_cursor);
+        self->ring_cursor.r_next = self->ring_cursor.r_prev = NULL;
+    }
+    Py_CLEAR(self->history_probation);
+    Py_CLEAR(self->history_protected);
+    Py_CLEAR(self->sweeper);
+    Py_CLEAR(self->memory_controller);
+    Py_CLEAR(self->size_estimators);
+    self->loaded = NULL;
+    Py_CLEAR(self->state_store);
+    Py_CLEAR(self->trace_hook);
+    Py_CLEAR(self->activation_histogram);
+    Py_CLEAR(self->priorities);
+
     while (self->ring_home.r_next != &self->ring_home)
     {
         CPersistentRing *here = self->ring_home.r_next;
@@ -957,7 +4314,7 @@ cc_clear(ccobject *self)
         if (o->cache)
         {
             Py_INCREF(o); /* account for uncounted reference */
-            if (PyDict_DelItem(self->data, o->oid) < 0)
+            if (data_del(self, o->oid) < 0)
                 return -1;
         }
         o->cache = NULL;
@@ -977,6 +4334,10 @@ cc_clear(ccobject *self)
         if (PyDict_SetItem(self->data, k, Py_None) < 0)
             return -1;
     }
+    /* The index doesn't release its references when it is freed. */
+    PyMem_Free(self->index);
+    self->index = NULL;
+    self->index_used = 0;
     Py_XDECREF(self->data);
     self->data = NULL;
     self->jar = NULL;
@@ -1008,6 +4369,7 @@ cc_traverse(ccobject *self, visitproc visit, void *arg)
     }
 
     VISIT(self->jar);
+    VISIT(self->class_index);
 
     here = self->ring_home.r_next;
 
@@ -1019,10 +4381,22 @@ cc_traverse(ccobject *self, visitproc visit, void *arg)
 
     while (here != &self->ring_home)
     {
-        cPersistentObject *o = OBJECT_FROM_RING(self, here);
-        VISIT(o);
+        if (!IS_CACHE_MARKER(self, here))
+        {
+            cPersistentObject *o = OBJECT_FROM_RING(self, here);
+            VISIT(o);
+        }
         here = here->r_next;
     }
+    VISIT(self->history_probation);
+    VISIT(self->history_protected);
+    VISIT(self->sweeper);
+    VISIT(self->memory_controller);
+    VISIT(self->size_estimators);
+    VISIT(self->state_store);
+    VISIT(self->trace_hook);
+    VISIT(self->activation_histogram);
+    VISIT(self->priorities);
 #undef VISIT
 
     return 0;
@@ -1031,7 +4405,7 @@ cc_traverse(ccobject *self, visitproc visit, void *arg)
 static Py_ssize_t
 cc_length(ccobject *self)
 {
-    return PyObject_Length(self->data);
+    return data_len(self);
 }
 
 static PyObject *
@@ -1039,12 +4413,15 @@ cc_subscript(ccobject *self, PyObject *key)
 {
     PyObject *r;
 
-    r = PyDict_GetItem(self->data, key);
+    r = data_get(self, key);
     if (r == NULL)
     {
+        self->stat_misses++;
         PyErr_SetObject(PyExc_KeyError, key);
         return NULL;
     }
+    self->stat_hits++;
+    note_referent(self, r);
     Py_INCREF(r);
 
     return r;
@@ -1117,7 +4494,7 @@ cc_add_item(ccobject *self, PyObject *key, PyObject *v)
     }
     Py_DECREF(jar);
 
-    object_again = PyDict_GetItem(self->data, key);
+    object_again = data_get(self, key);
     if (object_again)
     {
         if (object_again != v)
@@ -1135,9 +4512,8 @@ cc_add_item(ccobject *self, PyObject *key, PyObject *v)
 
     if (PyType_Check(v))
     {
-        if (PyDict_SetItem(self->data, key, v) < 0)
+        if (data_set(self, key, v) < 0)
             return -1;
-        PyObject_GC_UnTrack((void *)self->data);
         self->klass_count++;
         return 0;
     }
@@ -1160,10 +4536,9 @@ cc_add_item(ccobject *self, PyObject *key, PyObject *v)
         */
     }
 
-    if (PyDict_SetItem(self->data, key, v) < 0)
+    if (data_set(self, key, v) < 0)
         return -1;
     /* the dict should have a borrowed reference */
-    PyObject_GC_UnTrack((void *)self->data);
     Py_DECREF(v);
 
     p = (cPersistentObject *)v;
@@ -1174,7 +4549,8 @@ cc_add_item(ccobject *self, PyObject *key, PyObject *v)
         /* insert this non-ghost object into the ring just
             behind the home position. */
         self->non_ghost_count++;
-        ring_add(&self->ring_home, &p->ring);
+        CACHE_ACCOUNT(self, p, 1, 0);
+        ring_add(self->ring_insert, &p->ring);
         /* this list should have a new reference to the object */
         Py_INCREF(v);
     }
@@ -1187,8 +4563,11 @@ cc_del_item(ccobject *self, PyObject *key)
     PyObject *v;
     cPersistentObject *p;
 
+    /* The object may be in the access buffer. */
+    flush_accesses(self);
+
     /* unlink this item from the ring */
-    v = PyDict_GetItem(self->data, key);
+    v = data_get(self, key);
     if (v == NULL)
     {
         PyErr_SetObject(PyExc_KeyError, key);
@@ -1205,6 +4584,7 @@ cc_del_item(ccobject *self, PyObject *key)
         if (p->state >= 0)
         {
             self->non_ghost_count--;
+            CACHE_ACCOUNT(self, p, -1, 0);
             ring_del(&p->ring);
             /* The DelItem below will account for the reference
                 held by the list. */
@@ -1223,7 +4603,7 @@ cc_del_item(ccobject *self, PyObject *key)
         p->cache = NULL;
     }
 
-    if (PyDict_DelItem(self->data, key) < 0)
+    if (data_del(self, key) < 0)
     {
         PyErr_SetString(PyExc_RuntimeError,
                         "unexpectedly couldn't remove key in cc_ass_sub");
@@ -1259,12 +4639,40 @@ static PyMappingMethods cc_as_mapping =
 static PyObject *
 cc_cache_data(ccobject *self, void *context)
 {
-    return PyDict_Copy(self->data);
+    PyObject *d, *k, *v;
+    Py_ssize_t p = 0;
+
+    d = PyDict_Copy(self->data);
+    if (d == NULL)
+        return NULL;
+    while (data_next(self, &p, &k, &v))
+        if (PyDict_SetItem(d, k, v) < 0)
+        {
+            Py_DECREF(d);
+            return NULL;
+        }
+    return d;
+}
+
+static PyObject *
+cc_eviction_policy(ccobject *self, void *context)
+{
+    return PyUnicode_FromString(policy_names[self->policy]);
+}
+
+static PyObject *
+cc_exact_sizes(ccobject *self, void *context)
+{
+    return PyBool_FromLong(self->exact_sizes);
 }
 
 static PyGetSetDef cc_getsets[] =
 {
     {"cache_data", (getter)cc_cache_data},
+    {"cache_ghost_count", (getter)cc_ghost_count},
+    {"access_buffer_size", (getter)cc_access_buffer_size},
+    {"eviction_policy", (getter)cc_eviction_policy},
+    {"exact_sizes", (getter)cc_exact_sizes},
     {NULL}
 };
 
@@ -1280,6 +4688,9 @@ static PyMemberDef cc_members[] =
     {"cache_non_ghost_count", T_INT, offsetof(ccobject, non_ghost_count),
       READONLY},
     {"cache_klass_count", T_INT, offsetof(ccobject, klass_count), READONLY},
+    {"jar", T_OBJECT, offsetof(ccobject, jar), READONLY},
+    {"state_store", T_OBJECT, offsetof(ccobject, state_store)},
+    {"trace_hook", T_OBJECT, offsetof(ccobject, trace_hook), READONLY},
     {NULL}
 };
 
@@ -1358,6 +4769,10 @@ module_init(void)
     {
         return NULL;
     }
+    if (PyType_Ready(&RingIterType) < 0)
+        return NULL;
+    if (PyType_Ready(&ItemsIterType) < 0)
+        return NULL;
 
     module = PyModule_Create(&moduledef);
 
@@ -1372,6 +4787,9 @@ module_init(void)
     py__p_deactivate = INTERN("_p_deactivate");
     if (!py__p_deactivate)
         return NULL;
+    py__p_invalidate = INTERN("_p_invalidate");
+    if (!py__p_invalidate)
+        return NULL;
     py__p_jar = INTERN("_p_jar");
     if (!py__p_jar)
         return NULL;
@@ -1379,6 +4797,16 @@ module_init(void)
     if (!py__p_oid)
         return NULL;
 
+    {
+        PyObject *collections = PyImport_ImportModule("collections");
+        if (!collections)
+            return NULL;
+        OrderedDict = PyObject_GetAttrString(collections, "OrderedDict");
+        Py_DECREF(collections);
+        if (!OrderedDict)
+            return NULL;
+    }
+
     if (PyModule_AddStringConstant(module, "cache_variant", "stiff/c") < 0)
         return NULL;
 
@@ -465,13 +465,36 @@ class IPickleCache(Interface):
         o Only includes items in the ring (no ghosts or p-classes).
         """
 
+    def iter_items(limit=None):
+        """ -> an iterator of tuples (oid, value) for cached objects.
+
+        o Like 'items', but produces at most 'limit' tuples, if given.
+
+        o As when iterating over a dict, objects must not be added to
+          or removed from the cache while the iteration is in progress.
+        """
+
+    def iter_lru_items(limit=None):
+        """ -> an iterator of tuples (oid, value) for cached objects.
+
+        o Like 'lru_items', but produces the tuples one at a time, at
+          most 'limit' of them, if given.
+
+        o Objects may be loaded, accessed and ghostified while the
+          iteration is in progress. It ends with the object that was
+          most recently used when it started (objects accessed in the
+          meantime aren't produced again).
+
+        o Raises ValueError if used during garbage collection.
+        """
+
     def klass_items():
         """-> a sequence of tuples (oid, value) for cached p-classes.
 
         o Only includes persistent classes.
         """
 
-    def incrgc():
+    def incrgc(*, max_seconds=None, max_objects=None):
         """ Perform an incremental garbage collection sweep.
 
         o Reduce number of non-ghosts to 'cache_size', if possible.
@@ -481,14 +504,23 @@ class IPickleCache(Interface):
         o Skip dirty or sticky objects.
 
         o Quit once we get down to 'cache_size'.
+
+        o Also quit after 'max_seconds' seconds or after examining
+          'max_objects' objects, if given.  The next call to 'incrgc',
+          'full_sweep' or 'minimize' then resumes from the object the
+          sweep stopped at, rather than from the least recently used
+          object.
         """
 
-    def full_sweep():
+    def full_sweep(*, max_seconds=None, max_objects=None):
         """ Perform a full garbage collection sweep.
 
         o Reduce number of non-ghosts to 0, if possible.
 
         o Ghostify all non-sticky / non-changed objecs.
+
+        o 'max_seconds' and 'max_objects' limit the sweep as for
+          'incrgc'.
         """
 
     def minimize():
@@ -512,6 +544,16 @@ class IPickleCache(Interface):
         If 'oid' is already in the cache, raise.
         """
 
+    def new_ghost_many(pairs):
+        """ Add each object of the (oid, object) pairs to the cache as
+        'new_ghost' does.
+
+        Check all of them before adding any, so that if one of them
+        would raise, none is added.  Giving the same oid or object
+        twice raises ValueError.  If adding one still fails, remove
+        the ones already added.
+        """
+
     def invalidate(to_invalidate):
         """ Invalidate the indicated objects.
 
@@ -524,6 +566,31 @@ class IPickleCache(Interface):
 
         o For all other OIDs, ghostify the corrsponding object and
             remove it from the ring.
+
+        Return a dictionary with the number of objects found and ghostified
+        ('ghosted'), of OIDs not in the cache ('missing') and of p-classes
+        found ('classes').
+
+        o If there is a 'state_store', the OIDs are invalidated there,
+            too.
+        """
+
+    def invalidate_classes(classes):
+        """Invalidate the non-ghost objects that are instances of 'classes'.
+
+        o 'classes' is an iterable of classes; instances of their subclasses
+            are invalidated, too.
+
+        o Return the number of objects invalidated.
+        """
+
+    def invalidate_where(predicate):
+        """Invalidate the non-ghost objects for which 'predicate' is true.
+
+        o 'predicate' is called with each object in the ring, from the least
+            recently used to the most recently used.
+
+        o Return the number of objects invalidated.
         """
 
     def debug_info():
@@ -532,10 +599,318 @@ class IPickleCache(Interface):
         o Return a sequence of tuples, (oid, refcount, typename, state).
         """
 
+    def cache_stats(reset=False):
+        """Return a dictionary of counters describing the cache's usage.
+
+        The counters are:
+
+        o 'hits', 'misses':  lookups with 'get' or '__getitem__' that did
+            and did not find the oid.
+
+        o 'accesses':  accesses to non-ghost objects in the cache (each
+            one marks the object as most recently used).
+
+        o 'new_ghosts':  objects added with 'new_ghost'.
+
+        o 'incrgc_calls':  calls to 'incrgc'.
+
+        o 'evictions':  objects ghostified by 'incrgc', 'full_sweep' and
+            'minimize'.
+
+        o 'invalidations':  cached objects passed to 'invalidate'.
+
+        o 'bytes_reclaimed':  the estimated size of the evicted objects.
+
+        o 'ghost_limit_exceeded':  calls to 'incrgc' that found more
+            ghosts in the cache than the limit set with 'set_ghost_limit'.
+
+        o 'ghost_releases':  objects ghostified to release ghosts.
+
+        If 'reset' is true, set the counters back to zero after reading
+        them.
+        """
+
+    def class_stats():
+        """Return a dictionary describing the non-ghost objects by class.
+
+        It maps each class to a tuple of the number of non-ghost objects
+        of that class in the cache and their total estimated size.
+        """
+
+    def sample(k, ghosts=False):
+        """Return a list of up to 'k' objects chosen at random.
+
+        Each non-ghost object in the cache (or, if 'ghosts' is true,
+        each object in the cache) is equally likely to be chosen, and
+        none is chosen twice. Unlike 'debug_info', this doesn't look at
+        the objects' references, so it is cheap enough to call
+        regularly.
+        """
+
+    def estimate_composition(k):
+        """Estimate 'class_stats' from a 'sample' of 'k' objects.
+
+        Returns a dictionary like that of 'class_stats', with the number
+        of objects of each class and their estimated size in the sample
+        scaled up to the number of non-ghost objects in the cache.
+        Classes with no object in the sample are missing. If 'k' is at
+        least the number of non-ghost objects, the result is exact.
+        """
+
+    def set_class_quota(klass, max_count):
+        """Limit the number of non-ghost objects of the class 'klass'.
+
+        'incrgc' first ghostifies the least recently used objects of the
+        classes over their quotas, before it applies the eviction policy.
+        If 'max_count' is None, remove the quota of the class.
+        """
+
+    def class_quotas():
+        """Return a dictionary mapping classes to their quotas.
+        """
+
+    def pin(oid):
+        """Keep the object with the given oid out of garbage collection.
+
+        o 'incrgc', 'full_sweep' and 'minimize' (and class quotas and
+            the ghost limit) never ghostify a pinned object. Invalidating
+            it and its own '_p_deactivate' and '_p_invalidate' still do.
+
+        o Unlike '_p_sticky', the pin stays until 'unpin' is called, also
+            while the object is a ghost or not in the cache at all.
+            Pinning replaces a priority given with 'set_priority'.
+        """
+
+    def unpin(oid):
+        """Let garbage collection ghostify the object again.
+
+        Does nothing if the oid isn't pinned.
+        """
+
+    def set_priority(oid, priority):
+        """Give the object with the given oid an eviction priority.
+
+        o Objects have priority 0 unless they are given another. 'incrgc'
+            applies the eviction policy to those with priority 0 only.
+            If that doesn't get the cache down to its target size, it
+            ghostifies the least recently used objects with the lowest
+            priority above 0, then those with the next priority and so
+            on. 'full_sweep' and 'minimize' ignore priorities.
+
+        o Like pins, priorities are kept for oids, not objects. Setting a
+            priority replaces a pin, and a priority of 0 removes it.
+        """
+
+    def priorities():
+        """Return a dictionary mapping oids to their priorities.
+
+        Only oids given a priority with 'set_priority' (or pinned, with
+        a priority of None) are included.
+        """
+
+    def ghost_stats():
+        """Return a dictionary describing the ghosts by class.
+
+        It maps each class to a tuple of the number of ghosts of that
+        class in the cache and their total size in memory.
+        """
+
+    def set_ghost_limit(limit, release=True):
+        """Limit the number of ghosts in the cache to 'limit'.
+
+        Ghosts stay in the cache as long as something refers to them,
+        typically the non-ghost objects they were loaded for. 'incrgc'
+        counts the calls finding more than 'limit' ghosts in the cache
+        (see 'cache_stats'). If 'release' is true, it also ghostifies the
+        least recently used up-to-date objects referring to ghosts,
+        before it applies the eviction policy, until the number of
+        ghosts is within the limit. If 'limit' is None, remove the limit.
+
+        Objects refer to the ghosts they looked up (with 'get' or
+        '__getitem__') or created (with 'new_ghost' or 'new_ghost_many')
+        while their state was loaded, as the jar does for the
+        persistent references in the state, until they are ghosts
+        again.
+        """
+
+    def set_access_buffer(size):
+        """Record up to 'size' accesses before updating the ring.
+
+        o Normally, accessing an object moves it to the most recently
+            used end of the ring right away. With a buffer, the cache
+            only records the access, and moves the objects in batches,
+            in the order they were accessed: when the buffer is full,
+            before 'incrgc', 'full_sweep' and 'minimize' and before
+            listing the ring with 'lru_items' or 'iter_lru_items'.
+
+        o A 'size' of 0 removes the buffer. The buffer has no effect
+            with the 'clock' eviction policy, which only marks accessed
+            objects anyway.
+        """
+
+    def set_trace_hook(hook):
+        """Call 'hook' for events of the objects in the cache.
+
+        o It is called as ``hook(event, oid, klass, duration, cause)``
+            when an object is activated ('activate', 'duration' being
+            the seconds it took to load it), made a ghost ('ghostify')
+            or registered with its data manager after its first change
+            ('register'; 'duration' is None for the last two events).
+
+        o 'cause' is what the cache was doing to the object: 'evict'
+            (sweeps, like 'incrgc'), 'invalidate' ('invalidate' and
+            friends) or 'reify'. It is None for everything else, like
+            the object's own '_p_deactivate' and '_p_invalidate' or
+            attribute access.
+
+        o Exceptions raised by 'hook' are reported as unraisable and
+            otherwise ignored. A 'hook' of None removes it; with no hook,
+            tracing costs next to nothing.
+        """
+
+    def set_activation_histogram(enabled):
+        """Start or stop counting how long activating objects takes.
+
+        o While 'enabled' is true, the cache measures the time the data
+            manager's 'setstate' takes to load each of its objects, and
+            counts it in a histogram for the object's class (see
+            'activation_histogram'). Objects loaded together by 'reify'
+            are each counted with their share of the time.
+
+        o Stopping discards the counts.
+        """
+
+    def activation_histogram(reset=False):
+        """Return the counts of activations and their durations.
+
+        o The result is a dict with the total number of activations
+            counted ('activations') and a dict of the classes counted
+            ('classes'). For each class, this has a dict with the number
+            of activations of its objects ('activations') and a dict
+            ('buckets') mapping upper bounds of durations in seconds to
+            the number of activations that took longer than the next
+            smaller bound but no longer than this one. The bounds are
+            powers of two microseconds, up to about 17 seconds, and
+            infinity; only bounds with activations are included.
+
+        o If 'reset' is true, the counts are set back to zero.
+        """
+
     def update_object_size_estimation(oid, new_size):
         """Update the cache's size estimation for 'oid', if known to the cache.
         """
 
+    def set_size_estimator(estimator, klass=None):
+        """Estimate the size of objects of the class 'klass' when loaded.
+
+        o When an object of the class is loaded, 'estimator' is called with
+            it and returns its estimated size in bytes, or None to keep
+            the estimate of the jar. The cache updates its size estimation
+            and the object's '_p_estimated_size' accordingly. Exceptions
+            are reported as unraisable (see 'sys.unraisablehook') and the
+            object keeps the estimate of the jar.
+
+        o If 'klass' is None, use 'estimator' for all classes without an
+            estimator of their own.
+
+        o If 'estimator' is None, remove the estimator for 'klass'.
+
+        o 'persistent.picklecache.estimate_state_size' is an estimator
+            adding up the sizes of the object and of its state.
+        """
+
+    def start_sweeper(high_water=None, low_water=None,
+                      high_water_bytes=None, low_water_bytes=None,
+                      interval=1.0, max_seconds=0.01):
+        """Start a daemon thread that keeps the cache from growing too large.
+
+        o Every 'interval' seconds, if there are more than 'high_water'
+          non-ghosts or their estimated size is more than
+          'high_water_bytes', ghostify objects as 'incrgc' does until
+          they are down to 'low_water' and 'low_water_bytes' (which
+          default to 'cache_size' and 'cache_size_bytes').
+
+        o Do this in incremental sweeps of at most 'max_seconds' each.
+
+        o At least one of the high-water marks is required.
+
+        o Stop the thread already running, if any.
+
+        o Return the :class:`persistent.picklecache.CacheSweeper`.
+
+        The thread keeps the cache alive until 'stop_sweeper' is called.
+
+        The C implementation's thread ghostifies the objects itself,
+        which relies on the GIL: raise RuntimeError on free-threaded
+        builds of Python running without it. The Python implementation's
+        thread leaves that to the thread using the cache, the next time
+        it loads an object.
+        """
+
+    def stop_sweeper():
+        """Stop the thread started by 'start_sweeper', if any.
+        """
+
+    def enable_memory_controller(min_bytes=1 << 20, max_bytes=None,
+                                 low_watermark=0.7, high_watermark=0.85,
+                                 step=0.1, interval=1.0):
+        """Adjust 'cache_size_bytes' to the memory available to the process.
+
+        o Before each 'incrgc', compare the memory used by the process's
+          cgroup (or the process itself, if no cgroup limits it) with
+          the cgroup's memory limit (or the system's memory), at most
+          every 'interval' seconds.
+
+        o Above 'high_watermark' of the limit, lower 'cache_size_bytes'
+          to ('1 - step') times the current 'total_estimated_size', so
+          that 'incrgc' ghostifies objects.  Below 'low_watermark', if
+          the cache is nearly full, raise it by a factor of ('1 + step').
+
+        o Keep it between 'min_bytes' and 'max_bytes' (if given).
+
+        o Replace the controller already enabled, if any.
+
+        o Return the
+          :class:`persistent.picklecache.MemoryPressureController`.
+        """
+
+    def disable_memory_controller():
+        """Stop adjusting 'cache_size_bytes'.
+
+        o Restore the value it had when 'enable_memory_controller' was
+          called.
+        """
+
+    def snapshot_hot(path, limit=None):
+        """Write the oids of the most recently used non-ghosts to a file.
+
+        o Write at most 'limit' oids, most recently used first.
+
+        o The file contains nothing but the 8-byte oids, packed one
+          after the other, so that it can be read (or memory-mapped)
+          cheaply.  Oids of other sizes are skipped.
+
+        o Return the number of oids written.
+        """
+
+    def prewarm(path, limit=None, factory=None):
+        """Load the objects whose oids 'snapshot_hot' wrote to 'path'.
+
+        o Load at most 'limit' objects.
+
+        o For oids not already in the cache, call 'factory(oid)' to get
+          a new persistent object, and add it as a ghost with
+          'new_ghost'.  If 'factory' returns None, skip the oid.
+          Without a 'factory', use the jar's 'get' method (as ZODB
+          Connections have) to add the ghost, or skip the oid if the jar
+          has none.
+
+        o Activate the ghosts, so that the objects end up in the cache
+          in the order in which they were written.
+
+        o Return the number of objects activated.
+        """
+
     cache_size = Attribute('Target size of the cache')
     cache_drain_resistance = Attribute('Factor for draining cache below '
                                        'target size')
@@ -543,7 +918,60 @@ class IPickleCache(Interface):
                                       '(XXX how is it different from '
                                       'ringlen?')
     cache_data = Attribute("Property:  copy of our 'data' dict")
+    cache_ghost_count = Attribute("Property: number of ghosts in the cache")
     cache_klass_count = Attribute("Property: len of 'persistent_classes'")
+    eviction_policy = Attribute(
+        """The name of the policy used to choose the objects to ghostify.
+
+        One of ``'lru'`` (the default; least recently used objects
+        first), ``'slru'`` (segmented LRU: objects accessed only once
+        since they were loaded are ghostified before those accessed
+        repeatedly), ``'2q'`` (like ``'slru'``, also remembering
+        recently ghostified objects so that they are treated as
+        accessed repeatedly when they are loaded again soon),
+        ``'arc'`` (like ``'2q'``, adapting the size of the segments to
+        the workload) or ``'clock'`` (an approximation of ``'lru'``:
+        accessing an object only marks it as referenced, and
+        :meth:`incrgc` moves marked objects to the most recently used
+        end instead of ghostifying them, so that read-heavy code doesn't
+        reorder the cache on every attribute access). Set by passing
+        the ``eviction_policy`` keyword argument to the constructor; any
+        other value raises :exc:`ValueError`.
+
+        The policies only take effect in :meth:`incrgc`;
+        :meth:`full_sweep` ghostifies everything it can regardless.
+        """)
+    exact_sizes = Attribute(
+        """Whether the cache counts exact object sizes.
+
+        Objects record their ``_p_estimated_size`` in 64-byte blocks, up
+        to about 1GB. If the ``exact_sizes`` keyword argument to the
+        constructor is true, the cache remembers the sizes given to
+        :meth:`update_object_size_estimation` (or returned by size
+        estimators) as they are, and uses them for
+        ``total_estimated_size``, ``cache_size_bytes`` and
+        :meth:`class_stats`. Setting ``_p_estimated_size`` to a
+        different size without telling the cache makes it go back to
+        the rounded size. (The C implementation only keeps exact sizes
+        for objects with 8-byte oids.)
+        """)
+    access_buffer_size = Attribute(
+        """The size of the access buffer (see :meth:`set_access_buffer`),
+        or 0 if there is none.
+        """)
+    trace_hook = Attribute(
+        """The hook set with :meth:`set_trace_hook`, or None.
+        """)
+    state_store = Attribute(
+        """A store of pickled states shared by several caches, or None.
+
+        Usually a :class:`persistent.picklecache.PickleStateStore`, set
+        with the ``state_store`` keyword argument to the constructor.
+        The cache itself doesn't load states from it; a data manager
+        can look there before going to the storage, and put the states
+        it loads there. :meth:`invalidate` passes the OIDs on to the
+        store's ``invalidate`` method before invalidating the objects.
+        """)
 
 
 class IExtendedPickleCache(IPickleCache):
@@ -567,6 +995,15 @@ class IExtendedPickleCache(IPickleCache):
         o If any OID is present but not in GHOST state, skip it.
 
         o Raise KeyErrory if any OID is not present.
+
+        If the jar has a ``setstate_many(objects)`` method, it is
+        called once with the list of all the ghosts instead of calling
+        ``_p_activate`` on each of them. While it runs, the objects are
+        already in the ring and in the CHANGED state, as they are during
+        ``jar.setstate(obj)``; afterwards they are up-to-date. If it
+        raises, all of them are ghosts again.
+
+        The C implementation provides this method, too.
         """
 
     def mru(oid):
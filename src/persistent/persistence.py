@@ -13,7 +13,10 @@
 ##############################################################################
 import copyreg
 import struct
+import sys
 from sys import intern
+from time import perf_counter
+from types import SimpleNamespace
 
 from zope.interface import implementer
 
@@ -35,6 +38,9 @@ _INITIAL_SERIAL = _ZERO
 # Bitwise flags
 _CHANGED = 0x0001
 _STICKY = 0x0002
+# Set by a PickleCachePy using the 'clock' eviction policy when the
+# object is accessed; its sweeps clear it again.
+_REFERENCED = 0x0004
 
 _OGA = object.__getattribute__
 _OSA = object.__setattr__
@@ -77,6 +83,27 @@ def oid_repr(oid):
     return _repr
 
 
+def _trace(obj, cache, event, duration=None):
+    # Call the trace hook of the cache holding the object, if it has
+    # one, like the C implementation does (see
+    # PickleCache.set_trace_hook). Errors of the hook are reported as
+    # unraisable.
+    hook = getattr(cache, '_trace_hook', None)
+    if hook is None:
+        return
+    oid = _OGA(obj, '_Persistent__oid')
+    # Not cache.get(), which would count a hit.
+    if cache.data.get(oid) is not obj:
+        return
+    try:
+        hook(event, oid, type(obj), duration,
+             getattr(cache, '_trace_cause', None))
+    except Exception as e:
+        sys.unraisablehook(SimpleNamespace(
+            exc_type=type(e), exc_value=e, exc_traceback=e.__traceback__,
+            err_msg=None, object=hook))
+
+
 @use_c_impl
 @implementer(interfaces.IPersistent)
 class Persistent:
@@ -410,6 +437,23 @@ class Persistent:
             # The main point of this is to prevent changes made during
             # setstate from registering the object with the jar.
             _OSA(self, '_Persistent__flags', interfaces.CHANGED)
+            cache = getattr(jar, '_cache', None)
+            if getattr(cache, '_pending_sweep', None) is not None:
+                # Do the sweep the cache's sweeper asked for now that
+                # it can't ghostify us (see CacheSweeper).
+                cache._run_pending_sweep()
+            # Time loading the state if the cache wants to know.
+            counting = getattr(cache, '_activation_histogram',
+                               None) is not None
+            timing = counting or getattr(cache, '_trace_hook',
+                                         None) is not None
+            if timing:
+                start = perf_counter()
+            # Let the cache see what we look up while loading.
+            start_loading = getattr(cache, '_start_loading', None)
+            if start_loading is not None:
+                was_loading = start_loading(self)
+                cache._loading = self
             try:
                 jar.setstate(self)
             except BaseException:
@@ -420,6 +464,18 @@ class Persistent:
                 # of setstate did, mark ourself as up-to-date. The
                 # C implementation unconditionally does this.
                 _OSA(self, '_Persistent__flags', 0)  # up-to-date
+                # Let the cache estimate our size, if it wants to.
+                loaded = getattr(cache, '_loaded', None)
+                if loaded is not None:
+                    loaded(self)
+                if timing:
+                    duration = perf_counter() - start
+                    if counting:
+                        cache._record_activation(self, duration)
+                    _trace(self, cache, 'activate', duration)
+            finally:
+                if start_loading is not None:
+                    cache._loading = was_loading
 
     # In the C implementation, _p_invalidate winds up calling
     # _p_deactivate. There are ZODB tests that depend on this;
@@ -430,7 +486,7 @@ class Persistent:
         """ See IPersistent.
         """
         flags = _OGA(self, '_Persistent__flags')
-        if flags is not None and not flags:
+        if flags is not None and not flags & ~_REFERENCED:
             self._p_invalidate_deactivate_helper()
 
     def _p_invalidate(self):
@@ -446,7 +502,8 @@ class Persistent:
         if jar is None:
             return
 
-        if _OGA(self, '_Persistent__flags') is not None:
+        was_ghost = _OGA(self, '_Persistent__flags') is None
+        if not was_ghost:
             _OSA(self, '_Persistent__flags', None)
 
         if clear:
@@ -478,10 +535,16 @@ class Persistent:
         except AttributeError:
             pass
         else:
-            cache.update_object_size_estimation(
-                _OGA(self, '_Persistent__oid'), -1)
+            if not was_ghost:
+                _trace(self, cache, 'ghostify')
+            oid = _OGA(self, '_Persistent__oid')
+            cache.update_object_size_estimation(oid, -1)
             # See notes in PickleCache.sweep for why we have to do this
             cache._persistent_deactivate_ran = True
+            # As a ghost, we refer to nothing.
+            referrers = getattr(cache, '_ghost_referrers', None)
+            if referrers:
+                referrers.discard(oid)
 
     def _p_getattr(self, name):
         """ See IPersistent.
@@ -524,6 +587,7 @@ class Persistent:
         jar = _OGA(self, '_Persistent__jar')
         if jar is not None and _OGA(self, '_Persistent__oid') is not None:
             jar.register(self)
+            _trace(self, getattr(jar, '_cache', None), 'register')
 
     def _p_set_changed_flag(self, value):
         if value:
@@ -562,6 +626,20 @@ class Persistent:
         flags = oga(self, '_Persistent__flags')
         if flags is None:  # ghost
             return
+        if flags & _REFERENCED:
+            # The cache has already noted an access since its last
+            # sweep.
+            return
+
+        # With an access buffer (see PickleCache.set_access_buffer), just
+        # note the access; the cache deals with it later.
+        cache = getattr(jar, '_cache', None)
+        buffer = getattr(cache, '_access_buffer', None)
+        if buffer is not None:
+            buffer.append(oid)
+            if len(buffer) >= cache._access_buffer_size:
+                cache._drain_accesses()
+            return
 
         # The KeyError arises in ZODB: ZODB.serialize.ObjectWriter
         # can assign a jar and an oid to newly seen persistent objects,
@@ -570,7 +648,7 @@ class Persistent:
         # that at this level, all we can do is catch it.
         # The AttributeError arises in ZODB test cases
         try:
-            jar._cache.mru(oid)
+            cache.mru(oid)
         except (AttributeError, KeyError):
             pass
 
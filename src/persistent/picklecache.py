@@ -12,6 +12,17 @@
 #
 ##############################################################################
 import gc
+import itertools
+import logging
+import math
+import operator
+import os
+import random
+import sys
+import threading
+from collections import OrderedDict
+from time import perf_counter
+from types import SimpleNamespace
 from weakref import WeakValueDictionary
 
 from zope.interface import classImplements
@@ -19,13 +30,17 @@ from zope.interface import implementer
 
 from persistent._compat import PYPY
 from persistent._compat import use_c_impl
+from persistent.interfaces import CHANGED
 from persistent.interfaces import GHOST
 from persistent.interfaces import OID_TYPE
 from persistent.interfaces import UPTODATE
 from persistent.interfaces import IExtendedPickleCache
 from persistent.interfaces import IPickleCache
+from persistent.persistence import _REFERENCED
+from persistent.persistence import Persistent
 from persistent.persistence import PersistentPy
 from persistent.persistence import _estimated_size_in_24_bits
+from persistent.persistence import _trace
 from persistent.ring import Ring
 
 
@@ -44,14 +59,31 @@ def _sweeping_ring(f):
     # serves as a pseudo-lock to not mutate the ring further
     # in other functions
     def locked(self, *args, **kwargs):
+        was_sweeping = self._is_sweeping_ring
         self._is_sweeping_ring = True
         try:
             return f(self, *args, **kwargs)
         finally:
-            self._is_sweeping_ring = False
+            self._is_sweeping_ring = was_sweeping
     return locked
 
 
+def _tracing_cause(cause):
+    # A decorator for functions in the PickleCache that work on
+    # objects for a reason the trace hook should know about; see
+    # set_trace_hook.
+    def decorator(f):
+        def traced(self, *args, **kwargs):
+            before = self._trace_cause
+            self._trace_cause = cause
+            try:
+                return f(self, *args, **kwargs)
+            finally:
+                self._trace_cause = before
+        return traced
+    return decorator
+
+
 class _WeakValueDictionary:
     # Maps from OID -> Persistent object, but only weakly references the
     # Persistent object. This is similar to ``weakref.WeakValueDictionary``,
@@ -114,6 +146,12 @@ class _WeakValueDictionary:
         addr = self._save_addr(key, value)
         self._data[key] = addr
 
+    def update(self, pairs):
+        # Add all the (oid, object) pairs, growing the dict just once.
+        save_addr = self._save_addr
+        self._data.update({key: save_addr(key, value)
+                           for key, value in pairs})
+
     def pop(self, oid):
         return self._from_addr(self._data.pop(oid))
 
@@ -133,6 +171,587 @@ class _WeakValueDictionary:
         return self._from_addr(addr)
 
 
+def _gil_enabled():
+    # Free-threaded builds can run without the GIL; others always have it.
+    is_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_enabled is None or is_enabled()
+
+
+class CacheSweeper:
+    """A daemon thread that keeps a pickle cache from growing too large.
+
+    Every *interval* seconds, if the cache holds more than *high_water*
+    non-ghost objects or more than *high_water_bytes* estimated bytes,
+    the sweeper ghostifies least recently used objects until it is back
+    down to *low_water* objects and *low_water_bytes* bytes (which
+    default to the cache's ``cache_size`` and ``cache_size_bytes``).
+
+    It does so in a series of incremental sweeps that each take at most
+    *max_seconds*, so that it holds up the threads using the cache only
+    briefly. The sweeps use the same guard against overlapping sweeps
+    as the cache's own :meth:`~.IPickleCache.incrgc`; if the cache is
+    already being swept, the sweeper simply tries again later.
+
+    Use :meth:`~.IPickleCache.start_sweeper` rather than creating
+    instances directly. The sweeper keeps the cache alive until it is
+    stopped.
+
+    The C implementation's sweeper ghostifies objects from its own
+    thread, relying on the GIL: only the check for an overlapping sweep
+    is synchronized, not the changes each sweep makes to the cache's
+    ring of objects, which the threads using those objects also make.
+    On free-threaded builds of Python running without the GIL,
+    :meth:`start` therefore raises :exc:`RuntimeError`; call
+    :meth:`~.IPickleCache.incrgc` from the threads using the cache
+    instead.
+
+    The Python implementation can't ghostify objects behind the back of
+    the thread using them even with the GIL, so its sweeper only asks
+    for a sweep. The thread using the cache does it the next time it
+    loads the state of an object.
+    """
+
+    def __init__(self, cache, high_water=None, low_water=None,
+                 high_water_bytes=None, low_water_bytes=None,
+                 interval=1.0, max_seconds=0.01):
+        if high_water is None and high_water_bytes is None:
+            raise ValueError(
+                "At least one of high_water and high_water_bytes is required")
+        if low_water is None:
+            low_water = cache.cache_size
+        if low_water_bytes is None:
+            low_water_bytes = cache.cache_size_bytes
+        if high_water is not None and low_water > high_water:
+            raise ValueError("low_water must not exceed high_water")
+        if (high_water_bytes is not None
+                and low_water_bytes > high_water_bytes):
+            raise ValueError(
+                "low_water_bytes must not exceed high_water_bytes")
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        if max_seconds is not None and max_seconds <= 0:
+            raise ValueError("max_seconds must be positive")
+        self.cache = cache
+        self.high_water = high_water
+        self.low_water = low_water
+        self.high_water_bytes = high_water_bytes
+        self.low_water_bytes = low_water_bytes
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='PickleCache sweeper', daemon=True)
+
+    def sweep(self):
+        """Sweep the cache if it is over one of its high-water marks.
+
+        This is what the thread does every *interval* seconds. Returns
+        the number of objects ghostified.
+        """
+        cache = self.cache
+        over_count = (self.high_water is not None
+                      and cache.cache_non_ghost_count > self.high_water)
+        over_bytes = (self.high_water_bytes is not None
+                      and cache.total_estimated_size > self.high_water_bytes)
+        if not (over_count or over_bytes):
+            return 0
+        # As for the cache's own sweeps, a target of zero for both
+        # means sweeping everything.
+        target = self.low_water if over_count else 0
+        target_bytes = self.low_water_bytes if over_bytes else 0
+        start_count = cache.cache_non_ghost_count
+        while not self._stopped.is_set():
+            before = cache.cache_non_ghost_count
+            cache._sweep(target, target_bytes, max_seconds=self.max_seconds)
+            count = cache.cache_non_ghost_count
+            if ((target or target_bytes)
+                    and (not target or count <= target)
+                    and (not target_bytes
+                         or cache.total_estimated_size <= target_bytes)):
+                break
+            if count == 0 or count >= before:
+                # Done, or nothing more we can do for now.
+                break
+        return start_count - cache.cache_non_ghost_count
+
+    def _run(self):
+        request_sweep = getattr(self.cache, '_request_sweep', None)
+        while not self._stopped.wait(self.interval):
+            if request_sweep is not None:
+                request_sweep(self.sweep)
+                continue
+            try:
+                self.sweep()
+            except Exception:  # pragma: no cover
+                logging.getLogger(__name__).exception(
+                    "Error sweeping %r", self.cache)
+
+    def start(self):
+        """Start the thread.
+
+        Raises :exc:`RuntimeError` if the sweeps would have to run in
+        the thread while the GIL is disabled.
+        """
+        if (getattr(self.cache, '_request_sweep', None) is None
+                and not _gil_enabled()):
+            raise RuntimeError(
+                "The cache sweeper cannot run without the GIL: the cache's"
+                " ring is not synchronized with the threads using its"
+                " objects")
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the thread, waiting up to *timeout* seconds for it."""
+        self._stopped.set()
+        if (self._thread.is_alive()
+                and self._thread is not threading.current_thread()):
+            self._thread.join(timeout)
+
+    @property
+    def running(self):
+        """Whether the thread is still running."""
+        return self._thread.is_alive()
+
+
+# cgroup v1 reports "no limit" as a huge number (close to 2**63).
+_CGROUP_V1_NO_LIMIT = 1 << 60
+
+
+def _read_int(path):
+    # The first field of the file as an int, or None if there is no
+    # such file or no number in it.
+    try:
+        with open(path) as f:
+            return int(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class MemoryPressureController:
+    """Adjusts a pickle cache's ``cache_size_bytes`` to the memory
+    available to the process.
+
+    Every :meth:`~.IPickleCache.incrgc` of the cache calls
+    :meth:`adjust`, which (at most every *interval* seconds) reads
+    the memory used by the process's cgroup and the cgroup's limit. If
+    more than *high_watermark* of the limit is in use, it lowers the
+    target by *step* of the cache's current ``total_estimated_size``,
+    so that the sweep ghostifies objects. If less than *low_watermark*
+    is in use and the cache is nearly up to its target, it raises the
+    target by *step*. The target stays between
+    *min_bytes* and *max_bytes* (if given). A target of zero (no limit
+    on the estimated size) is only replaced under pressure.
+
+    Outside of a cgroup with a limit, the controller uses the resident
+    set size of the process instead of the memory used by the cgroup,
+    and the size of the system's memory instead of the limit.
+
+    Use :meth:`~.IPickleCache.enable_memory_controller` rather than
+    creating instances directly.
+    """
+
+    def __init__(self, cache, min_bytes=1 << 20, max_bytes=None,
+                 low_watermark=0.7, high_watermark=0.85, step=0.1,
+                 interval=1.0, proc_root='/proc',
+                 cgroup_root='/sys/fs/cgroup'):
+        if min_bytes <= 0:
+            raise ValueError("min_bytes must be positive")
+        if max_bytes is not None and max_bytes < min_bytes:
+            raise ValueError("max_bytes must not be less than min_bytes")
+        if not 0 < low_watermark <= high_watermark < 1:
+            raise ValueError(
+                "The watermarks must satisfy"
+                " 0 < low_watermark <= high_watermark < 1")
+        if not 0 < step < 1:
+            raise ValueError("step must be between 0 and 1")
+        if interval < 0:
+            raise ValueError("interval must not be negative")
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.step = step
+        self.interval = interval
+        self.proc_root = proc_root
+        self.cgroup_root = cgroup_root
+        # What to restore when the controller is disabled.
+        self.initial_bytes = cache.cache_size_bytes
+        # The last readings, for monitoring.
+        self.usage = None
+        self.limit = None
+        self._next_check = 0
+
+    def read_memory(self):
+        """Return the memory in use and the limit, in bytes.
+
+        Either may be None if it cannot be determined.
+        """
+        cgroup = self.cgroup_root
+        # cgroup v2, then v1.
+        limit = _read_int(os.path.join(cgroup, 'memory.max'))
+        usage = _read_int(os.path.join(cgroup, 'memory.current'))
+        if limit is None:
+            limit = _read_int(
+                os.path.join(cgroup, 'memory', 'memory.limit_in_bytes'))
+            if limit is not None and limit >= _CGROUP_V1_NO_LIMIT:
+                limit = None
+            if usage is None:
+                usage = _read_int(
+                    os.path.join(cgroup, 'memory', 'memory.usage_in_bytes'))
+        if limit is None:
+            # Not limited by a cgroup; what matters is us and the
+            # machine.
+            usage = None
+            limit = self._read_meminfo('MemTotal')
+        if usage is None:
+            pages = self._read_statm_resident()
+            if pages is not None:
+                usage = pages * os.sysconf('SC_PAGE_SIZE')
+        return usage, limit
+
+    def _read_meminfo(self, field):
+        prefix = field + ':'
+        try:
+            with open(os.path.join(self.proc_root, 'meminfo')) as f:
+                for line in f:
+                    if line.startswith(prefix):
+                        return int(line.split()[1]) * 1024
+        except (OSError, IndexError, ValueError):
+            pass
+        return None
+
+    def _read_statm_resident(self):
+        try:
+            with open(os.path.join(self.proc_root, 'self', 'statm')) as f:
+                return int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def adjust(self, cache):
+        """Adjust the cache's ``cache_size_bytes``, returning it."""
+        target = cache.cache_size_bytes
+        now = perf_counter()
+        if now < self._next_check:
+            return target
+        self._next_check = now + self.interval
+
+        self.usage, self.limit = usage, limit = self.read_memory()
+        if not usage or not limit:
+            return target
+        pressure = usage / limit
+        if pressure > self.high_watermark:
+            size = cache.total_estimated_size
+            if target:
+                size = min(size, target)
+            target = max(self.min_bytes, int(size * (1 - self.step)))
+        elif (pressure < self.low_watermark
+              and target
+              and cache.total_estimated_size >= target * (1 - self.step)):
+            target = max(self.min_bytes, int(target * (1 + self.step)))
+            if self.max_bytes is not None:
+                target = min(target, self.max_bytes)
+        else:
+            return target
+        cache.cache_size_bytes = target
+        return target
+
+
+class PickleStateStore:
+    """A size-bounded store of pickled object states, keyed by oid and
+    serial, that can be shared by the pickle caches of all the
+    connections of a process.
+
+    Without it, each connection loads (and keeps) its own copy of the
+    state of the objects all connections use. The caches only pass
+    invalidations on to the store (passing oids to
+    :meth:`~.IPickleCache.invalidate` of a cache using the store also
+    invalidates them here); they never load states themselves, so the
+    store only saves loads if the jar's ``setstate`` uses it. It
+    should look for the state of an object in the ``state_store`` of
+    its cache with :meth:`get` (or :meth:`get_latest`) before loading
+    it from storage, and add what it loads with :meth:`set`::
+
+        def setstate(self, obj):
+            oid = obj._p_oid
+            found = self._cache.state_store.get_latest(oid)
+            if found is None:
+                state, serial = self._storage.load(oid)
+                self._cache.state_store.set(oid, serial, state)
+            else:
+                state, serial = found
+            obj._p_serial = serial
+            obj.__setstate__(self._unpickle(state))
+
+    The least recently used states go when the total size of the states
+    would exceed *max_bytes*.
+
+    All methods may be called from any thread.
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+        self.max_bytes = max_bytes
+        # The total size of the states.
+        self.size = 0
+        # (oid, serial) -> state, least recently used first
+        self._states = OrderedDict()
+        # oid -> the serials of its states, most recently set last
+        self._serials = {}
+        self._stats = dict.fromkeys(('hits', 'misses', 'evictions'), 0)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._states)
+
+    def get(self, oid, serial):
+        """Return the state of the object's revision, or None."""
+        with self._lock:
+            return self._get(oid, serial)
+
+    def get_latest(self, oid):
+        """Return the most recently set ``(state, serial)`` of the
+        object, or None."""
+        with self._lock:
+            serials = self._serials.get(oid)
+            if not serials:
+                self._stats['misses'] += 1
+                return None
+            serial = serials[-1]
+            return self._get(oid, serial), serial
+
+    def _get(self, oid, serial):
+        key = oid, serial
+        state = self._states.get(key)
+        if state is None:
+            self._stats['misses'] += 1
+        else:
+            self._stats['hits'] += 1
+            self._states.move_to_end(key)
+        return state
+
+    def set(self, oid, serial, state):
+        """Store the state (bytes) of the object's revision.
+
+        Return whether it was stored; states bigger than ``max_bytes``
+        are not.
+        """
+        if not isinstance(state, bytes):
+            raise TypeError("state must be bytes")
+        if len(state) > self.max_bytes:
+            return False
+        key = oid, serial
+        with self._lock:
+            old = self._states.pop(key, None)
+            if old is None:
+                self._serials.setdefault(oid, []).append(serial)
+            else:
+                self.size -= len(old)
+            self._states[key] = state
+            self.size += len(state)
+            while self.size > self.max_bytes:
+                (oid, serial), old = self._states.popitem(last=False)
+                self._remove_serial(oid, serial)
+                self.size -= len(old)
+                self._stats['evictions'] += 1
+        return True
+
+    def _remove_serial(self, oid, serial):
+        serials = self._serials[oid]
+        serials.remove(serial)
+        if not serials:
+            del self._serials[oid]
+
+    def invalidate(self, oids):
+        """Remove all the states of the objects.
+
+        *oids* is an oid or an iterable of oids, as for
+        :meth:`~.IPickleCache.invalidate`.
+        """
+        if isinstance(oids, OID_TYPE):
+            oids = (oids,)
+        with self._lock:
+            for oid in oids:
+                for serial in self._serials.pop(oid, ()):
+                    self.size -= len(self._states.pop((oid, serial)))
+
+    def clear(self):
+        """Remove all the states."""
+        with self._lock:
+            self._states.clear()
+            self._serials.clear()
+            self.size = 0
+
+    def stats(self, reset=False):
+        """Return a dictionary of counters: the 'hits' and 'misses' of
+        :meth:`get` and :meth:`get_latest`, and the 'evictions' of
+        states to make room for others."""
+        with self._lock:
+            result = dict(self._stats)
+            if reset:
+                self._stats = dict.fromkeys(self._stats, 0)
+        return result
+
+
+_CONTAINER_TYPES = (dict, list, tuple, set, frozenset)
+
+
+def estimate_state_size(obj, max_depth=2):
+    """Estimate the memory used by the loaded persistent object *obj*.
+
+    This adds up :func:`sys.getsizeof` of the object, of its state (as
+    returned by ``__getstate__``) and of the dicts, lists, tuples and
+    sets in the state and their contents, up to *max_depth* levels
+    below the state. Each object is counted once, and other persistent
+    objects are not counted at all: they have their own estimates.
+
+    This is meant to be used with ``PickleCache.set_size_estimator``.
+    """
+    seen = {id(obj)}
+
+    def size_of(value, depth):
+        if id(value) in seen or isinstance(value, (Persistent, PersistentPy)):
+            return 0
+        seen.add(id(value))
+        size = sys.getsizeof(value)
+        if depth < max_depth and isinstance(value, _CONTAINER_TYPES):
+            if isinstance(value, dict):
+                value = itertools.chain.from_iterable(value.items())
+            size += sum(size_of(item, depth + 1) for item in value)
+        return size
+
+    return sys.getsizeof(obj) + size_of(obj.__getstate__(), 0)
+
+
+# The priority of pinned objects; see PickleCache.pin.
+_PINNED = sys.maxsize
+
+# Activation histograms count durations in buckets whose upper bounds
+# are 2**i microseconds, and a last bucket for anything longer; see
+# "Activation Histograms" in cPickleCache.c.
+_ACTIVATION_BUCKETS = 26
+
+
+def _activation_bucket(duration):
+    us = duration * 1e6
+    if us <= 1.0:
+        return 0
+    mantissa, exponent = math.frexp(us)
+    if mantissa == 0.5:
+        exponent -= 1
+    return min(exponent, _ACTIVATION_BUCKETS - 1)
+
+
+def _activation_bound(bucket):
+    if bucket == _ACTIVATION_BUCKETS - 1:
+        return math.inf
+    return 2.0 ** bucket / 1e6
+
+
+# snapshot_hot() files are just the concatenated oids, most recently used
+# first. Only oids of this (ZODB's) size are written.
+_SNAPSHOT_OID_SIZE = 8
+
+
+def _snapshot_hot(cache, path, limit=None):
+    # The implementation of IPickleCache.snapshot_hot for both caches.
+    if limit is not None and limit < 0:
+        raise ValueError("limit must not be negative")
+    oids = []
+    for oid, _ in reversed(cache.lru_items()):
+        if limit is not None and len(oids) >= limit:
+            break
+        if isinstance(oid, OID_TYPE) and len(oid) == _SNAPSHOT_OID_SIZE:
+            oids.append(oid)
+    # Write to a temporary file first so that a reader (or a crash) never
+    # sees a partial snapshot.
+    tmp_path = os.fspath(path) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join(oids))
+    os.replace(tmp_path, path)
+    return len(oids)
+
+
+def _prewarm(cache, path, limit=None, factory=None):
+    # The implementation of IPickleCache.prewarm for both caches.
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) % _SNAPSHOT_OID_SIZE:
+        raise ValueError("%r is not a snapshot_hot() file" % (path,))
+    count = len(data) // _SNAPSHOT_OID_SIZE
+    if limit is not None:
+        count = min(count, limit)
+    jar_get = getattr(cache.jar, 'get', None)
+
+    to_load = []
+    new_ghosts = []
+    for i in range(count):
+        oid = data[i * _SNAPSHOT_OID_SIZE:(i + 1) * _SNAPSHOT_OID_SIZE]
+        obj = cache.get(oid)
+        if obj is None:
+            if factory is not None:
+                obj = factory(oid)
+                if obj is None:
+                    continue
+                new_ghosts.append((oid, obj))
+                to_load.append(obj)
+                continue
+            elif jar_get is not None:
+                # A ZODB Connection loads enough to create the ghost and
+                # adds it to the cache.
+                obj = jar_get(oid)
+            else:
+                continue
+        if not isinstance(obj, type) and obj._p_status == 'ghost':
+            to_load.append(obj)
+
+    cache.new_ghost_many(new_ghosts)
+
+    # Load the least recently used first, leaving the cache in the
+    # snapshot's order.
+    to_load.reverse()
+    reify = getattr(cache, 'reify', None)
+    if reify is not None:
+        reify([obj._p_oid for obj in to_load])
+    else:
+        for obj in to_load:
+            obj._p_activate()
+    return len(to_load)
+
+
+def _check_new_ghosts(pairs, cacheable, cached):
+    # Check the (oid, object) pairs given to new_ghost_many() before
+    # adding any, raising what the C implementation raises.
+    # Like the C implementation, check each pair first and then that
+    # no oid or object is repeated (which C finds while adding them).
+    pairs = list(pairs)
+    for pair in pairs:
+        if not isinstance(pair, tuple) or len(pair) != 2:
+            raise TypeError("new_ghost_many() expects (oid, object) tuples")
+        oid, obj = pair
+        if not isinstance(obj, cacheable):
+            raise TypeError("Cache values must be persistent objects.")
+        if obj._p_oid is not None:
+            raise ValueError("New ghost object must not have an oid")
+        if obj._p_jar is not None:
+            raise ValueError("New ghost object must not have a jar")
+        if cached(oid):
+            raise ValueError("The given oid is already in the cache")
+    if (len({oid for oid, _ in pairs}) != len(pairs)
+            or len({id(obj) for _, obj in pairs}) != len(pairs)):
+        oids = set()
+        ids = set()
+        for oid, obj in pairs:
+            if oid in oids:
+                raise ValueError("The same oid is given more than once")
+            if id(obj) in ids:
+                raise ValueError("The same object is given more than once")
+            oids.add(oid)
+            ids.add(id(obj))
+    return pairs
+
+
 @use_c_impl
 # We actually implement IExtendedPickleCache, but
 # the C version does not, and our interface declarations are
@@ -148,11 +767,40 @@ class PickleCache:
     total_estimated_size = 0
     cache_size_bytes = 0
 
+    # The counters reported by cache_stats(), in order.
+    _STATS = (
+        'hits',
+        'misses',
+        'accesses',
+        'new_ghosts',
+        'incrgc_calls',
+        'evictions',
+        'invalidations',
+        'bytes_reclaimed',
+        'ghost_limit_exceeded',
+        'ghost_releases',
+    )
+
     # Set by functions that sweep the entire ring (via _sweeping_ring)
     # Serves as a pseudo-lock
     _is_sweeping_ring = False
 
-    def __init__(self, jar, target_size=0, cache_size_bytes=0):
+    # The sweep asked for by the sweeper thread, which
+    # PersistentPy._p_activate does (see CacheSweeper).
+    _pending_sweep = None
+
+    # The object PersistentPy._p_activate is loading, if any.
+    _loading = None
+
+    # The eviction policies we understand. See the comments in
+    # cPickleCache.c for how they work.
+    _EVICTION_POLICIES = ('lru', 'slru', '2q', 'arc', 'clock')
+
+    def __init__(self, jar, target_size=0, cache_size_bytes=0,
+                 eviction_policy='lru', exact_sizes=False, state_store=None):
+        if eviction_policy not in self._EVICTION_POLICIES:
+            raise ValueError(
+                "Unknown eviction policy %r" % (eviction_policy,))
         # TODO: forward-port Dieter's bytes stuff
         self.jar = jar
         # We expect the jars to be able to have a pointer to
@@ -171,8 +819,70 @@ class PickleCache:
         self.non_ghost_count = 0
         self.persistent_classes = {}
         self.data = _WeakValueDictionary()
-        self.ring = Ring(self.data.cleanup_hook)
+        self._eviction_policy = eviction_policy
+        self.ring = Ring(self.data.cleanup_hook,
+                         segmented=eviction_policy not in ('lru', 'clock'))
+        # With the 'clock' policy, accesses only set the _REFERENCED flag
+        # of the objects, and sweeps move those objects.
+        self._clock = eviction_policy == 'clock'
+        # Oids of recently ghostified objects, used as ordered sets.
+        self._history_probation = None
+        self._history_protected = None
+        if eviction_policy in ('2q', 'arc'):
+            self._history_probation = OrderedDict()
+        if eviction_policy == 'arc':
+            self._history_protected = OrderedDict()
+        # The adaptive target size of the probationary segment for 'arc'.
+        self._arc_p = 0
         self.cache_size_bytes = cache_size_bytes
+        self._stats = dict.fromkeys(self._STATS, 0)
+        # Like the ring_lock of the C implementation, held while
+        # sweeping; a sweep that can't acquire it does nothing.
+        self._sweep_lock = threading.Lock()
+        self._sweeper = None
+        self._memory_controller = None
+        # class -> the maximum number of its non-ghost objects
+        self._class_quotas = {}
+        # The most ghosts we want, or None, and whether sweeps ghostify
+        # objects referring to ghosts to get below it.
+        self._ghost_limit = None
+        self._ghost_release = True
+        # The oids of the non-ghosts that looked up or created ghosts
+        # while they were loaded. See _release_ghosts.
+        self._ghost_referrers = set()
+        # class (or None for all others) -> size estimator
+        self._size_estimators = {}
+        # oid -> exact estimated size of the object, or None if we
+        # don't keep exact sizes. See _size_of.
+        self._exact_sizes = {} if exact_sizes else None
+        self.state_store = state_store
+        # The oids of the objects accessed since the ring was last
+        # updated, or None to update it on each access. See
+        # set_access_buffer.
+        self._access_buffer = None
+        self._access_buffer_size = 0
+        # Called for events of our objects, with the reason we are
+        # working on them if we are. See set_trace_hook.
+        self._trace_hook = None
+        self._trace_cause = None
+        # class -> [activations, count of bucket 0, count of bucket 1, ...]
+        # or None. See set_activation_histogram.
+        self._activation_histogram = None
+        # oid -> None (pinned) or priority. See "Pins and Priorities"
+        # in cPickleCache.c.
+        self._priorities = {}
+
+    @property
+    def exact_sizes(self):
+        """ See IPickleCache.
+        """
+        return self._exact_sizes is not None
+
+    @property
+    def eviction_policy(self):
+        """ See IPickleCache.
+        """
+        return self._eviction_policy
 
     # IPickleCache API
     def __len__(self):
@@ -186,8 +896,17 @@ class PickleCache:
         """
         value = self.data.get(oid, self)
         if value is not self:
+            self._stats['hits'] += 1
+            if self._loading is not None:
+                self._note_referent(value)
             return value
-        return self.persistent_classes[oid]
+        try:
+            value = self.persistent_classes[oid]
+        except KeyError:
+            self._stats['misses'] += 1
+            raise
+        self._stats['hits'] += 1
+        return value
 
     def __setitem__(self, oid, value):
         """ See IPickleCache.
@@ -214,8 +933,11 @@ class PickleCache:
 
         if oid in self.persistent_classes or oid in self.data:
             # Have to be careful here, a GC might have just run
-            # and cleaned up the object
-            existing_data = self.get(oid)
+            # and cleaned up the object. (This isn't a lookup, so
+            # don't count a hit like get() would.)
+            existing_data = self.persistent_classes.get(oid)
+            if existing_data is None:
+                existing_data = self.data.get(oid)
             if existing_data is not None and existing_data is not value:
                 # Raise the same type of exception as the C impl with the same
                 # message.
@@ -254,14 +976,25 @@ class PickleCache:
         else:
             pobj = self.data.pop(oid)
             self.ring.delete(pobj)
+            self._ghost_referrers.discard(oid)
+            if self._exact_sizes:
+                self._exact_sizes.pop(oid, None)
 
     def get(self, oid, default=None):
         """ See IPickleCache.
         """
         value = self.data.get(oid, self)
         if value is not self:
+            self._stats['hits'] += 1
+            if self._loading is not None:
+                self._note_referent(value)
             return value
-        return self.persistent_classes.get(oid, default)
+        value = self.persistent_classes.get(oid, self)
+        if value is not self:
+            self._stats['hits'] += 1
+            return value
+        self._stats['misses'] += 1
+        return default
 
     def mru(self, oid):
         """ See IPickleCache.
@@ -272,16 +1005,43 @@ class PickleCache:
             # because that could leave it inconsistent
             return False  # marker return for tests
 
-        value = self.data[oid]
+        self._stats['accesses'] += 1
+        self._accessed(self.data[oid])
+        return None
 
-        was_in_ring = value in self.ring
-        if not was_in_ring:
+    def _accessed(self, value):
+        if value not in self.ring:
             if _OGA(value, '_p_state') != GHOST:
                 self.ring.add(value)
                 self.non_ghost_count += 1
+                if self._clock:
+                    self._note_reference(value)
+        elif self._clock:
+            self._note_reference(value)
         else:
-            self.ring.move_to_head(value)
-        return None
+            self.ring.promote(value)
+
+    def _drain_accesses(self):
+        # Deal with the accesses that PersistentPy._p_accessed put in the
+        # buffer as mru() would have, in the order they happened. Only
+        # the last access of an object matters for its place in the ring.
+        buffer = self._access_buffer
+        if not buffer or self._is_sweeping_ring:
+            return
+        self._access_buffer = []
+        self._stats['accesses'] += len(buffer)
+        get = self.data.get
+        accessed = self._accessed
+        for oid in reversed(dict.fromkeys(reversed(buffer))):
+            value = get(oid)
+            if value is not None:
+                accessed(value)
+
+    @staticmethod
+    def _note_reference(value):
+        flags = _OGA(value, '_Persistent__flags')
+        if flags is not None:
+            _OSA(value, '_Persistent__flags', flags | _REFERENCED)
 
     def ringlen(self):
         """ See IPickleCache.
@@ -296,19 +1056,41 @@ class PickleCache:
     def lru_items(self):
         """ See IPickleCache.
         """
+        self._drain_accesses()
         return [
             (obj._p_oid, obj)
             for obj in self.ring
         ]
 
+    def iter_lru_items(self, limit=None):
+        """ See IPickleCache.
+        """
+        if limit is not None and limit < 0:
+            raise ValueError("limit must not be negative")
+        self._drain_accesses()
+        return ((obj._p_oid, obj) for obj in self.ring.iterobjects(limit))
+
+    def iter_items(self, limit=None):
+        """ See IPickleCache.
+        """
+        if limit is not None and limit < 0:
+            raise ValueError("limit must not be negative")
+        return itertools.islice(self.data.items(), limit)
+
     def klass_items(self):
         """ See IPickleCache.
         """
         return self.persistent_classes.items()
 
-    def incrgc(self, ignored=None):
+    def incrgc(self, ignored=None, *, max_seconds=None, max_objects=None):
         """ See IPickleCache.
         """
+        self._stats['incrgc_calls'] += 1
+        if self._memory_controller is not None:
+            self._memory_controller.adjust(self)
+        if (self._ghost_limit is not None
+                and self.cache_ghost_count > self._ghost_limit):
+            self._stats['ghost_limit_exceeded'] += 1
         target = self.cache_size
         if self.drain_resistance >= 1:
             size = self.non_ghost_count
@@ -316,13 +1098,14 @@ class PickleCache:
             if target2 < target:
                 target = target2
         # return value for testing
-        return self._sweep(target, self.cache_size_bytes)
+        return self._sweep(target, self.cache_size_bytes,
+                           max_seconds, max_objects)
 
-    def full_sweep(self, target=None):
+    def full_sweep(self, target=None, *, max_seconds=None, max_objects=None):
         """ See IPickleCache.
         """
         # return value for testing
-        return self._sweep(0)
+        return self._sweep(0, 0, max_seconds, max_objects)
 
     minimize = full_sweep
 
@@ -335,6 +1118,50 @@ class PickleCache:
             raise ValueError('Object already has jar')
         if oid in self.persistent_classes or oid in self.data:
             raise KeyError('Duplicate OID: %s' % oid)
+        self._add_new_ghost(oid, obj)
+
+    def new_ghost_many(self, pairs):
+        """ See IPickleCache.
+        """
+        # Check everything first, so that we add either all of them or
+        # none.
+        pairs = _check_new_ghosts(
+            pairs, self._CACHEABLE_TYPES,
+            lambda oid: oid in self.persistent_classes or oid in self.data)
+        jar = self.jar
+        data = self.data
+        added = []
+        try:
+            # Set up our own objects directly and add them all at once,
+            # rather than each through __setitem__, which would check
+            # them again.
+            ghosts = []
+            for oid, obj in pairs:
+                added.append((oid, obj))
+                if isinstance(obj, PersistentPy):
+                    _OSA(obj, '_Persistent__oid', oid)
+                    _OSA(obj, '_Persistent__jar', jar)
+                    _OSA(obj, '_Persistent__flags', None)
+                    ghosts.append((oid, obj))
+                else:
+                    self._add_new_ghost(oid, obj)
+            data.update(ghosts)
+            self._stats['new_ghosts'] += len(ghosts)
+            if self._loading is not None and ghosts:
+                self._note_referent(ghosts[0][1])
+            if data.cleanup_hook:
+                # Begin monitoring for them to be deallocated.
+                ring_node_for = self.ring.ring_node_for
+                for _, obj in ghosts:
+                    ring_node_for(obj)
+        except BaseException:
+            # Adding can still fail part-way, say setting the jar of a
+            # persistent class.
+            for oid, obj in reversed(added):
+                self._discard_new_ghost(oid, obj)
+            raise
+
+    def _add_new_ghost(self, oid, obj):
         obj._p_oid = oid
         obj._p_jar = self.jar
         if not isinstance(obj, type):
@@ -346,27 +1173,374 @@ class PickleCache:
                 # testConnection.doctest_proper_ghost_initialization_with_empty__p_deactivate
                 obj._p_invalidate_deactivate_helper(False)
         self[oid] = obj
+        self._stats['new_ghosts'] += 1
+        if self._loading is not None:
+            self._note_referent(obj)
+
+    def _start_loading(self, obj):
+        # Called by PersistentPy._p_activate before it loads the state
+        # of obj, which it then makes our _loading until it is done.
+        # Returns what that was before. See _release_ghosts.
+        self._ghost_referrers.discard(obj._p_oid)
+        return self._loading
+
+    def _note_referent(self, value):
+        # The object being loaded refers to value.
+        if (not isinstance(value, type)
+                and _OGA(value, '_p_state') == GHOST):
+            self._ghost_referrers.add(self._loading._p_oid)
+
+    def _discard_new_ghost(self, oid, obj):
+        # Undo _add_new_ghost(), which may have only partly succeeded.
+        if (self.data.get(oid) is obj
+                or self.persistent_classes.get(oid) is obj):
+            del self[oid]
+            self._stats['new_ghosts'] -= 1
+        # Without a jar, an instance is up-to-date again.
+        for name in ('_p_jar', '_p_oid'):
+            try:
+                setattr(obj, name, None)
+            except Exception:
+                pass
 
+    @_tracing_cause('reify')
     def reify(self, to_reify):
         """ See IPickleCache.
         """
         if isinstance(to_reify, OID_TYPE):  # bytes
             to_reify = [to_reify]
+        # Each ghost once, even if its oid is given more than once.
+        ghosts = {}
         for oid in to_reify:
-            value = self[oid]
-            if value._p_state == GHOST:
+            value = self.data.get(oid, self)
+            if value is self:
+                value = self.persistent_classes[oid]
+                if value._p_state == GHOST:
+                    value._p_activate()
+            elif value._p_state == GHOST:
+                ghosts[oid] = value
+        ghosts = list(ghosts.items())
+
+        setstate_many = getattr(self.jar, 'setstate_many', None)
+        if setstate_many is None or not ghosts:
+            for oid, value in ghosts:
                 value._p_activate()
-                self.non_ghost_count += 1
+                # This adds it to the ring (and counts it) if
+                # activating it didn't.
                 self.mru(oid)
+            return
+
+        # Do for all of them what ``_p_activate`` does for one: mark
+        # them changed while their state is being set. Like the C
+        # implementation, we put them in the ring first.
+        objects = []
+        for oid, value in ghosts:
+            _OSA(value, '_Persistent__flags', CHANGED)
+            self.mru(oid)
+            objects.append(value)
+        start = perf_counter()
+        try:
+            setstate_many(objects)
+        except BaseException:
+            for value in objects:
+                if value in self.ring:
+                    self.ring.delete(value)
+                    self.non_ghost_count -= 1
+                value._p_invalidate_deactivate_helper()
+            raise
+        duration = perf_counter() - start
+        for value in objects:
+            if _OGA(value, '_Persistent__flags') is not None:
+                _OSA(value, '_Persistent__flags', 0)  # up-to-date
+        # Let the size estimators have their say, as _p_activate does.
+        loaded = self._loaded
+        if loaded is not None:
+            for value in objects:
+                loaded(value)
+        # Like the C implementation, the histogram counts each with its
+        # share of the time, but the trace hook gets the time of all.
+        for value in objects:
+            self._record_activation(value, duration / len(objects))
+        for value in objects:
+            _trace(value, self, 'activate', duration)
+
+    def enable_memory_controller(self, *args, **kwargs):
+        """ See IPickleCache.
+        """
+        self.disable_memory_controller()
+        controller = MemoryPressureController(self, *args, **kwargs)
+        self._memory_controller = controller
+        return controller
+
+    def disable_memory_controller(self):
+        """ See IPickleCache.
+        """
+        controller, self._memory_controller = self._memory_controller, None
+        if controller is not None:
+            self.cache_size_bytes = controller.initial_bytes
+
+    def snapshot_hot(self, path, limit=None):
+        """ See IPickleCache.
+        """
+        return _snapshot_hot(self, path, limit)
+
+    def prewarm(self, path, limit=None, factory=None):
+        """ See IPickleCache.
+        """
+        return _prewarm(self, path, limit, factory)
 
+    def start_sweeper(self, *args, **kwargs):
+        """ See IPickleCache.
+        """
+        self.stop_sweeper()
+        sweeper = CacheSweeper(self, *args, **kwargs)
+        sweeper.start()
+        self._sweeper = sweeper
+        return sweeper
+
+    def stop_sweeper(self):
+        """ See IPickleCache.
+        """
+        sweeper, self._sweeper = self._sweeper, None
+        if sweeper is not None:
+            sweeper.stop()
+        self._pending_sweep = None
+
+    def _request_sweep(self, sweep):
+        # Called by the sweeper thread.
+        self._pending_sweep = sweep
+
+    def _run_pending_sweep(self):
+        sweep, self._pending_sweep = self._pending_sweep, None
+        if sweep is None:
+            return
+        try:
+            sweep()
+        except Exception:  # pragma: no cover
+            logging.getLogger(__name__).exception("Error sweeping %r", self)
+
+    @_tracing_cause('invalidate')
     def invalidate(self, to_invalidate):
         """ See IPickleCache.
         """
         if isinstance(to_invalidate, OID_TYPE):
-            self._invalidate(to_invalidate)
+            to_invalidate = (to_invalidate,)
+        if self.state_store is not None:
+            # First, so that nobody loads the old states again.
+            to_invalidate = tuple(to_invalidate)
+            self.state_store.invalidate(to_invalidate)
+        return self._invalidate_many(to_invalidate)
+
+    def invalidate_classes(self, classes):
+        """ See IPickleCache.
+        """
+        classes = tuple(classes)
+        for klass in classes:
+            if not isinstance(klass, type):
+                raise TypeError("expected classes")
+        return self._invalidate_matching(
+            [value for value in self.ring if isinstance(value, classes)])
+
+    def invalidate_where(self, predicate):
+        """ See IPickleCache.
+        """
+        if not callable(predicate):
+            raise TypeError("predicate must be callable")
+        return self._invalidate_matching(list(self.ring), predicate)
+
+    def cache_stats(self, reset=False):
+        """ See IPickleCache.
+        """
+        # Count the buffered accesses, too.
+        self._drain_accesses()
+        result = dict(self._stats)
+        if reset:
+            self._stats = dict.fromkeys(self._STATS, 0)
+        return result
+
+    def class_stats(self):
+        """ See IPickleCache.
+        """
+        # Unlike the C implementation, we don't keep these numbers
+        # up to date all the time; the ring has the same information.
+        result = {}
+        for value in self.ring:
+            klass = type(value)
+            count, size = result.get(klass, (0, 0))
+            result[klass] = (count + 1, size + self._size_of(value))
+        return result
+
+    def sample(self, k, ghosts=False):
+        """ See IPickleCache.
+        """
+        if k < 0:
+            raise ValueError("k must not be negative")
+        if ghosts:
+            population = [value for _, value in self.data.items()]
         else:
-            for oid in to_invalidate:
-                self._invalidate(oid)
+            population = list(self.ring)
+        return random.sample(population, min(k, len(population)))
+
+    def estimate_composition(self, k):
+        """ See IPickleCache.
+        """
+        sample = self.sample(k)
+        counts = {}
+        for value in sample:
+            klass = type(value)
+            count, size = counts.get(klass, (0, 0))
+            counts[klass] = (count + 1, size + self._size_of(value))
+        # Each object of the sample stands for scale objects. Rounded
+        # like the C implementation.
+        scale = self.non_ghost_count / len(sample) if sample else 0
+        return {klass: (int(count * scale + 0.5), int(size * scale + 0.5))
+                for klass, (count, size) in counts.items()}
+
+    def set_class_quota(self, klass, max_count):
+        """ See IPickleCache.
+        """
+        if not isinstance(klass, type):
+            raise TypeError("Quotas are set for classes")
+        if max_count is None:
+            self._class_quotas.pop(klass, None)
+            return
+        if max_count < 0:
+            raise ValueError("max_count must not be negative")
+        self._class_quotas[klass] = max_count
+
+    def class_quotas(self):
+        """ See IPickleCache.
+        """
+        return dict(self._class_quotas)
+
+    def pin(self, oid):
+        """ See IPickleCache.
+        """
+        self._priorities[oid] = None
+
+    def unpin(self, oid):
+        """ See IPickleCache.
+        """
+        if oid in self._priorities and self._priorities[oid] is None:
+            del self._priorities[oid]
+
+    def set_priority(self, oid, priority):
+        """ See IPickleCache.
+        """
+        if priority < 0:
+            raise ValueError("priority must not be negative")
+        if priority:
+            self._priorities[oid] = priority
+        else:
+            self._priorities.pop(oid, None)
+
+    def priorities(self):
+        """ See IPickleCache.
+        """
+        return dict(self._priorities)
+
+    def _priority(self, value):
+        # The priority of the object, 0 unless it was given one.
+        if not self._priorities:
+            return 0
+        priority = self._priorities.get(value._p_oid, 0)
+        return _PINNED if priority is None else priority
+
+    @property
+    def cache_ghost_count(self):
+        """ See IPickleCache.
+        """
+        return len(self.data) - self.non_ghost_count
+
+    def ghost_stats(self):
+        """ See IPickleCache.
+        """
+        result = {}
+        for _, value in self.data.items():
+            if value._p_state != GHOST:
+                continue
+            klass = type(value)
+            count, size = result.get(klass, (0, 0))
+            result[klass] = (count + 1, size + sys.getsizeof(value))
+        return result
+
+    def set_ghost_limit(self, limit, release=True):
+        """ See IPickleCache.
+        """
+        if limit is not None and limit < 0:
+            raise ValueError("limit must not be negative")
+        self._ghost_limit = limit
+        self._ghost_release = bool(release)
+
+    def set_access_buffer(self, size):
+        """ See IPickleCache.
+        """
+        if size < 0:
+            raise ValueError("size must not be negative")
+        self._drain_accesses()
+        self._access_buffer = [] if size else None
+        self._access_buffer_size = size
+
+    @property
+    def access_buffer_size(self):
+        """ See IPickleCache.
+        """
+        return self._access_buffer_size
+
+    def set_trace_hook(self, hook):
+        """ See IPickleCache.
+        """
+        if hook is not None and not callable(hook):
+            raise TypeError("hook must be callable")
+        self._trace_hook = hook
+
+    @property
+    def trace_hook(self):
+        """ See IPickleCache.
+        """
+        return self._trace_hook
+
+    def set_activation_histogram(self, enabled):
+        """ See IPickleCache.
+        """
+        if not enabled:
+            self._activation_histogram = None
+        elif self._activation_histogram is None:
+            self._activation_histogram = {}
+
+    def activation_histogram(self, reset=False):
+        """ See IPickleCache.
+        """
+        histogram = self._activation_histogram or {}
+        classes = {}
+        for klass, counts in list(histogram.items()):
+            classes[klass] = {
+                'activations': counts[0],
+                'buckets': {_activation_bound(i): count
+                            for i, count in enumerate(counts[1:])
+                            if count},
+            }
+        if reset:
+            histogram.clear()
+        return {
+            'activations': sum(counts['activations']
+                               for counts in classes.values()),
+            'classes': classes,
+        }
+
+    def _record_activation(self, obj, duration):
+        # Called by persistent objects after loading their state took
+        # duration seconds, if we have an activation histogram.
+        histogram = self._activation_histogram
+        if (histogram is None
+                or self.data.get(_OGA(obj, '_Persistent__oid')) is not obj):
+            return
+        klass = type(obj)
+        counts = histogram.get(klass)
+        if counts is None:
+            counts = histogram[klass] = [0] * (_ACTIVATION_BUCKETS + 1)
+        counts[0] += 1
+        counts[_activation_bucket(duration) + 1] += 1
 
     def debug_info(self):
         result = []
@@ -386,12 +1560,35 @@ class PickleCache:
             ))
         return result
 
+    def set_size_estimator(self, estimator, klass=None):
+        """ See IPickleCache.
+        """
+        if klass is not None and not isinstance(klass, type):
+            raise TypeError("klass must be a class or None")
+        if estimator is None:
+            self._size_estimators.pop(klass, None)
+        elif not callable(estimator):
+            raise TypeError("estimator must be callable")
+        else:
+            self._size_estimators[klass] = estimator
+        self._loaded = self._estimate_size if self._size_estimators else None
+
     def update_object_size_estimation(self, oid, new_size):
         """ See IPickleCache.
         """
         value = self.data.get(oid)
 
-        if value is not None:
+        if value is not None and self._exact_sizes is not None:
+            old_size = self._size_of(value)
+            if new_size < 0:
+                # The object was deactivated and no longer takes any
+                # bytes (see PersistentPy._p_deactivate).
+                self._exact_sizes.pop(oid, None)
+                new_size = 0
+            else:
+                self._exact_sizes[oid] = new_size
+            self.total_estimated_size += new_size - old_size
+        elif value is not None:
             # Recall that while the argument is given in bytes,
             # we have to work with 64-block chunks (plus one)
             # to match the C implementation. Hence the convoluted
@@ -426,9 +1623,258 @@ class PickleCache:
     # there's no way around it if we want full compatibility.
     _persistent_deactivate_ran = False
 
+    def _size_of(self, value):
+        # The estimated size we count for the object, in bytes: the
+        # exact one, if we keep exact sizes and it still matches the
+        # object's _p_estimated_size (which may be set without telling
+        # us), and its _p_estimated_size otherwise.
+        size = getattr(value, '_p_estimated_size', 0)
+        if self._exact_sizes:
+            exact = self._exact_sizes.get(value._p_oid)
+            if (exact is not None
+                    and _estimated_size_in_24_bits(exact) * 64 == size):
+                return exact
+        return size
+
+    # Called by PersistentPy._p_activate after loading an object, like
+    # the loaded hook of the C implementation's CACHE_HEAD.
+    _loaded = None
+
+    def _estimate_size(self, obj):
+        estimators = self._size_estimators
+        estimator = estimators.get(type(obj), estimators.get(None))
+        if estimator is None:
+            return
+        # Like the C implementation, report errors as unraisable and
+        # keep the jar's estimate; the state has been loaded after all.
+        try:
+            size = estimator(obj)
+            if size is None:
+                # Keep the jar's estimate.
+                return
+            size = operator.index(size)
+            if size < 0:
+                raise ValueError(
+                    "size estimators must not return negative sizes")
+        except Exception as e:
+            sys.unraisablehook(SimpleNamespace(
+                exc_type=type(e), exc_value=e, exc_traceback=e.__traceback__,
+                err_msg=None, object=estimator))
+            return
+        self.update_object_size_estimation(obj._p_oid, size)
+        obj._p_estimated_size = size
+
+    # Set when a sweep runs out of budget: whether the objects following
+    # the ring's cursor belong to the probationary segment.
+    _cursor_in_probation = False
+
+    def _protected_target(self, capacity):
+        policy = self._eviction_policy
+        if policy == 'slru':
+            return capacity - capacity // 5
+        if policy == '2q':
+            return capacity - capacity // 4
+        if policy == 'arc':
+            return capacity - self._arc_p
+        return capacity
+
+    def _remember_evicted(self, oid, from_probation, capacity):
+        history = (self._history_probation if from_probation
+                   else self._history_protected)
+        if history is None:
+            return
+        limit = capacity // 2 if self._eviction_policy == '2q' else capacity
+        history[oid] = None
+        while history and len(history) > limit:
+            history.popitem(False)
+
+    def _take_from_history(self, oid, capacity):
+        # Return whether the probationary object with the given oid
+        # was ghostified recently, forgetting it if so.
+        b1 = self._history_probation
+        if b1 is None:
+            return False
+        b2 = self._history_protected
+        if oid in b1:
+            hit = b1
+        elif b2 is not None and oid in b2:
+            hit = b2
+        else:
+            return False
+
+        if self._eviction_policy == 'arc':
+            # Grow the probationary segment on hits in its history,
+            # shrink it on hits in the protected history.
+            if hit is b1:
+                delta = len(b2) // len(b1) if len(b2) > len(b1) else 1
+                self._arc_p = min(self._arc_p + delta, capacity)
+            else:
+                delta = len(b1) // len(b2) if len(b1) > len(b2) else 1
+                self._arc_p = max(self._arc_p - delta, 0)
+        del hit[oid]
+        return True
+
+    @_tracing_cause('evict')
+    def _sweep(self, target, target_size_bytes=0,
+               max_seconds=None, max_objects=None):
+        if max_seconds is not None and max_seconds < 0:
+            raise ValueError("max_seconds must not be negative")
+        if max_objects is not None and max_objects < 0:
+            raise ValueError("max_objects must not be negative")
+        if not self._sweep_lock.acquire(False):
+            # Somebody else is sweeping (perhaps the sweeper thread,
+            # perhaps our caller, through a _p_deactivate method).
+            return 0
+        try:
+            self._drain_accesses()
+            return self._sweep_ring(target, target_size_bytes,
+                                    max_seconds, max_objects)
+        finally:
+            self._sweep_lock.release()
+
+    def _evict(self, node, value):
+        # Ghostify the up-to-date object in the ring node, returning
+        # whether it worked.
+
+        # The C implementation will only evict things that are
+        # specifically in the up-to-date state
+        self._persistent_deactivate_ran = False
+
+        # sweeping an object out of the cache should also
+        # ghost it---that's what C does. This winds up
+        # calling `update_object_size_estimation`.
+        # Also in C, if this was the last reference to the object,
+        # it removes itself from the `data` dictionary.
+        # If we're under PyPy or Jython, we need to run a GC collection
+        # to make this happen...this is only noticeable though, when we
+        # eject objects. Also, note that we can only take any of these
+        # actions if our _p_deactivate ran, in case of buggy
+        # subclasses. see _persistent_deactivate_ran.
+        size_before = self.total_estimated_size
+        value._p_deactivate()
+        if (self._persistent_deactivate_ran
+                # Test-cases sneak in non-Persistent objects, sigh, so
+                # naturally they don't cooperate (without this check a
+                # bunch of test_picklecache breaks)
+                or not isinstance(value, self._SWEEPABLE_TYPES)):
+            self.ring.delete_node(node)
+            self.non_ghost_count -= 1
+            self._stats['evictions'] += 1
+            if self.total_estimated_size < size_before:
+                self._stats['bytes_reclaimed'] += (
+                    size_before - self.total_estimated_size)
+            return True
+        return False
+
+    def _enforce_quotas(self, budget_left):
+        # Ghostify the least recently used up-to-date objects of the
+        # classes over their quotas. Returns the numbers of objects
+        # examined and ghostified, and whether any of those had weak
+        # references.
+        quotas = self._class_quotas
+        excess = {}
+        for value in self.ring:
+            klass = type(value)
+            if klass in quotas:
+                excess[klass] = excess.get(klass, -quotas[klass]) + 1
+        excess = {klass: n for klass, n in excess.items() if n > 0}
+        examined = ejected = 0
+        had_weak_refs = False
+        for node, value in self.ring.iteritems():
+            if not excess or not budget_left(examined):
+                break
+            if value is None:
+                continue
+            examined += 1
+            klass = type(value)
+            if (klass not in excess
+                    or value._p_state != UPTODATE
+                    or self._priority(value) == _PINNED):
+                continue
+            weak_refs = getattr(value, '__weakref__', None) is not None
+            if self._evict(node, value):
+                ejected += 1
+                had_weak_refs |= weak_refs
+                excess[klass] -= 1
+                if not excess[klass]:
+                    del excess[klass]
+        return examined, ejected, had_weak_refs
+
+    def _release_ghosts(self, budget_left):
+        # While we have too many ghosts, ghostify the least recently
+        # used up-to-date objects that refer to ghosts, releasing those
+        # nobody else refers to. Returns the same as _enforce_quotas.
+        # Like the C implementation, we only know about the ghosts the
+        # objects looked up or created while they were loaded (see
+        # _note_referent), rather than looking at all their references.
+        referrers = self._ghost_referrers
+        examined = ejected = 0
+        had_weak_refs = False
+        for node, value in self.ring.iteritems():
+            if (self.cache_ghost_count <= self._ghost_limit
+                    or not budget_left(examined)):
+                break
+            if value is None:
+                continue
+            examined += 1
+            if (value._p_state != UPTODATE
+                    or self._priority(value) == _PINNED
+                    or value._p_oid not in referrers):
+                continue
+            weak_refs = getattr(value, '__weakref__', None) is not None
+            if self._evict(node, value):
+                ejected += 1
+                had_weak_refs |= weak_refs
+                self._stats['ghost_releases'] += 1
+        # Clear the iteration variable, so the last object we
+        # ghostified doesn't keep its ghosts alive.
+        value = None
+        return examined, ejected, had_weak_refs
+
+    def _evict_by_priority(self, over_target, budget_left):
+        # While we are over the targets, ghostify the least recently
+        # used up-to-date objects with the lowest priority above 0, then
+        # those with the next priority and so on. Returns the same as
+        # _enforce_quotas.
+        examined = ejected = 0
+        had_weak_refs = False
+        for priority in sorted({priority
+                                for priority in self._priorities.values()
+                                if priority is not None}):
+            for node, value in self.ring.iteritems():
+                if not over_target() or not budget_left(examined):
+                    return examined, ejected, had_weak_refs
+                if value is None:
+                    continue
+                examined += 1
+                if (value._p_state != UPTODATE
+                        or self._priority(value) != priority):
+                    continue
+                weak_refs = getattr(value, '__weakref__', None) is not None
+                if self._evict(node, value):
+                    ejected += 1
+                    had_weak_refs |= weak_refs
+        return examined, ejected, had_weak_refs
+
     @_sweeping_ring
-    def _sweep(self, target, target_size_bytes=0):
+    def _sweep_ring(self, target, target_size_bytes,
+                    max_seconds, max_objects):
+        deadline = None
+        if max_seconds is not None:
+            deadline = perf_counter() + max_seconds
+        examined = 0
         ejected = 0
+        # Only incremental collections apply the eviction policy; a full
+        # sweep ghostifies everything it can.
+        partial = target or target_size_bytes
+        marker = self.ring.ring_segment
+        in_probation = marker is not None
+        probation_survivors = 0
+        capacity = self.cache_size if self.cache_size > 0 \
+            else self.non_ghost_count
+        # Promoted objects go to the end of the ring; the first one
+        # marks where the ring ended when we started.
+        stop = None
         # If we find and eject objects that may have been weak referenced, we
         # need to run a garbage collection to try to clear those references.
         # Otherwise, it's highly likely that accessing those objects through
@@ -436,43 +1882,112 @@ class PickleCache:
         # jar they came from is probably closed, that will lead to an error.
         # See https://github.com/zopefoundation/persistent/issues/149
         had_weak_refs = False
+
+        def budget_left(examined):
+            return ((max_objects is None or examined < max_objects)
+                    and (deadline is None or perf_counter() < deadline))
+
+        # Quotas and the ghost limit come first.
+        if partial and self._class_quotas:
+            examined, ejected, had_weak_refs = self._enforce_quotas(
+                budget_left)
+        if (partial
+                and self._ghost_limit is not None
+                and self._ghost_release):
+            g_examined, g_ejected, g_weak_refs = self._release_ghosts(
+                lambda n: budget_left(examined + n))
+            examined += g_examined
+            ejected += g_ejected
+            had_weak_refs |= g_weak_refs
+        # Carry on where the last interrupted sweep stopped, if any.
+        start = self.ring.take_cursor()
+        if start is not None:
+            in_probation = self._cursor_in_probation
         ring = self.ring
-        for node, value in ring.iteritems():
+        for node, value in ring.iteritems(start):
             if ((target or target_size_bytes)
                     and (not target or self.non_ghost_count <= target)
                     and (self.total_estimated_size <= target_size_bytes
                          or not target_size_bytes)):
                 break
 
+            if node == stop:
+                break
+
+            if ((max_objects is not None and examined >= max_objects)
+                    or (deadline is not None and perf_counter() >= deadline)):
+                # Out of budget; remember where to carry on.
+                ring.save_cursor(node)
+                self._cursor_in_probation = in_probation
+                break
+
+            if node == marker:
+                # We've seen all of the probationary segment. If the
+                # protected segment is over its target size, demote its
+                # least recently used objects and carry on with them.
+                if not (in_probation
+                        and partial
+                        and ring.demote(
+                            self.non_ghost_count
+                            - probation_survivors
+                            - self._protected_target(capacity),
+                            stop)):
+                    in_probation = False
+                continue
+
+            if value is None:
+                # An iterator's node.
+                continue
+
+            examined += 1
             if value._p_state == UPTODATE:
-                # The C implementation will only evict things that are
-                # specifically in the up-to-date state
-                self._persistent_deactivate_ran = False
-
-                # sweeping an object out of the cache should also
-                # ghost it---that's what C does. This winds up
-                # calling `update_object_size_estimation`.
-                # Also in C, if this was the last reference to the object,
-                # it removes itself from the `data` dictionary.
-                # If we're under PyPy or Jython, we need to run a GC collection
-                # to make this happen...this is only noticeable though, when we
-                # eject objects. Also, note that we can only take any of these
-                # actions if our _p_deactivate ran, in case of buggy
-                # subclasses. see _persistent_deactivate_ran.
+                priority = self._priority(value)
+                if priority == _PINNED or (partial and priority):
+                    # Pinned, or left for _evict_by_priority.
+                    if in_probation:
+                        probation_survivors += 1
+                    continue
+
+                if self._clock and partial:
+                    flags = _OGA(value, '_Persistent__flags')
+                    if flags & _REFERENCED:
+                        # Accessed since we last got here; give it a
+                        # second chance.
+                        _OSA(value, '_Persistent__flags',
+                             flags & ~_REFERENCED)
+                        ring.move_to_head(value)
+                        if stop is None:
+                            stop = node
+                        continue
+
+                oid = value._p_oid
+                if (in_probation
+                        and partial
+                        and self._take_from_history(oid, capacity)):
+                    ring.move_to_head(value)
+                    if stop is None:
+                        stop = node
+                    continue
 
                 if not had_weak_refs:
                     had_weak_refs |= getattr(
                         value, '__weakref__', None) is not None
 
-                value._p_deactivate()
-                if (self._persistent_deactivate_ran
-                        # Test-cases sneak in non-Persistent objects, sigh, so
-                        # naturally they don't cooperate (without this check a
-                        # bunch of test_picklecache breaks)
-                        or not isinstance(value, self._SWEEPABLE_TYPES)):
-                    ring.delete_node(node)
+                if self._evict(node, value):
                     ejected += 1
-                    self.non_ghost_count -= 1
+                    if partial:
+                        self._remember_evicted(oid, in_probation, capacity)
+            elif in_probation:
+                probation_survivors += 1
+
+        if partial and self._priorities:
+            _, p_ejected, p_weak_refs = self._evict_by_priority(
+                lambda: ((target and self.non_ghost_count > target)
+                         or (target_size_bytes and
+                             self.total_estimated_size > target_size_bytes)),
+                lambda n: budget_left(examined + n))
+            ejected += p_ejected
+            had_weak_refs |= p_weak_refs
 
         if ejected and had_weak_refs:
             # Clear the iteration variables, so the objects they point to
@@ -482,22 +1997,57 @@ class PickleCache:
             gc.collect()
         return ejected
 
+    @_tracing_cause('invalidate')
     @_sweeping_ring
-    def _invalidate(self, oid):
-        value = self.data.get(oid)
-        if value is not None and value._p_state != GHOST:
+    def _invalidate_matching(self, values, predicate=None):
+        # Ghosts have no state to invalidate, so the callers only pass
+        # the objects in the ring.
+        count = 0
+        for value in values:
+            # An earlier invalidation or call of the predicate may have
+            # ghostified it.
+            if (value._p_state == GHOST
+                    or self.data.get(value._p_oid) is not value):
+                continue
+            if predicate is not None and (not predicate(value)
+                                          or value._p_state == GHOST):
+                continue
+            count += 1
             value._p_invalidate()
             self.ring.delete(value)
             self.non_ghost_count -= 1
-        elif oid in self.persistent_classes:
-            persistent_class = self.persistent_classes.pop(oid)
-            try:
-                # ZODB.persistentclass.PersistentMetaClass objects
-                # have this method and it must be called for transaction abort
-                # and other forms of invalidation to work
-                persistent_class._p_invalidate()
-            except AttributeError:
-                pass
+        self._stats['invalidations'] += count
+        return count
+
+    @_sweeping_ring
+    def _invalidate_many(self, oids):
+        get = self.data.get
+        persistent_classes = self.persistent_classes
+        delete = self.ring.delete
+        ghosted = missing = classes = 0
+        for oid in oids:
+            value = get(oid)
+            if value is not None:
+                ghosted += 1
+                if value._p_state != GHOST:
+                    value._p_invalidate()
+                    delete(value)
+                    self.non_ghost_count -= 1
+            elif oid in persistent_classes:
+                classes += 1
+                persistent_class = persistent_classes.pop(oid)
+                try:
+                    # ZODB.persistentclass.PersistentMetaClass objects
+                    # have this method and it must be called for
+                    # transaction abort and other forms of invalidation
+                    # to work
+                    persistent_class._p_invalidate()
+                except AttributeError:
+                    pass
+            else:
+                missing += 1
+        self._stats['invalidations'] += ghosted + classes
+        return {'ghosted': ghosted, 'missing': missing, 'classes': classes}
 
 
 # This name is bound by the ``@use_c_impl`` decorator to the class defined
@@ -79,6 +79,50 @@ class IRing(Interface):
         undefined consequences.
         """
 
+    def iterobjects(limit=None):
+        """Iterate over (at most *limit* of) the persistent objects in the
+        ring, in the order of least recently used to most recently used.
+
+        Unlike :meth:`__iter__`, this allows the ring to be mutated
+        while the iteration is in progress. The iteration ends with the
+        object that was the most recently used one when it started, so
+        objects that are moved to the head of the ring meanwhile are
+        not produced again.
+        """
+
+    def promote(object):
+        """Note an access to the object, which must be in the ring.
+
+        For a plain ring this is the same as :meth:`move_to_head`. A
+        segmented ring leaves objects at the most recently used end
+        of the probationary segment where they are, and moves all
+        other objects to the most recently used end of the protected
+        segment.
+        """
+
+    def demote(count, stop=None):
+        """Move (at most) *count* of the least recently used objects of the
+        protected segment of a segmented ring to the most recently used
+        end of its probationary segment, not going past the node *stop*.
+
+        Returns the number of objects moved. A plain ring has no
+        segments and always returns 0.
+        """
+
+    def save_cursor(node):
+        """Remember the position in front of the ring node *node*.
+
+        There is only one saved position; saving another one replaces
+        it.
+        """
+
+    def take_cursor():
+        """Forget the position remembered by :meth:`save_cursor`.
+
+        Returns the ring node following that position, or None if no
+        position was saved or it is now at the end of the ring.
+        """
+
 
 ffi = _ring.ffi
 _FFI_RING = _ring.lib
@@ -94,15 +138,38 @@ class _CFFIRing:
     """A ring backed by a C implementation. All operations are constant time.
 
     It is only available on platforms with ``cffi`` installed.
+
+    If *segmented* is true, the ring is divided into a probationary
+    segment, to which new objects are added, and a protected segment.
+    The boundary is a marker node (``ring_segment``) that
+    :meth:`iteritems` produces with a value of None, as it does the
+    ``ring_cursor`` node that :meth:`save_cursor` links in.
     """
 
-    __slots__ = ('ring_home', 'ring_to_obj', 'cleanup_func')
+    __slots__ = (
+        'ring_home',
+        'ring_to_obj',
+        'cleanup_func',
+        'ring_segment',
+        'ring_insert',
+        'ring_cursor',
+    )
 
-    def __init__(self, cleanup_func=None):
+    def __init__(self, cleanup_func=None, segmented=False):
         node = self.ring_home = ffi.new("CPersistentRing*")
         node.r_next = node
         node.r_prev = node
 
+        # New objects are linked in in front of ring_insert.
+        self.ring_segment = None
+        self.ring_insert = node
+        if segmented:
+            marker = self.ring_segment = ffi.new("CPersistentRing*")
+            _FFI_RING.cffi_ring_add(node, marker)
+            self.ring_insert = marker
+        # Only linked in while its r_next is not NULL.
+        self.ring_cursor = ffi.new("CPersistentRing*")
+
         self.cleanup_func = cleanup_func
 
         # The Persistent objects themselves are responsible for keeping
@@ -145,7 +212,7 @@ class _CFFIRing:
 
     def add(self, pobj):
         node = self.ring_node_for(pobj)
-        _FFI_RING.cffi_ring_add(self.ring_home, node)
+        _FFI_RING.cffi_ring_add(self.ring_insert, node)
         self.ring_to_obj[node] = pobj
 
     def delete(self, pobj):
@@ -165,9 +232,47 @@ class _CFFIRing:
         node = self.ring_node_for(pobj, False)
         _FFI_RING.cffi_ring_move_to_head(self.ring_home, node)
 
-    def iteritems(self):
+    def promote(self, pobj):
+        node = self.ring_node_for(pobj, False)
+        if node.r_next != self.ring_insert:
+            _FFI_RING.cffi_ring_move_to_head(self.ring_home, node)
+
+    def demote(self, count, stop=None):
+        marker = self.ring_segment
+        if marker is None:
+            return 0
         head = self.ring_home
-        here = head.r_next
+        last = marker
+        demoted = 0
+        ring_to_obj = self.ring_to_obj
+        while (demoted < count
+               and last.r_next != stop
+               and last.r_next != head):
+            last = last.r_next
+            if last in ring_to_obj:
+                demoted += 1
+        if demoted:
+            _FFI_RING.cffi_ring_del(marker)
+            _FFI_RING.cffi_ring_add(last.r_next, marker)
+        return demoted
+
+    def save_cursor(self, node):
+        cursor = self.ring_cursor
+        if cursor.r_next:
+            _FFI_RING.cffi_ring_del(cursor)
+        _FFI_RING.cffi_ring_add(node, cursor)
+
+    def take_cursor(self):
+        cursor = self.ring_cursor
+        if not cursor.r_next:
+            return None
+        node = cursor.r_next
+        _FFI_RING.cffi_ring_del(cursor)
+        return None if node == self.ring_home else node
+
+    def iteritems(self, start=None):
+        head = self.ring_home
+        here = head.r_next if start is None else start
         ring_to_obj = self.ring_to_obj
         while here != head:
             # We allow mutation during iteration, which means
@@ -176,12 +281,41 @@ class _CFFIRing:
             # removed.
             current = here
             here = here.r_next
-            pobj = ring_to_obj[current]
+            # Markers are the only nodes without an object.
+            pobj = ring_to_obj.get(current)
             yield current, pobj
 
+    def iterobjects(self, limit=None):
+        # Like the C implementation's iterators, we link two placeholder
+        # nodes into the ring: one where the iteration ends and one in
+        # front of the next object to produce. iteritems() produces
+        # them with a value of None.
+        head = self.ring_home
+        ring_to_obj = self.ring_to_obj
+        here = ffi.new("CPersistentRing*")
+        end = ffi.new("CPersistentRing*")
+        _FFI_RING.cffi_ring_add(head, end)
+        _FFI_RING.cffi_ring_add(head.r_next, here)
+        try:
+            while limit is None or limit > 0:
+                node = here.r_next
+                while node != end and node not in ring_to_obj:
+                    node = node.r_next
+                if node == end:
+                    break
+                _FFI_RING.cffi_ring_del(here)
+                _FFI_RING.cffi_ring_add(node.r_next, here)
+                if limit is not None:
+                    limit -= 1
+                yield ring_to_obj[node]
+        finally:
+            _FFI_RING.cffi_ring_del(here)
+            _FFI_RING.cffi_ring_del(end)
+
     def __iter__(self):
         for _, v in self.iteritems():
-            yield v
+            if v is not None:
+                yield v
 
 
 # Export the best available implementation
@@ -2189,6 +2189,22 @@ class PyPersistentTests(unittest.TestCase, _Persistent_Base):
         inst._Persistent__flags = None
         inst._p_accessed()
 
+    def test_p_accessed_already_referenced(self):
+        # A cache using the 'clock' policy already noted an access.
+        from persistent.persistence import _REFERENCED
+
+        class Cache:
+            def mru(self, oid):
+                raise AssertionError("Should never get here")
+
+        inst = self._makeOne()
+        inst._p_jar = self._makeJar()
+        inst._p_jar._cache = Cache()
+        inst._p_oid = 42
+        inst._Persistent__flags = _REFERENCED
+        inst._p_accessed()
+        self.assertEqual(inst._p_state, 0)
+
 
 @skipIfNoCExtension
 class CPersistentTests(unittest.TestCase, _Persistent_Base):
@@ -12,6 +12,10 @@
 #
 ##############################################################################
 import gc
+import os
+import shutil
+import sys
+import tempfile
 import unittest
 
 from persistent._compat import PYPY
@@ -358,6 +362,280 @@ class PickleCacheTestMixin:
         for oid in oids[90:]:
             self.assertIsNotNone(cache.get(oid))
 
+    def test_incrgc_max_objects_resumes(self):
+        cache = self._makeOne()
+        oids = self._populate_cache(cache)
+
+        cache.incrgc(max_objects=30)
+        gc.collect()  # banish the ghosts who are no longer in the ring
+        self.assertEqual(cache.cache_non_ghost_count, 70)
+        self.assertEqual(cache.ringlen(), 70)
+        items = cache.lru_items()
+        self.assertEqual(_len(items), 70)
+        self.assertEqual(items[0][0], oids[30])
+
+        cache.incrgc(max_objects=30)
+        gc.collect()
+        self.assertEqual(cache.cache_non_ghost_count, 40)
+        self.assertEqual(cache.lru_items()[0][0], oids[60])
+
+        cache.incrgc()
+        gc.collect()
+        self.assertEqual(cache.cache_non_ghost_count, 10)
+        self.assertEqual(cache.lru_items()[0][0], oids[90])
+
+    def test_incrgc_max_seconds_zero(self):
+        cache = self._makeOne()
+        self._populate_cache(cache)
+
+        cache.incrgc(max_seconds=0)
+        self.assertEqual(cache.cache_non_ghost_count, 100)
+        self.assertEqual(cache.ringlen(), 100)
+
+        cache.incrgc(max_seconds=60)
+        self.assertEqual(cache.cache_non_ghost_count, 10)
+
+    def test_incrgc_negative_budget(self):
+        cache = self._makeOne()
+        with self.assertRaises(ValueError):
+            cache.incrgc(max_seconds=-1)
+        with self.assertRaises(ValueError):
+            cache.incrgc(max_objects=-1)
+
+    def test_full_sweep_max_objects_resumes(self):
+        cache = self._makeOne()
+        oids = self._populate_cache(cache)
+
+        cache.full_sweep(max_objects=99)
+        gc.collect()
+        self.assertEqual(cache.cache_non_ghost_count, 1)
+        self.assertEqual(cache.lru_items()[0][0], oids[99])
+
+        # The object we were going to start with is gone, so the next
+        # sweep starts at the beginning.
+        cache.invalidate(oids[99])
+        self.assertEqual(cache.cache_non_ghost_count, 0)
+        cache.minimize(max_objects=1)
+        self.assertEqual(cache.ringlen(), 0)
+        self.assertEqual(cache.lru_items(), [])
+
+    def test_start_sweeper_requires_high_water(self):
+        cache = self._makeOne()
+        with self.assertRaises(ValueError):
+            cache.start_sweeper()
+        with self.assertRaises(ValueError):
+            cache.start_sweeper(high_water=5)  # below cache_size
+        with self.assertRaises(ValueError):
+            cache.start_sweeper(high_water_bytes=100, low_water_bytes=200)
+        with self.assertRaises(ValueError):
+            cache.start_sweeper(high_water=50, max_seconds=0)
+        with self.assertRaises(ValueError):
+            cache.start_sweeper(high_water=50, interval=0)
+
+    def test_sweeper_sweep(self):
+        from persistent.picklecache import CacheSweeper
+        cache = self._makeOne()
+        self._populate_cache(cache)
+
+        sweeper = CacheSweeper(cache, high_water=100, low_water=20)
+        self.assertEqual(sweeper.sweep(), 0)
+        self.assertEqual(cache.cache_non_ghost_count, 100)
+
+        sweeper.high_water = 50
+        self.assertEqual(sweeper.sweep(), 80)
+        self.assertEqual(cache.cache_non_ghost_count, 20)
+        self.assertFalse(sweeper.running)
+
+    def test_sweeper_sweep_bytes(self):
+        from persistent.picklecache import CacheSweeper
+        cache, load = self._makeEvictionCache('lru', 0)
+        objs = [load(i) for i in range(100)]
+        for p in objs:
+            cache.update_object_size_estimation(p._p_oid, 1)
+            p._p_estimated_size = 1
+        self.assertEqual(cache.total_estimated_size, 6400)
+
+        sweeper = CacheSweeper(cache, high_water_bytes=3200,
+                               low_water_bytes=640)
+        self.assertEqual(sweeper.sweep(), 90)
+        self.assertEqual(cache.total_estimated_size, 640)
+
+    def test_start_sweeper(self):
+        import time
+        cache, load = self._makeEvictionCache('lru', 20)
+        cache.jar._cache = cache
+        for i in range(100):
+            load(i)
+
+        sweeper = cache.start_sweeper(high_water=50, interval=0.001)
+        self.addCleanup(cache.stop_sweeper)
+        self.assertTrue(sweeper.running)
+        self.assertIs(sweeper.cache, cache)
+        deadline = time.time() + 10
+        while cache.cache_non_ghost_count > 21 and time.time() < deadline:
+            time.sleep(0.001)
+            # The Python implementation sweeps when we load an object.
+            load(100)._p_deactivate()
+        self.assertLessEqual(cache.cache_non_ghost_count, 21)
+
+        # Starting another one stops the first.
+        other = cache.start_sweeper(high_water=50)
+        self.assertFalse(sweeper.running)
+        self.assertTrue(other.running)
+        cache.stop_sweeper()
+        self.assertFalse(other.running)
+        cache.stop_sweeper()
+
+    def test_start_sweeper_while_accessing_objects(self):
+        # The thread using the cache keeps loading and accessing its
+        # objects while the sweeper ghostifies them.
+        import time
+        cache, load = self._makeEvictionCache('lru', 10)
+        cache.jar._cache = cache
+        for i in range(200):
+            load(i)
+        cache.start_sweeper(high_water=50, low_water=20, interval=0.001)
+        self.addCleanup(cache.stop_sweeper)
+        start = time.time()
+        i = 0
+        while (time.time() < start + 0.2
+               or not cache.cache_stats()['evictions']):
+            self.assertLess(time.time(), start + 10)
+            p = load(i % 300)
+            self.assertEqual(p.value, self._numbered_oid(i % 300))
+            if i % 5 == 0:
+                cache.invalidate(p._p_oid)
+            i += 7
+        cache.stop_sweeper()
+
+        # The ring still holds exactly the non-ghosts.
+        items = cache.lru_items()
+        self.assertEqual(len(items), cache.cache_non_ghost_count)
+        self.assertEqual(cache.ringlen(), cache.cache_non_ghost_count)
+        self.assertNotIn('ghost', [v._p_status for _, v in items])
+        self.assertEqual(
+            len([v for _, v in cache.items() if v._p_status != 'ghost']),
+            cache.cache_non_ghost_count)
+
+    def _start_sweeper_without_gil(self, cache):
+        had_is_gil_enabled = hasattr(sys, '_is_gil_enabled')
+        is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+        sys._is_gil_enabled = lambda: False
+        try:
+            return cache.start_sweeper(high_water=50)
+        finally:
+            if had_is_gil_enabled:
+                sys._is_gil_enabled = is_gil_enabled
+            else:
+                del sys._is_gil_enabled
+
+    def _makeMemoryFiles(self, files):
+        # Returns a directory containing the given files, a dict
+        # mapping relative paths to their contents.
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for path, contents in files.items():
+            path = os.path.join(root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(contents)
+        return root
+
+    def test_memory_controller(self):
+        cache, load = self._makeEvictionCache('lru', 0)
+        objs = [load(i) for i in range(100)]
+        for p in objs:
+            cache.update_object_size_estimation(p._p_oid, 1)
+            p._p_estimated_size = 1
+        root = self._makeMemoryFiles({'memory.max': '1000\n',
+                                      'memory.current': '900\n'})
+
+        def set_usage(usage):
+            with open(os.path.join(root, 'memory.current'), 'w') as f:
+                f.write('%d\n' % usage)
+
+        controller = cache.enable_memory_controller(
+            min_bytes=640, max_bytes=6000, step=0.5, interval=0,
+            cgroup_root=root, proc_root=root)
+        self.assertEqual(controller.initial_bytes, 0)
+
+        # Under pressure, the target drops to half of what we have.
+        cache.incrgc()
+        self.assertEqual((controller.usage, controller.limit), (900, 1000))
+        self.assertEqual(cache.cache_size_bytes, 3200)
+        self.assertEqual(cache.total_estimated_size, 3200)
+        self.assertEqual(cache.cache_non_ghost_count, 50)
+
+        # Between the watermarks, nothing changes.
+        set_usage(800)
+        cache.incrgc()
+        self.assertEqual(cache.cache_size_bytes, 3200)
+
+        # Without pressure, it grows, up to max_bytes.
+        set_usage(100)
+        cache.incrgc()
+        self.assertEqual(cache.cache_size_bytes, 4800)
+        cache.incrgc()
+        self.assertEqual(cache.cache_size_bytes, 6000)
+        # But not while the cache doesn't need the room.
+        cache.cache_size_bytes = 100000
+        cache.incrgc()
+        self.assertEqual(cache.cache_size_bytes, 100000)
+
+        # Until it is pressed down to min_bytes.
+        set_usage(1000)
+        for _ in range(5):
+            cache.incrgc()
+        self.assertEqual(cache.cache_size_bytes, 640)
+        self.assertEqual(cache.total_estimated_size, 640)
+
+        cache.disable_memory_controller()
+        self.assertEqual(cache.cache_size_bytes, 0)
+        set_usage(900)
+        cache.incrgc()
+        self.assertEqual(cache.cache_size_bytes, 0)
+        cache.disable_memory_controller()
+
+    def test_memory_controller_read_memory(self):
+        cache = self._makeOne()
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        proc = self._makeMemoryFiles({'meminfo': 'MemTotal:  16 kB\n',
+                                      'self/statm': '10 3 2 1 0 5 0\n'})
+        v1 = self._makeMemoryFiles({
+            'memory/memory.limit_in_bytes': '2000\n',
+            'memory/memory.usage_in_bytes': '500\n'})
+        unlimited = self._makeMemoryFiles({
+            'memory.max': 'max\n',
+            'memory.current': '500\n'})
+
+        controller = cache.enable_memory_controller(
+            interval=0, cgroup_root=v1, proc_root=proc)
+        self.assertEqual(controller.read_memory(), (500, 2000))
+
+        # Outside of a cgroup with a limit, the process and the system.
+        controller.cgroup_root = unlimited
+        self.assertEqual(controller.read_memory(), (3 * page_size, 16384))
+
+        controller.proc_root = unlimited
+        self.assertEqual(controller.read_memory(), (None, None))
+        self.assertEqual(controller.adjust(cache), 0)
+
+    def test_enable_memory_controller_invalid(self):
+        cache = self._makeOne()
+        with self.assertRaises(ValueError):
+            cache.enable_memory_controller(min_bytes=0)
+        with self.assertRaises(ValueError):
+            cache.enable_memory_controller(min_bytes=100, max_bytes=10)
+        with self.assertRaises(ValueError):
+            cache.enable_memory_controller(low_watermark=0.9,
+                                           high_watermark=0.8)
+        with self.assertRaises(ValueError):
+            cache.enable_memory_controller(high_watermark=1)
+        with self.assertRaises(ValueError):
+            cache.enable_memory_controller(step=1)
+        with self.assertRaises(ValueError):
+            cache.enable_memory_controller(interval=-1)
+
     def test_incrgc_w_smaller_drain_resistance(self):
         cache = self._makeOne()
         cache.cache_drain_resistance = 2
@@ -593,6 +871,227 @@ class PickleCacheTestMixin:
     def test_new_ghost_w_pclass_ghost(self):
         self._check_new_ghost_w_pclass_ghost()
 
+    def test_new_ghost_many(self):
+        from persistent.interfaces import GHOST
+
+        jar = DummyConnection()
+        cache = self._makeOne(jar)
+        candidates = [
+            (self._numbered_oid(i), self._makePersist(oid=None, jar=None))
+            for i in range(5)
+        ]
+        candidates[0][1]._p_activate()
+        cache.new_ghost_many(iter(candidates))
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(cache.ringlen(), 0)
+        for oid, candidate in candidates:
+            self.assertIs(cache.get(oid), candidate)
+            self.assertEqual(candidate._p_oid, oid)
+            self.assertEqual(candidate._p_jar, jar)
+            self.assertEqual(candidate._p_state, GHOST)
+        self.assertEqual(cache.cache_stats()['new_ghosts'], 5)
+
+        cache.new_ghost_many([])
+        self.assertEqual(len(cache), 5)
+
+    def test_new_ghost_many_all_or_nothing(self):
+        cache = self._makeOne()
+        existing = self._makePersist(oid=None, jar=None)
+        cache.new_ghost(b'oid', existing)
+
+        def check(exc, message, *pairs):
+            first = self._makePersist(oid=None, jar=None)
+            with self.assertRaisesRegex(exc, '^%s$' % message):
+                cache.new_ghost_many(((b'first', first),) + pairs)
+            self.assertIsNone(cache.get(b'first'))
+            self.assertIsNone(first._p_oid)
+            self.assertEqual(len(cache), 1)
+
+        check(ValueError, 'The given oid is already in the cache',
+              (b'oid', self._makePersist(oid=None, jar=None)))
+        check(ValueError, 'New ghost object must not have an oid',
+              (b'second', self._makePersist(oid=b'second')))
+        check(ValueError, 'New ghost object must not have a jar',
+              (b'second', self._makePersist(oid=None)))
+        check(ValueError, 'The same oid is given more than once',
+              (b'first', self._makePersist(oid=None, jar=None)))
+        other = self._makePersist(oid=None, jar=None)
+        check(ValueError, 'The same object is given more than once',
+              (b'second', other), (b'third', other))
+        check(TypeError, r'Cache values must be persistent objects\.',
+              (b'second', object()))
+        check(TypeError, r'new_ghost_many\(\) expects \(oid, object\) tuples',
+              (b'second',))
+
+    def test_new_ghost_many_rolls_back(self):
+        from persistent.interfaces import UPTODATE
+
+        class Refused(Exception):
+            pass
+
+        class Meta(type):
+            def __setattr__(cls, name, value):
+                if name == '_p_jar' and value is not None:
+                    raise Refused
+                type.__setattr__(cls, name, value)
+
+        class Pclass(metaclass=Meta):
+            _p_oid = None
+            _p_jar = None
+
+        cache = self._makeOne()
+        candidates = [
+            self._makePersist(oid=None, jar=None,
+                              kind=self._getRealPersistentClass())
+            for _ in range(2)
+        ]
+        with self.assertRaises(Refused):
+            cache.new_ghost_many([(b'a', candidates[0]),
+                                  (b'b', candidates[1]),
+                                  (b'c', Pclass)])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.cache_stats()['new_ghosts'], 0)
+        for candidate in candidates + [Pclass]:
+            self.assertIsNone(candidate._p_oid)
+            self.assertIsNone(candidate._p_jar)
+        for candidate in candidates:
+            self.assertEqual(candidate._p_state, UPTODATE)
+        # They can be added again.
+        cache.new_ghost_many([(b'a', candidates[0]), (b'b', candidates[1])])
+        self.assertEqual(len(cache), 2)
+
+    def _makeReifyCache(self, setstate_many=True):
+        # Returns the cache, the list of the jar's calls, and a list
+        # of ten ghosts in the cache.
+        calls = []
+
+        class Jar:
+            def setstate(self, obj):
+                calls.append(('setstate', obj._p_oid))
+                obj.__setstate__({'value': obj._p_oid})
+
+            def register(self, obj):
+                "Does nothing"
+
+        class BulkJar(Jar):
+            fail = False
+
+            def setstate_many(self, objects):
+                calls.append(('setstate_many', [o._p_oid for o in objects]))
+                for obj in objects:
+                    obj.__setstate__({'value': obj._p_oid})
+                if self.fail:
+                    raise ValueError('load failed')
+
+        class P(self._getRealPersistentClass()):
+            pass
+
+        jar = BulkJar() if setstate_many else Jar()
+        cache = self._getTargetClass()(jar, 100)
+        ghosts = [P() for _ in range(10)]
+        cache.new_ghost_many(
+            [(self._numbered_oid(i), p) for i, p in enumerate(ghosts)])
+        return cache, calls, ghosts
+
+    def test_reify_setstate_many(self):
+        from persistent.interfaces import UPTODATE
+        cache, calls, ghosts = self._makeReifyCache()
+        ghosts[0]._p_activate()
+        oids = [self._numbered_oid(i) for i in range(5)]
+        del calls[:]
+
+        cache.reify(oids)
+
+        # The ghosts were loaded in one call.
+        self.assertEqual(calls, [('setstate_many', oids[1:])])
+        for p in ghosts[:5]:
+            self.assertEqual(p._p_status, 'saved')
+            self.assertEqual(p._p_state, UPTODATE)
+            self.assertEqual(p.value, p._p_oid)
+        self.assertEqual(cache.cache_non_ghost_count, 5)
+        self.assertEqual(cache.ringlen(), 5)
+        self.assertEqual([oid for oid, _ in cache.lru_items()], oids)
+        self.assertEqual(ghosts[5]._p_status, 'ghost')
+
+        # Reifying objects that aren't ghosts does nothing.
+        del calls[:]
+        cache.reify(oids)
+        self.assertEqual(calls, [])
+        self.assertEqual(cache.cache_non_ghost_count, 5)
+
+    def test_reify_without_setstate_many(self):
+        cache, calls, ghosts = self._makeReifyCache(setstate_many=False)
+        oids = [self._numbered_oid(i) for i in range(3)]
+
+        cache.reify(oids)
+
+        self.assertEqual(calls, [('setstate', oid) for oid in oids])
+        self.assertEqual(cache.cache_non_ghost_count, 3)
+        self.assertEqual(cache.ringlen(), 3)
+        for p in ghosts[:3]:
+            self.assertEqual(p.value, p._p_oid)
+
+    def test_reify_size_estimator(self):
+        for setstate_many in (True, False):
+            cache, calls, ghosts = self._makeReifyCache(setstate_many)
+            estimated = []
+
+            def estimator(obj):
+                estimated.append(obj)
+                return 4096
+
+            cache.set_size_estimator(estimator)
+            cache.reify([self._numbered_oid(i) for i in range(3)])
+
+            self.assertEqual(estimated, ghosts[:3])
+            for p in ghosts[:3]:
+                self.assertEqual(p._p_estimated_size, 4160)
+            self.assertEqual(cache.total_estimated_size, 3 * 4160)
+
+    def test_reify_duplicate_oids(self):
+        for setstate_many in (True, False):
+            cache, calls, ghosts = self._makeReifyCache(setstate_many)
+            oids = [self._numbered_oid(i) for i in (1, 2, 1, 1)]
+            del calls[:]
+
+            cache.reify(oids)
+
+            if setstate_many:
+                self.assertEqual(calls, [('setstate_many', oids[:2])])
+            else:
+                self.assertEqual(calls, [('setstate', oid)
+                                         for oid in oids[:2]])
+            self.assertEqual(cache.cache_non_ghost_count, 2)
+            self.assertEqual(cache.ringlen(), 2)
+            self.assertEqual([oid for oid, _ in cache.lru_items()],
+                             oids[:2])
+            cache.minimize()
+            self.assertEqual(cache.cache_non_ghost_count, 0)
+            self.assertEqual(cache.ringlen(), 0)
+            self.assertEqual(ghosts[1]._p_status, 'ghost')
+
+    def test_reify_setstate_many_error(self):
+        cache, calls, ghosts = self._makeReifyCache()
+        ghosts[0]._p_activate()
+        cache.jar.fail = True
+
+        with self.assertRaises(ValueError):
+            cache.reify([self._numbered_oid(i) for i in range(5)])
+
+        # All of them are ghosts again; the object that wasn't one
+        # is untouched.
+        self.assertEqual(ghosts[0]._p_status, 'saved')
+        for p in ghosts[1:5]:
+            self.assertEqual(p._p_status, 'ghost')
+            self.assertNotIn('value', p.__dict__)
+        self.assertEqual(cache.cache_non_ghost_count, 1)
+        self.assertEqual(cache.ringlen(), 1)
+
+        cache.jar.fail = False
+        cache.reify(self._numbered_oid(1))
+        self.assertEqual(ghosts[1].value, self._numbered_oid(1))
+        self.assertEqual(cache.cache_non_ghost_count, 2)
+
     def test_invalidate_miss_single(self):
         KEY = b'123'
         cache = self._makeOne()
@@ -636,6 +1135,108 @@ class PickleCacheTestMixin:
         self.assertEqual(c1._p_state, GHOST)
         self.assertEqual(c2._p_state, GHOST)
 
+    def test_invalidate_summary(self):
+        from persistent.interfaces import CHANGED
+        from persistent.interfaces import GHOST
+
+        invalidated = []
+
+        class Custom(self._getRealPersistentClass()):
+            def _p_invalidate(self):
+                invalidated.append(self)
+                super()._p_invalidate()
+
+        class Pclass:
+            _p_oid = b'pclass'
+            _p_jar = DummyConnection()
+
+            @classmethod
+            def _p_invalidate(cls):
+                invalidated.append(cls)
+
+        jar = Pclass._p_jar
+        cache = self._makeOne(jar)
+        cache[Pclass._p_oid] = Pclass
+        plain = self._makePersist(oid=b'plain', jar=jar, state=UPTODATE)
+        changed = self._makePersist(oid=b'changed', jar=jar, state=CHANGED)
+        ghost = self._makePersist(oid=b'ghost', jar=jar, state=GHOST)
+        custom = self._makePersist(oid=b'custom', jar=jar, state=UPTODATE,
+                                   kind=Custom)
+        for obj in plain, changed, ghost, custom:
+            cache[obj._p_oid] = obj
+
+        self.assertEqual(
+            cache.invalidate((b'plain', b'changed', b'ghost', b'custom',
+                              b'pclass', b'missing')),
+            {'ghosted': 4, 'missing': 1, 'classes': 1})
+        for obj in plain, changed, ghost, custom:
+            self.assertEqual(obj._p_state, GHOST)
+        self.assertEqual(len(invalidated), 2)
+        self.assertIn(Pclass, invalidated)
+        self.assertIn(custom, invalidated)
+        self.assertEqual(cache.ringlen(), 0)
+        self.assertEqual(cache.cache_non_ghost_count, 0)
+        self.assertEqual(cache.cache_stats()['invalidations'], 5)
+
+        self.assertEqual(cache.invalidate(b'missing'),
+                         {'ghosted': 0, 'missing': 1, 'classes': 0})
+        self.assertEqual(cache.invalidate({b'plain', b'missing'}),
+                         {'ghosted': 1, 'missing': 1, 'classes': 0})
+
+    def test_invalidate_classes(self):
+        from persistent.interfaces import GHOST
+        cache, A, B, load = self._makeClassCache(100)
+
+        class C(A):
+            pass
+
+        objs = [load((A, B, C)[i % 3], i) for i in range(9)]
+        ghost = B()
+        cache.new_ghost(self._numbered_oid(9), ghost)
+        self.assertEqual(cache.invalidate_classes([A]), 6)
+        self.assertEqual([p._p_state == GHOST for p in objs],
+                         [True, False, True] * 3)
+        self.assertEqual(cache.cache_non_ghost_count, 3)
+        self.assertEqual(cache.ringlen(), 3)
+        self.assertEqual(cache.class_stats(), {B: (3, 0)})
+        self.assertEqual(cache.cache_stats()['invalidations'], 6)
+
+        self.assertEqual(cache.invalidate_classes([A]), 0)
+        self.assertEqual(cache.invalidate_classes(()), 0)
+        with self.assertRaises(TypeError):
+            cache.invalidate_classes([objs[0]])
+        self.assertEqual(cache.invalidate_classes((A, B)), 3)
+        self.assertEqual(cache.ringlen(), 0)
+
+    def test_invalidate_where(self):
+        from persistent.interfaces import GHOST
+        cache, A, B, load = self._makeClassCache(100)
+        objs = [load(A, i) for i in range(6)]
+        seen = []
+
+        def predicate(obj):
+            seen.append(obj)
+            if obj is objs[0]:
+                # Invalidating an object we haven't seen yet.
+                cache.invalidate(objs[1]._p_oid)
+            return obj.value in (objs[0]._p_oid, objs[4]._p_oid)
+
+        self.assertEqual(cache.invalidate_where(predicate), 2)
+        self.assertEqual(seen, [objs[0]] + objs[2:])
+        self.assertEqual([p._p_state == GHOST for p in objs],
+                         [True, True, False, False, True, False])
+        self.assertEqual(cache.cache_non_ghost_count, 3)
+        self.assertEqual(cache.ringlen(), 3)
+
+        with self.assertRaises(TypeError):
+            cache.invalidate_where(None)
+
+        def error(obj):
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            cache.invalidate_where(error)
+
     def _check_debug_info_w_persistent_class(self):
         KEY = b'pclass'
 
@@ -776,6 +1377,1094 @@ class PickleCacheTestMixin:
         del raw
         self.assertEqual(1, len(cache))
 
+    def test_eviction_policy_default(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.eviction_policy, 'lru')
+
+    def test_eviction_policy_unknown(self):
+        with self.assertRaises(ValueError):
+            self._getTargetClass()(DummyConnection(), 10,
+                                   eviction_policy='mru')
+
+    def _makeEvictionCache(self, policy, target_size):
+        # Returns the cache and a function that loads (activates) the
+        # object with the given number.
+
+        class Jar:
+            def setstate(self, obj):
+                obj.__setstate__({'value': obj._p_oid})
+
+            def register(self, obj):
+                "Does nothing"
+
+        class P(self._getRealPersistentClass()):
+            pass
+
+        jar = Jar()
+        cache = self._getTargetClass()(jar, target_size,
+                                       eviction_policy=policy)
+        self.assertEqual(cache.eviction_policy, policy)
+
+        def load(i):
+            oid = self._numbered_oid(i)
+            try:
+                p = cache[oid]
+            except KeyError:
+                p = P()
+                cache.new_ghost(oid, p)
+            p._p_activate()
+            return p
+
+        return cache, load
+
+    def _check_scan_resistance(self, policy):
+        cache, load = self._makeEvictionCache(policy, 10)
+        hot = [load(i) for i in range(5)]
+        load(5)
+        for p in hot:
+            p.value  # access it again
+        scanned = []
+        for i in range(100, 120):
+            scanned.append(load(i))
+            scanned[-1].value
+        self.assertEqual(cache.cache_non_ghost_count, 26)
+        self.assertEqual(cache.ringlen(), 26)
+        self.assertEqual(len(cache.lru_items()), 26)
+
+        cache.incrgc()
+
+        self.assertEqual(cache.cache_non_ghost_count, 10)
+        return [p._p_status for p in hot]
+
+    def test_incrgc_lru_not_scan_resistant(self):
+        self.assertEqual(self._check_scan_resistance('lru'),
+                         ['ghost'] * 5)
+
+    def test_incrgc_slru_scan_resistant(self):
+        self.assertEqual(self._check_scan_resistance('slru'),
+                         ['saved'] * 5)
+
+    def test_incrgc_2q_scan_resistant(self):
+        self.assertEqual(self._check_scan_resistance('2q'),
+                         ['saved'] * 5)
+
+    def test_incrgc_arc_scan_resistant(self):
+        self.assertEqual(self._check_scan_resistance('arc'),
+                         ['saved'] * 5)
+
+    def test_segmented_lru_items_probation_first(self):
+        cache, load = self._makeEvictionCache('slru', 10)
+        objs = [load(i) for i in range(4)]
+        objs[1].value
+        objs[0].value
+        self.assertEqual([oid for oid, _ in cache.lru_items()],
+                         [self._numbered_oid(i) for i in (2, 3, 1, 0)])
+
+    def _check_history_promotion(self, policy):
+        cache, load = self._makeEvictionCache(policy, 3)
+        objs = [load(i) for i in range(4)]
+        cache.incrgc()
+        self.assertEqual(objs[0]._p_status, 'ghost')
+
+        # Loading it again soon after it was evicted...
+        load(0)
+        cache.invalidate([p._p_oid for p in objs[1:]])
+        objs.extend(load(i) for i in range(4, 8))
+        cache.incrgc()
+        self.assertEqual(cache.cache_non_ghost_count, 3)
+        return objs[0]._p_status
+
+    def test_incrgc_slru_no_history(self):
+        self.assertEqual(self._check_history_promotion('slru'), 'ghost')
+
+    def test_incrgc_2q_history_promotes(self):
+        # ...makes it survive the next incremental collection.
+        self.assertEqual(self._check_history_promotion('2q'), 'saved')
+
+    def test_incrgc_arc_history_promotes(self):
+        self.assertEqual(self._check_history_promotion('arc'), 'saved')
+
+    def _makeClassCache(self, target_size):
+        # Returns the cache, two persistent classes and a function that
+        # loads (activates) an object of the given class and number.
+
+        class Jar:
+            def setstate(self, obj):
+                obj.__setstate__({'value': obj._p_oid})
+
+            def register(self, obj):
+                "Does nothing"
+
+        class A(self._getRealPersistentClass()):
+            pass
+
+        class B(self._getRealPersistentClass()):
+            pass
+
+        cache = self._getTargetClass()(Jar(), target_size)
+
+        def load(klass, i):
+            p = klass()
+            cache.new_ghost(self._numbered_oid(i), p)
+            p._p_activate()
+            return p
+
+        return cache, A, B, load
+
+    def test_class_stats(self):
+        cache, A, B, load = self._makeClassCache(100)
+        self.assertEqual(cache.class_stats(), {})
+        objs = [load(A, i) for i in range(3)] + [load(B, 3)]
+        self.assertEqual(cache.class_stats(), {A: (3, 0), B: (1, 0)})
+
+        cache.update_object_size_estimation(objs[0]._p_oid, 640)
+        objs[0]._p_estimated_size = 640
+        self.assertEqual(cache.class_stats(), {A: (3, 704), B: (1, 0)})
+
+        cache.invalidate([objs[0]._p_oid, objs[3]._p_oid])
+        self.assertEqual(cache.class_stats(), {A: (2, 0)})
+
+    def test_sample(self):
+        cache, A, B, load = self._makeClassCache(100)
+        self.assertEqual(cache.sample(3), [])
+        objs = [load(A, i) for i in range(6)] + [load(B, 6)]
+        ghost = B()
+        cache.new_ghost(self._numbered_oid(7), ghost)
+
+        sample = cache.sample(3)
+        self.assertEqual(len(sample), 3)
+        self.assertEqual(len({id(obj) for obj in sample}), 3)
+        for obj in sample:
+            self.assertIn(obj, objs)
+        self.assertEqual(sorted(cache.sample(100), key=id),
+                         sorted(objs, key=id))
+        self.assertEqual(sorted(cache.sample(100, ghosts=True), key=id),
+                         sorted(objs + [ghost], key=id))
+        self.assertEqual(cache.sample(0), [])
+
+        # Every object can be chosen.
+        chosen = set()
+        for _ in range(1000):
+            chosen.update(id(obj) for obj in cache.sample(1))
+        self.assertEqual(chosen, {id(obj) for obj in objs})
+        with self.assertRaises(ValueError):
+            cache.sample(-1)
+
+    def test_estimate_composition(self):
+        cache, A, B, load = self._makeClassCache(100)
+        self.assertEqual(cache.estimate_composition(10), {})
+        objs = [load(A, i) for i in range(30)] + [load(B, 30)]
+        for obj in objs:
+            # What a jar does when loading them.
+            cache.update_object_size_estimation(obj._p_oid, 128)
+            obj._p_estimated_size = 128
+        stats = cache.class_stats()
+        self.assertEqual(cache.estimate_composition(100), stats)
+        size_of_one = stats[A][1] // 30
+        self.assertEqual(stats[B][1], size_of_one)
+
+        estimate = cache.estimate_composition(10)
+        count = sum(count for count, _ in estimate.values())
+        self.assertLessEqual(abs(count - 31), len(estimate))
+        for klass, (count, size) in estimate.items():
+            # Both are rounded.
+            self.assertLess(abs(size - count * size_of_one), size_of_one)
+        self.assertEqual(cache.estimate_composition(0), {})
+
+    def test_pin_and_priorities(self):
+        from persistent.interfaces import GHOST
+        from persistent.interfaces import UPTODATE
+        cache, A, B, load = self._makeClassCache(2)
+        objs = [load(A, i) for i in range(5)]
+        oids = [obj._p_oid for obj in objs]
+        self.assertEqual(cache.priorities(), {})
+        cache.pin(oids[0])
+        cache.set_priority(oids[1], 2)
+        cache.set_priority(oids[2], 1)
+        self.assertEqual(cache.priorities(),
+                         {oids[0]: None, oids[1]: 2, oids[2]: 1})
+
+        # The policy only gets objects with priority 0; then the lowest
+        # priority goes first.
+        cache.incrgc()
+        self.assertEqual([obj._p_state for obj in objs],
+                         [UPTODATE, UPTODATE, GHOST, GHOST, GHOST])
+        cache.cache_size = 1
+        cache.incrgc()
+        self.assertEqual(objs[1]._p_state, GHOST)
+        self.assertEqual(objs[0]._p_state, UPTODATE)
+
+        # Only pins survive full sweeps.
+        objs[1].value
+        cache.full_sweep()
+        self.assertEqual(self._lru_numbers(cache), [0])
+        cache.minimize()
+        self.assertEqual(self._lru_numbers(cache), [0])
+        cache.set_class_quota(A, 0)
+        cache.incrgc()
+        self.assertEqual(self._lru_numbers(cache), [0])
+        cache.set_class_quota(A, None)
+
+        # But invalidations don't care.
+        cache.invalidate(oids[0])
+        self.assertEqual(objs[0]._p_state, GHOST)
+
+        objs[0].value
+        cache.unpin(oids[0])
+        cache.unpin(oids[3])
+        cache.set_priority(oids[1], 0)
+        cache.set_priority(oids[3], 0)
+        self.assertEqual(cache.priorities(), {oids[2]: 1})
+        cache.full_sweep()
+        self.assertEqual(self._lru_numbers(cache), [])
+
+        # Pinning and setting a priority replace each other.
+        cache.pin(oids[2])
+        self.assertEqual(cache.priorities(), {oids[2]: None})
+        cache.unpin(oids[2])
+        self.assertEqual(cache.priorities(), {})
+        with self.assertRaises(ValueError):
+            cache.set_priority(oids[2], -1)
+
+    def test_set_class_quota(self):
+        cache, A, B, load = self._makeClassCache(100)
+        self.assertEqual(cache.class_quotas(), {})
+        cache.set_class_quota(A, 2)
+        self.assertEqual(cache.class_quotas(), {A: 2})
+
+        objs = [load(A if i % 2 else B, i) for i in range(10)]
+        self.assertEqual(cache.class_stats(), {A: (5, 0), B: (5, 0)})
+
+        # The cache is far from full, but A is over its quota, so its
+        # least recently used objects go.
+        cache.incrgc()
+        self.assertEqual(cache.class_stats(), {A: (2, 0), B: (5, 0)})
+        self.assertEqual([p._p_status for p in objs if isinstance(p, A)],
+                         ['ghost', 'ghost', 'ghost', 'saved', 'saved'])
+        self.assertEqual(cache.cache_stats()['evictions'], 3)
+
+        # Without a quota, they stay until the cache is full.
+        cache.set_class_quota(A, None)
+        self.assertEqual(cache.class_quotas(), {})
+        objs[1]._p_activate()
+        cache.incrgc()
+        self.assertEqual(cache.class_stats(), {A: (3, 0), B: (5, 0)})
+
+    def test_set_class_quota_invalid(self):
+        cache, A, B, load = self._makeClassCache(100)
+        with self.assertRaises(TypeError):
+            cache.set_class_quota(A(), 1)
+        with self.assertRaises(ValueError):
+            cache.set_class_quota(A, -1)
+        # Removing a quota that doesn't exist is fine.
+        cache.set_class_quota(B, None)
+        self.assertEqual(cache.class_quotas(), {})
+
+    def _makeGhostParents(self, count):
+        # Returns a cache, two persistent classes and count loaded
+        # objects of class A. Each of them refers to two ghosts of
+        # class B, which it looks up or creates while it is loaded,
+        # like the persistent_load of a jar.
+        test = self
+
+        class Jar:
+            def setstate(self, obj):
+                state = {}
+                if isinstance(obj, A):
+                    i = int(obj._p_oid[4:])
+                    for j in range(2):
+                        oid = test._numbered_oid(100 + 2 * i + j)
+                        child = cache.get(oid)
+                        if child is None:
+                            child = B()
+                            cache.new_ghost(oid, child)
+                        state['child%d' % j] = child
+                obj.__setstate__(state)
+
+        class A(self._getRealPersistentClass()):
+            pass
+
+        class B(self._getRealPersistentClass()):
+            pass
+
+        jar = Jar()
+        cache = jar._cache = self._getTargetClass()(jar, 100)
+        parents = []
+        for i in range(count):
+            parent = A()
+            cache.new_ghost(self._numbered_oid(i), parent)
+            parent._p_activate()
+            parents.append(parent)
+        return cache, A, B, parents
+
+    def test_ghost_stats(self):
+        cache, A, B, parents = self._makeGhostParents(0)
+        self.assertEqual(cache.ghost_stats(), {})
+        self.assertEqual(cache.cache_ghost_count, 0)
+        cache, A, B, parents = self._makeGhostParents(3)
+        self.assertEqual(cache.cache_ghost_count, 6)
+        stats = cache.ghost_stats()
+        self.assertEqual(list(stats), [B])
+        count, size = stats[B]
+        self.assertEqual(count, 6)
+        self.assertGreater(size, 0)
+
+        cache.invalidate([parents[0]._p_oid])
+        self.assertEqual(cache.cache_ghost_count, 5)
+        self.assertEqual(cache.ghost_stats()[A][0], 1)
+
+    def test_set_ghost_limit(self):
+        cache, A, B, parents = self._makeGhostParents(3)
+        # This one is the least recently used, but refers to no ghosts.
+        other = B()
+        cache.new_ghost(self._numbered_oid(99), other)
+        other._p_activate()
+        for p in parents:
+            p.child0  # access it again
+        cache.set_ghost_limit(4)
+
+        # The least recently used objects referring to ghosts go, until
+        # there are few enough ghosts (counting those objects).
+        cache.incrgc()
+        self.assertEqual([p._p_status for p in parents],
+                         ['ghost', 'ghost', 'saved'])
+        self.assertEqual(other._p_status, 'saved')
+        self.assertEqual(cache.cache_ghost_count, 4)
+        stats = cache.cache_stats()
+        self.assertEqual(stats['ghost_limit_exceeded'], 1)
+        self.assertEqual(stats['ghost_releases'], 2)
+
+        cache.incrgc()
+        self.assertEqual(parents[2]._p_status, 'saved')
+        self.assertEqual(cache.cache_stats()['ghost_limit_exceeded'], 1)
+
+        # Without a limit, ghosts stay.
+        cache.set_ghost_limit(None)
+        cache.set_ghost_limit(0)
+        cache.set_ghost_limit(None)
+        cache.incrgc()
+        self.assertEqual(parents[2]._p_status, 'saved')
+
+    def test_set_ghost_limit_goes_by_last_load(self):
+        cache, A, B, parents = self._makeGhostParents(2)
+        # Loaded again, the first looks its ghosts up.
+        children = [parents[0].child0, parents[0].child1]
+        parents[0]._p_invalidate()
+        parents[0]._p_activate()
+        # The second finds its children up-to-date.
+        for child in (parents[1].child0, parents[1].child1):
+            child._p_activate()
+        parents[1]._p_invalidate()
+        parents[1]._p_activate()
+
+        cache.set_ghost_limit(0)
+        cache.incrgc()
+        self.assertEqual([p._p_status for p in parents], ['ghost', 'saved'])
+        self.assertEqual([p._p_status for p in children], ['ghost', 'ghost'])
+        self.assertEqual(cache.cache_stats()['ghost_releases'], 1)
+
+    def test_set_ghost_limit_no_release(self):
+        cache, A, B, parents = self._makeGhostParents(3)
+        cache.set_ghost_limit(0, release=False)
+        cache.incrgc()
+        self.assertEqual([p._p_status for p in parents],
+                         ['saved', 'saved', 'saved'])
+        stats = cache.cache_stats()
+        self.assertEqual(stats['ghost_limit_exceeded'], 1)
+        self.assertEqual(stats['ghost_releases'], 0)
+
+    def test_set_ghost_limit_invalid(self):
+        cache = self._makeOne()
+        with self.assertRaises(ValueError):
+            cache.set_ghost_limit(-1)
+
+    def test_set_size_estimator(self):
+        cache, A, B, load = self._makeClassCache(100)
+        estimated = []
+
+        def estimator(obj):
+            estimated.append(obj)
+            return 1000
+
+        cache.set_size_estimator(estimator, A)
+        # Keeping the jar's estimate.
+        cache.set_size_estimator(lambda obj: None)
+        a = load(A, 0)
+        b = load(B, 1)
+        self.assertEqual(estimated, [a])
+        self.assertEqual(a._p_estimated_size, 1024)
+        self.assertEqual(b._p_estimated_size, 0)
+        self.assertEqual(cache.total_estimated_size, 1024)
+        self.assertEqual(cache.class_stats(), {A: (1, 1024), B: (1, 0)})
+
+        cache.set_size_estimator(None, A)
+        self.assertEqual(load(A, 2)._p_estimated_size, 0)
+        cache.set_size_estimator(None)
+        cache.set_size_estimator(None)
+        self.assertEqual(load(B, 3)._p_estimated_size, 0)
+        self.assertEqual(estimated, [a])
+
+    def _makeSizedCache(self, sizes, **kwargs):
+        # Returns a cache whose jar sets the sizes of the objects it
+        # loads from the sizes dict, like ZODB does, and a function that
+        # loads the object with the given number.
+
+        class Jar:
+            def setstate(self, obj):
+                obj.__setstate__({'value': obj._p_oid})
+                size = sizes[obj._p_oid]
+                cache.update_object_size_estimation(obj._p_oid, size)
+                obj._p_estimated_size = size
+
+            def register(self, obj):
+                "Does nothing"
+
+        class P(self._getRealPersistentClass()):
+            pass
+
+        cache = self._getTargetClass()(Jar(), 100, **kwargs)
+
+        def load(i):
+            p = P()
+            cache.new_ghost(self._numbered_oid(i), p)
+            p._p_activate()
+            return p
+
+        return cache, load
+
+    def test_exact_sizes(self):
+        sizes = [1, 10, 100, 3 << 30]
+        cache, load = self._makeSizedCache(
+            {self._numbered_oid(i): size for i, size in enumerate(sizes)},
+            exact_sizes=True)
+        self.assertTrue(cache.exact_sizes)
+        objs = [load(i) for i in range(len(sizes))]
+        self.assertEqual(cache.total_estimated_size, sum(sizes))
+        self.assertEqual(cache.class_stats(),
+                         {type(objs[0]): (4, sum(sizes))})
+        # The objects' own estimates are rounded, as always.
+        self.assertEqual(objs[0]._p_estimated_size, 64)
+        self.assertEqual(objs[3]._p_estimated_size, 16777215 * 64)
+
+        cache.invalidate(objs[3]._p_oid)
+        self.assertEqual(cache.total_estimated_size, 111)
+        cache.cache_size_bytes = 100
+        cache.incrgc()
+        self.assertEqual(cache.total_estimated_size, 100)
+        self.assertEqual(cache.cache_stats()['bytes_reclaimed'], 11)
+
+    def test_exact_sizes_above_4gb(self):
+        sizes = [5 << 30, (1 << 32) + 1]
+        cache, load = self._makeSizedCache(
+            {self._numbered_oid(i): size for i, size in enumerate(sizes)},
+            exact_sizes=True)
+        objs = [load(i) for i in range(len(sizes))]
+        self.assertEqual(cache.total_estimated_size, sum(sizes))
+        self.assertEqual(cache.class_stats(),
+                         {type(objs[0]): (2, sum(sizes))})
+        cache.update_object_size_estimation(objs[0]._p_oid, 7 << 30)
+        self.assertEqual(cache.total_estimated_size, (7 << 30) + sizes[1])
+
+    def test_exact_sizes_off(self):
+        sizes = [1, 10, 100, 3 << 30]
+        cache, load = self._makeSizedCache(
+            {self._numbered_oid(i): size for i, size in enumerate(sizes)})
+        self.assertFalse(cache.exact_sizes)
+        for i in range(len(sizes)):
+            load(i)
+        self.assertEqual(cache.total_estimated_size,
+                         64 + 64 + 128 + 16777215 * 64)
+
+    def _lru_numbers(self, cache):
+        return [int(oid[4:]) for oid, _ in cache.lru_items()]
+
+    def test_set_access_buffer(self):
+        cache, A, B, load = self._makeClassCache(100)
+        self.assertEqual(cache.access_buffer_size, 0)
+        objs = [load(A, i) for i in range(4)]
+        cache.set_access_buffer(2)
+        self.assertEqual(cache.access_buffer_size, 2)
+        for i in (0, 1, 0):
+            objs[i].value
+        # The third access drained the first two.
+        self.assertEqual(self._lru_numbers(cache), [2, 3, 1, 0])
+
+        # Ghostified objects are skipped.
+        objs[2].value
+        objs[3].value
+        cache.invalidate(objs[2]._p_oid)
+        self.assertEqual(self._lru_numbers(cache), [1, 0, 3])
+
+        # So are deallocated ones.
+        objs[3].value
+        oid = objs[3]._p_oid
+        del objs[3]
+        cache.invalidate(oid)
+        gc.collect()
+        self.assertIsNone(cache.get(oid))
+        objs[1].value
+        self.assertEqual(self._lru_numbers(cache), [0, 1])
+
+        # incrgc() drains the buffer first.
+        objs[0].value
+        cache.cache_size = 1
+        cache.incrgc()
+        self.assertEqual(self._lru_numbers(cache), [0])
+
+        cache.set_access_buffer(0)
+        self.assertEqual(cache.access_buffer_size, 0)
+        objs[1].value
+        objs[0].value
+        self.assertEqual(self._lru_numbers(cache), [1, 0])
+        with self.assertRaises(ValueError):
+            cache.set_access_buffer(-1)
+
+    def test_set_trace_hook(self):
+        cache, A, B, load = self._makeClassCache(1)
+        self.assertIsNone(cache.trace_hook)
+        events = []
+
+        def hook(event, oid, klass, duration, cause):
+            events.append((event, int(oid[4:]), klass, cause))
+            if event == 'activate':
+                self.assertIsInstance(duration, float)
+                self.assertGreaterEqual(duration, 0)
+            else:
+                self.assertIsNone(duration)
+
+        cache.set_trace_hook(hook)
+        self.assertIs(cache.trace_hook, hook)
+        objs = [load(A, 0), load(B, 1)]
+        objs[0].value = 42
+        objs[1]._p_deactivate()
+        objs[1].value
+        cache.incrgc()
+        cache.invalidate(objs[0]._p_oid)
+        cache.invalidate_classes([B])
+        self.assertEqual(events, [
+            ('activate', 0, A, None),
+            ('activate', 1, B, None),
+            ('register', 0, A, None),
+            ('ghostify', 1, B, None),
+            ('activate', 1, B, None),
+            ('ghostify', 1, B, 'evict'),
+            ('ghostify', 0, A, 'invalidate'),
+        ])
+
+        # Errors don't get in the way.
+        unraisable = []
+        old_hook = sys.unraisablehook
+        sys.unraisablehook = unraisable.append
+        try:
+            cache.set_trace_hook(lambda *args: 1 / 0)
+            objs[0].value
+        finally:
+            sys.unraisablehook = old_hook
+        self.assertEqual(objs[0].value, objs[0]._p_oid)
+        self.assertEqual(len(unraisable), 1)
+        self.assertIs(unraisable[0].exc_type, ZeroDivisionError)
+
+        del events[:]
+        cache.set_trace_hook(None)
+        self.assertIsNone(cache.trace_hook)
+        cache.invalidate(objs[0]._p_oid)
+        objs[0].value
+        self.assertEqual(events, [])
+        with self.assertRaises(TypeError):
+            cache.set_trace_hook(42)
+
+    def test_set_trace_hook_reify(self):
+        cache, calls, ghosts = self._makeReifyCache()
+        events = []
+        cache.set_trace_hook(
+            lambda event, oid, klass, duration, cause: events.append(
+                (event, oid, cause)))
+        oids = [self._numbered_oid(i) for i in range(2)]
+        cache.reify(oids)
+        self.assertEqual(events, [('activate', oid, 'reify') for oid in oids])
+        # Tracing doesn't count as looking the objects up.
+        self.assertEqual(cache.cache_stats()['hits'], 0)
+
+    def test_activation_histogram(self):
+        from persistent import picklecache
+        cache, A, B, load = self._makeClassCache(100)
+        self.assertEqual(cache.activation_histogram(),
+                         {'activations': 0, 'classes': {}})
+        cache.set_activation_histogram(True)
+        objs = [load(A, i) for i in range(3)] + [load(B, 3)]
+        histogram = cache.activation_histogram()
+        self.assertEqual(histogram['activations'], 4)
+        self.assertEqual(set(histogram['classes']), {A, B})
+        counts = histogram['classes'][A]
+        self.assertEqual(counts['activations'], 3)
+        self.assertEqual(sum(counts['buckets'].values()), 3)
+        for bound in counts['buckets']:
+            self.assertIn(bound, [picklecache._activation_bound(i) for i in
+                                  range(picklecache._ACTIVATION_BUCKETS)])
+
+        # Objects that are already loaded aren't counted again.
+        objs[0].value
+        self.assertEqual(cache.activation_histogram(reset=True), histogram)
+        self.assertEqual(cache.activation_histogram(),
+                         {'activations': 0, 'classes': {}})
+
+        cache.invalidate(objs[3]._p_oid)
+        objs[3].value
+        histogram = cache.activation_histogram()
+        self.assertEqual(histogram['activations'], 1)
+        self.assertEqual(histogram['classes'][B]['activations'], 1)
+
+        cache.set_activation_histogram(False)
+        cache.invalidate(objs[3]._p_oid)
+        objs[3].value
+        self.assertEqual(cache.activation_histogram(),
+                         {'activations': 0, 'classes': {}})
+
+    def test_activation_histogram_reify(self):
+        cache, calls, ghosts = self._makeReifyCache()
+        cache.set_activation_histogram(True)
+        cache.reify([self._numbered_oid(i) for i in range(4)])
+        histogram = cache.activation_histogram()
+        self.assertEqual(histogram['activations'], 4)
+        self.assertEqual(
+            histogram['classes'][type(ghosts[0])]['activations'], 4)
+
+    def test_state_store(self):
+        from persistent.picklecache import PickleStateStore
+        store = PickleStateStore()
+        jar = DummyConnection()
+        cache = self._getTargetClass()(jar, 10, state_store=store)
+        self.assertIs(cache.state_store, store)
+        self.assertIsNone(self._makeOne().state_store)
+        from persistent.interfaces import GHOST
+        oids = [self._numbered_oid(i) for i in range(5)]
+        objs = [self._makePersist(oid=oid) for oid in oids[:3]]
+        for obj in objs:
+            cache[obj._p_oid] = obj
+        for oid in oids:
+            store.set(oid, b'serial', b'state')
+
+        cache.invalidate(oids[0])
+        self.assertIsNone(store.get(oids[0], b'serial'))
+        self.assertEqual(objs[0]._p_state, GHOST)
+        to_invalidate = [oids[1], oids[3]]
+        result = cache.invalidate(to_invalidate)
+        self.assertEqual(result, {'ghosted': 1, 'missing': 1, 'classes': 0})
+        self.assertIsNone(store.get(oids[1], b'serial'))
+        self.assertIsNone(store.get(oids[3], b'serial'))
+        cache.invalidate(iter(oids[2:4]))
+        self.assertEqual(objs[2]._p_state, GHOST)
+        self.assertIsNone(store.get(oids[2], b'serial'))
+        self.assertEqual(store.get(oids[4], b'serial'), b'state')
+
+        cache.state_store = None
+        cache.invalidate(oids[4])
+        self.assertEqual(store.get(oids[4], b'serial'), b'state')
+
+    def test_state_store_through_jar(self):
+        # Caches sharing a store save loads when their jars use it.
+        import pickle
+
+        from persistent.picklecache import PickleStateStore
+        storage = {self._numbered_oid(i): (pickle.dumps({'value': i}),
+                                           b'serial_%d' % i)
+                   for i in range(3)}
+        loads = []
+
+        class Jar:
+            def setstate(self, obj):
+                oid = obj._p_oid
+                store = self._cache.state_store
+                found = store.get_latest(oid)
+                if found is None:
+                    loads.append(oid)
+                    state, serial = storage[oid]
+                    store.set(oid, serial, state)
+                else:
+                    state, serial = found
+                obj._p_serial = serial
+                obj.__setstate__(pickle.loads(state))
+
+        class P(self._getRealPersistentClass()):
+            pass
+
+        store = PickleStateStore()
+
+        def load(cache, i):
+            p = P()
+            cache.new_ghost(self._numbered_oid(i), p)
+            self.assertEqual(p.value, i)
+            return p
+
+        caches = []
+        for _ in range(2):
+            jar = Jar()
+            jar._cache = self._getTargetClass()(jar, 10, state_store=store)
+            caches.append(jar._cache)
+        p = load(caches[0], 0)
+        self.assertEqual(p._p_serial, b'serial_0')
+        load(caches[0], 1)
+        self.assertEqual(loads, [self._numbered_oid(0),
+                                 self._numbered_oid(1)])
+        p = load(caches[1], 0)
+        self.assertEqual(p._p_serial, b'serial_0')
+        load(caches[1], 1)
+        self.assertEqual(len(loads), 2)
+
+        # Invalidating an object in one cache makes the other load it
+        # from storage again.
+        storage[self._numbered_oid(0)] = (pickle.dumps({'value': 0}),
+                                          b'serial_9')
+        caches[0].invalidate(self._numbered_oid(0))
+        caches[1].invalidate(self._numbered_oid(0))
+        self.assertEqual(caches[1][self._numbered_oid(0)].value, 0)
+        self.assertEqual(caches[1][self._numbered_oid(0)]._p_serial,
+                         b'serial_9')
+        self.assertEqual(loads[2:], [self._numbered_oid(0)])
+
+    def test_set_size_estimator_errors(self):
+        cache, A, B, load = self._makeClassCache(100)
+        with self.assertRaises(TypeError):
+            cache.set_size_estimator(42)
+        with self.assertRaises(TypeError):
+            cache.set_size_estimator(len, A())
+
+        def error(obj):
+            raise KeyError(obj)
+
+        def negative(obj):
+            return -1
+
+        # Errors are reported as unraisable; the object is loaded and
+        # keeps the jar's estimate.
+        unraisable = []
+        old_hook = sys.unraisablehook
+        sys.unraisablehook = unraisable.append
+        try:
+            cache.set_size_estimator(error, A)
+            a = load(A, 0)
+            cache.set_size_estimator(negative, A)
+            b = load(A, 1)
+        finally:
+            sys.unraisablehook = old_hook
+        self.assertEqual([(u.exc_type, u.object) for u in unraisable],
+                         [(KeyError, error), (ValueError, negative)])
+        for obj in a, b:
+            self.assertEqual(obj._p_status, 'saved')
+            self.assertEqual(obj._p_estimated_size, 0)
+        self.assertEqual(cache.total_estimated_size, 0)
+        self.assertEqual(cache.cache_non_ghost_count, 2)
+
+    def test_estimate_state_size(self):
+        import sys
+
+        from persistent.picklecache import estimate_state_size
+        cache, A, B, load = self._makeClassCache(100)
+        a = load(A, 0)
+        b = load(B, 1)
+        self.assertEqual(estimate_state_size(a, 0),
+                         sys.getsizeof(a) + sys.getsizeof(a.__getstate__()))
+        before = estimate_state_size(a)
+        a.b = b
+        a.items = [str(i) * 100 for i in range(10)]
+        # The persistent object doesn't count, but the strings in the
+        # list do.
+        self.assertGreater(estimate_state_size(a),
+                           before + sum(map(sys.getsizeof, a.items)))
+        self.assertLess(estimate_state_size(a, 1),
+                        estimate_state_size(a))
+
+        cache.set_size_estimator(estimate_state_size)
+        cache.invalidate(a._p_oid)
+        a._p_activate()
+        self.assertEqual(a._p_estimated_size,
+                         (estimate_state_size(a) // 64 + 1) * 64)
+
+    def test_iter_lru_items(self):
+        cache, A, _, load = self._makeClassCache(100)
+        self.assertEqual(list(cache.iter_lru_items()), [])
+        objs = [load(A, i) for i in range(5)]
+        self.assertEqual(list(cache.iter_lru_items()), cache.lru_items())
+        self.assertEqual([p for _, p in cache.iter_lru_items(limit=2)],
+                         objs[:2])
+        self.assertEqual(list(cache.iter_lru_items(0)), [])
+        with self.assertRaises(ValueError):
+            cache.iter_lru_items(-1)
+        # An abandoned iterator leaves nothing behind.
+        it = cache.iter_lru_items()
+        next(it)
+        del it
+        self.assertEqual([p for _, p in cache.lru_items()], objs)
+        self.assertEqual(cache.ringlen(), 5)
+
+    def test_iter_lru_items_mutation(self):
+        cache, A, _, load = self._makeClassCache(100)
+        objs = [load(A, i) for i in range(4)]
+        it = cache.iter_lru_items()
+        oid, p = next(it)
+        self.assertIs(p, objs[0])
+        self.assertEqual(oid, p._p_oid)
+        # Objects accessed or loaded during the iteration move past its
+        # end, and ghosts are skipped.
+        p.value
+        objs.append(load(A, 4))
+        cache.invalidate(objs[1]._p_oid)
+        self.assertEqual(cache.ringlen(), 4)
+        self.assertEqual([p for _, p in cache.lru_items()],
+                         [objs[2], objs[3], objs[0], objs[4]])
+        self.assertEqual([p for _, p in it], objs[2:4])
+
+    def test_iter_lru_items_during_incrgc(self):
+        cache, A, _, load = self._makeClassCache(3)
+        objs = [load(A, i) for i in range(5)]
+        it = cache.iter_lru_items()
+        next(it)
+        cache.incrgc()
+        self.assertEqual([p._p_status for p in objs],
+                         ['ghost', 'ghost', 'saved', 'saved', 'saved'])
+        self.assertEqual([p for _, p in it], objs[2:])
+        it = cache.iter_lru_items()
+        next(it)
+        cache.full_sweep()
+        self.assertEqual(list(it), [])
+        self.assertEqual(cache.ringlen(), 0)
+
+    def test_iter_items(self):
+        cache, A, _, load = self._makeClassCache(100)
+        objs = [load(A, i) for i in range(3)]
+        self.assertEqual(sorted(cache.iter_items()), sorted(cache.items()))
+        items = list(cache.iter_items(limit=2))
+        self.assertEqual(len(items), 2)
+        for oid, p in items:
+            self.assertIn(p, objs)
+            self.assertEqual(oid, p._p_oid)
+        self.assertEqual(list(cache.iter_items(0)), [])
+        with self.assertRaises(ValueError):
+            cache.iter_items(-1)
+
+        it = cache.iter_items()
+        next(it)
+        load(A, 3)
+        with self.assertRaises(RuntimeError):
+            next(it)
+
+    def test_many_ghosts(self):
+        # Enough to grow the C implementation's oid index a few times,
+        # with oids of several sizes.
+        cache = self._makeOne()
+        oids = [i.to_bytes(8, 'big') for i in range(2000)]
+        oids += [b'\xff' * 8, b'short', b'longer than eight']
+        ghosts = {}
+        for oid in oids:
+            ghosts[oid] = self._getRealPersistentClass()()
+            cache.new_ghost(oid, ghosts[oid])
+        self.assertEqual(len(cache), len(oids))
+
+        # Ghosts go away with their last reference.
+        for oid in oids[::2]:
+            del ghosts[oid]
+        gc.collect()
+        self.assertEqual(len(cache), len(oids) // 2)
+        for oid in oids:
+            self.assertIs(cache.get(oid), ghosts.get(oid))
+        self.assertEqual(dict(cache.cache_data), ghosts)
+        self.assertEqual(dict(cache.items()), ghosts)
+
+        for oid in oids[1:1000:2]:
+            del cache[oid]
+        self.assertEqual(len(cache), len(oids) // 2 - 500)
+        self.assertIsNone(cache.get(oids[1]))
+        self.assertIs(cache[oids[1001]], ghosts[oids[1001]])
+
+    def test_incrgc_clock_second_chance(self):
+        cache, load = self._makeEvictionCache('clock', 2)
+        objs = [load(i) for i in range(4)]
+        objs[1].value
+        objs[0].value
+        # Accessing them doesn't reorder the ring.
+        self.assertEqual([oid for oid, _ in cache.lru_items()],
+                         [self._numbered_oid(i) for i in range(4)])
+
+        # The referenced objects are moved instead of ghostified.
+        cache.incrgc()
+        self.assertEqual([p._p_status for p in objs],
+                         ['saved', 'saved', 'ghost', 'ghost'])
+        self.assertEqual([oid for oid, _ in cache.lru_items()],
+                         [self._numbered_oid(i) for i in range(2)])
+        self.assertEqual(cache.cache_stats()['evictions'], 2)
+
+        # That used up their second chance.
+        objs.extend(load(i) for i in range(4, 6))
+        cache.incrgc()
+        self.assertEqual([p._p_status for p in objs],
+                         ['ghost', 'ghost', 'ghost', 'ghost',
+                          'saved', 'saved'])
+        self.assertEqual(cache.cache_non_ghost_count, 2)
+
+    def test_incrgc_clock_references_are_per_object(self):
+        # Only the objects that were accessed get a second chance, no
+        # matter how many other objects there are.
+        cache, load = self._makeEvictionCache('clock', 10)
+        objs = [load(i) for i in range(1000)]
+        for p in objs[500:510]:
+            p.value
+        cache.incrgc()
+        self.assertEqual([oid for oid, _ in cache.lru_items()],
+                         [p._p_oid for p in objs[500:510]])
+
+    def test_full_sweep_ignores_eviction_policy(self):
+        for policy in ('slru', '2q', 'arc', 'clock'):
+            cache, load = self._makeEvictionCache(policy, 3)
+            objs = [load(i) for i in range(6)]
+            for p in objs:
+                p.value
+            cache.full_sweep()
+            self.assertEqual(cache.cache_non_ghost_count, 0, policy)
+            self.assertEqual(cache.ringlen(), 0, policy)
+            self.assertEqual(cache.lru_items(), [], policy)
+
+    def _makeSnapshotPath(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        return os.path.join(tmpdir, 'hot.oids')
+
+    def test_snapshot_hot_and_prewarm(self):
+        cache, load = self._makeEvictionCache('lru', 10)
+        objs = [load(i) for i in range(8)]
+        objs[2].value
+        objs[5].value
+        path = self._makeSnapshotPath()
+
+        self.assertEqual(cache.snapshot_hot(path, 4), 4)
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Most recently used first.
+        self.assertEqual(data, b''.join(
+            self._numbered_oid(i) for i in (5, 2, 7, 6)))
+
+        self.assertEqual(cache.snapshot_hot(path), 8)
+        with open(path, 'rb') as f:
+            self.assertEqual(len(f.read()), 64)
+
+        # Load them into a new cache, most recently used last.
+        new_cache, _ = self._makeEvictionCache('lru', 10)
+        P = type(objs[0])
+        oids = []
+
+        def factory(oid):
+            oids.append(oid)
+            return P() if oid != self._numbered_oid(6) else None
+
+        self.assertEqual(new_cache.prewarm(path, factory=factory, limit=5), 4)
+        self.assertEqual(oids, [self._numbered_oid(i)
+                                for i in (5, 2, 7, 6, 4)])
+        self.assertEqual([oid for oid, _ in new_cache.lru_items()],
+                         [self._numbered_oid(i) for i in (4, 7, 2, 5)])
+        for _, obj in new_cache.lru_items():
+            self.assertEqual(obj.value, obj._p_oid)
+
+        # Objects already loaded aren't loaded again.
+        self.assertEqual(new_cache.prewarm(path, factory=factory), 3)
+
+    def test_prewarm_uses_jar_get(self):
+        cache, load = self._makeEvictionCache('lru', 10)
+        objs = [load(i) for i in range(3)]
+        path = self._makeSnapshotPath()
+        cache.snapshot_hot(path)
+
+        new_cache, _ = self._makeEvictionCache('lru', 10)
+        # Without a way to create the objects, nothing happens
+        self.assertEqual(new_cache.prewarm(path), 0)
+
+        P = type(objs[0])
+
+        def get(oid):
+            obj = P()
+            new_cache.new_ghost(oid, obj)
+            return obj
+        new_cache.jar.get = get
+        self.assertEqual(new_cache.prewarm(path), 3)
+        self.assertEqual(new_cache.ringlen(), 3)
+
+    def test_prewarm_bad_file(self):
+        path = self._makeSnapshotPath()
+        with open(path, 'wb') as f:
+            f.write(b'0123456789')
+        cache = self._makeOne()
+        with self.assertRaises(ValueError):
+            cache.prewarm(path)
+
+    def test_snapshot_hot_skips_other_oids(self):
+        cache = self._makeOne()
+        cache[b'short'] = self._makePersist(oid=b'short', state=UPTODATE)
+        path = self._makeSnapshotPath()
+        self.assertEqual(cache.snapshot_hot(path), 0)
+        with self.assertRaises(ValueError):
+            cache.snapshot_hot(path, -1)
+
+    def test_cache_stats_empty(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.cache_stats(), {
+            'hits': 0,
+            'misses': 0,
+            'accesses': 0,
+            'new_ghosts': 0,
+            'incrgc_calls': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            'bytes_reclaimed': 0,
+            'ghost_limit_exceeded': 0,
+            'ghost_releases': 0,
+        })
+
+    def test_cache_stats(self):
+        cache, load = self._makeEvictionCache('lru', 2)
+        objs = [load(i) for i in range(4)]
+        stats = cache.cache_stats(reset=True)
+        self.assertEqual(stats['new_ghosts'], 4)
+        self.assertEqual(stats['misses'], 4)
+        self.assertEqual(stats['hits'], 0)
+
+        cache.get(self._numbered_oid(0))
+        cache.get(b'nonesuch')
+        cache[self._numbered_oid(1)]
+        with self.assertRaises(KeyError):
+            cache[b'nonesuch']
+        objs[0].value
+        objs[1].value
+        objs[2]._p_estimated_size = 1000
+        cache.update_object_size_estimation(objs[2]._p_oid, 1000)
+        cache.incrgc()
+        cache.invalidate([objs[3]._p_oid, b'nonesuch'])
+
+        stats = cache.cache_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['accesses'], 2)
+        self.assertEqual(stats['new_ghosts'], 0)
+        self.assertEqual(stats['incrgc_calls'], 1)
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertGreaterEqual(stats['bytes_reclaimed'], 1000)
+
+        cache.full_sweep()
+        self.assertEqual(cache.cache_stats(True)['evictions'], 4)
+        self.assertEqual(cache.cache_stats()['evictions'], 0)
+
+    def test_cache_stats_setitem(self):
+        # Only lookups count, not storing an object again, as in C.
+        cache, load = self._makeEvictionCache('lru', 2)
+        objs = [load(i) for i in range(2)]
+        cache.cache_stats(reset=True)
+        for obj in objs:
+            cache[obj._p_oid] = obj
+        stats = cache.cache_stats()
+        self.assertEqual(stats['hits'], 0)
+        self.assertEqual(stats['misses'], 0)
+        self.assertEqual(len(cache), 2)
+
 
 class PythonPickleCacheTests(PickleCacheTestMixin, unittest.TestCase):
     # Tests that depend on the implementation details of the
@@ -787,6 +2476,32 @@ class PythonPickleCacheTests(PickleCacheTestMixin, unittest.TestCase):
         from persistent.interfaces import IExtendedPickleCache
         return IExtendedPickleCache
 
+    def test_start_sweeper_without_gil(self):
+        # The sweeps run in the thread using the cache.
+        cache = self._makeOne()
+        sweeper = self._start_sweeper_without_gil(cache)
+        self.assertTrue(sweeper.running)
+        cache.stop_sweeper()
+
+    def test_sweeper_asks_for_sweeps(self):
+        import time
+        cache, load = self._makeEvictionCache('lru', 20)
+        cache.jar._cache = cache
+        for i in range(100):
+            load(i)
+        sweeper = cache.start_sweeper(high_water=50, interval=0.001)
+        self.addCleanup(cache.stop_sweeper)
+        deadline = time.time() + 10
+        while cache._pending_sweep is None and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(cache._pending_sweep, sweeper.sweep)
+        self.assertEqual(cache.cache_non_ghost_count, 100)
+
+        load(100)
+        self.assertEqual(cache.cache_non_ghost_count, 21)
+        cache.stop_sweeper()
+        self.assertIsNone(cache._pending_sweep)
+
     def test_sweep_of_non_deactivating_object(self):
         jar = DummyConnection()
         cache = self._makeOne(jar)
@@ -1256,6 +2971,23 @@ class PythonPickleCacheTests(PickleCacheTestMixin, unittest.TestCase):
 
         self.assertEqual(unraised, [])
 
+    def test_activation_bucket(self):
+        # The same as activation_bucket() in cPickleCache.c.
+        from persistent.picklecache import _activation_bound
+        from persistent.picklecache import _activation_bucket
+        self.assertEqual(_activation_bucket(0.0), 0)
+        self.assertEqual(_activation_bucket(1e-6), 0)
+        self.assertEqual(_activation_bucket(1.5e-6), 1)
+        self.assertEqual(_activation_bucket(2e-6), 1)
+        self.assertEqual(_activation_bucket(3e-6), 2)
+        self.assertEqual(_activation_bucket(0.001), 10)
+        self.assertEqual(_activation_bucket(16.0), 24)
+        self.assertEqual(_activation_bucket(17.0), 25)
+        self.assertEqual(_activation_bucket(1e9), 25)
+        self.assertEqual(_activation_bound(0), 1e-6)
+        self.assertEqual(_activation_bound(10), 0.001024)
+        self.assertEqual(_activation_bound(25), float('inf'))
+
 
 @skipIfNoCExtension
 class CPickleCacheTests(PickleCacheTestMixin, unittest.TestCase):
@@ -1273,6 +3005,21 @@ class CPickleCacheTests(PickleCacheTestMixin, unittest.TestCase):
             __slots__ = ()
         return DummyPersistent
 
+    def test_start_sweeper_without_gil(self):
+        cache = self._makeOne()
+        with self.assertRaises(RuntimeError):
+            self._start_sweeper_without_gil(cache)
+
+    def test_update_object_size_estimation_bad_sizes(self):
+        cache, load = self._makeSizedCache({self._numbered_oid(0): 10},
+                                           exact_sizes=True)
+        obj = load(0)
+        with self.assertRaises(ValueError):
+            cache.update_object_size_estimation(obj._p_oid, -1)
+        with self.assertRaises(OverflowError):
+            cache.update_object_size_estimation(obj._p_oid, 1 << 64)
+        self.assertEqual(cache.total_estimated_size, 10)
+
     def test_inst_does_not_conform_to_IExtendedPickleCache(self):
         # Test that ``@use_c_impl`` is only applying the correct
         # interface declaration to the C implementation.
@@ -1337,6 +3084,131 @@ class CPickleCacheTests(PickleCacheTestMixin, unittest.TestCase):
         self.assertEqual(cache.cache_non_ghost_count, 0)
         self.assertEqual(len(cache), 0)
 
+    def test_exact_sizes_reload(self):
+        # The exact size of a ghost is kept for when it is loaded again.
+        # Objects with other than 8-byte oids have rounded sizes.
+        sizes = {self._numbered_oid(0): 1, self._numbered_oid(1): 10,
+                 b'short': 100}
+        cache, load = self._makeSizedCache(sizes, exact_sizes=True)
+        objs = [load(0), load(1)]
+        other = objs[0].__class__()
+        cache.new_ghost(b'short', other)
+        other._p_activate()
+        self.assertEqual(cache.total_estimated_size, 1 + 10 + 128)
+
+        cache.invalidate([objs[0]._p_oid, b'short'])
+        self.assertEqual(cache.total_estimated_size, 10)
+        objs[0]._p_activate()
+        other._p_activate()
+        self.assertEqual(cache.total_estimated_size, 1 + 10 + 128)
+
+        cache.update_object_size_estimation(objs[1]._p_oid, 1000)
+        objs[1]._p_estimated_size = 1000
+        self.assertEqual(cache.total_estimated_size, 1 + 1000 + 128)
+        cache.full_sweep()
+        self.assertEqual(cache.total_estimated_size, 0)
+
+
+class PickleStateStoreTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from persistent.picklecache import PickleStateStore
+        return PickleStateStore
+
+    def _makeOne(self, max_bytes=100):
+        return self._getTargetClass()(max_bytes)
+
+    def test_ctor(self):
+        store = self._makeOne()
+        self.assertEqual(store.max_bytes, 100)
+        self.assertEqual(store.size, 0)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(self._getTargetClass()().max_bytes, 64 << 20)
+        with self.assertRaises(ValueError):
+            self._makeOne(0)
+
+    def test_get_set(self):
+        store = self._makeOne()
+        self.assertIsNone(store.get(b'a', b'1'))
+        self.assertIsNone(store.get_latest(b'a'))
+        self.assertTrue(store.set(b'a', b'1', b'x' * 10))
+        self.assertTrue(store.set(b'a', b'2', b'y' * 20))
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.size, 30)
+        self.assertEqual(store.get(b'a', b'1'), b'x' * 10)
+        self.assertEqual(store.get_latest(b'a'), (b'y' * 20, b'2'))
+        self.assertIsNone(store.get(b'a', b'3'))
+        # Setting the same revision again replaces its state.
+        self.assertTrue(store.set(b'a', b'1', b'z'))
+        self.assertEqual(store.size, 21)
+        self.assertEqual(store.get_latest(b'a'), (b'y' * 20, b'2'))
+        self.assertEqual(store.stats(),
+                         {'hits': 3, 'misses': 3, 'evictions': 0})
+
+    def test_set_errors(self):
+        store = self._makeOne()
+        with self.assertRaises(TypeError):
+            store.set(b'a', b'1', 'state')
+        self.assertFalse(store.set(b'a', b'1', b'x' * 101))
+        self.assertEqual(len(store), 0)
+
+    def test_lru_eviction(self):
+        store = self._makeOne()
+        for i in range(4):
+            store.set(b'%d' % i, b'1', b'x' * 30)
+        self.assertEqual(len(store), 3)
+        self.assertIsNone(store.get(b'0', b'1'))
+        # Using '1' makes '2' the least recently used.
+        store.get(b'1', b'1')
+        store.set(b'4', b'1', b'x' * 30)
+        self.assertIsNone(store.get_latest(b'2'))
+        self.assertIsNotNone(store.get(b'1', b'1'))
+        self.assertEqual(store.size, 90)
+        self.assertEqual(store.stats(reset=True)['evictions'], 2)
+        self.assertEqual(store.stats(),
+                         {'hits': 0, 'misses': 0, 'evictions': 0})
+
+    def test_invalidate(self):
+        store = self._makeOne()
+        store.set(b'a', b'1', b'x')
+        store.set(b'a', b'2', b'xx')
+        store.set(b'b', b'1', b'yyy')
+        store.set(b'c', b'1', b'zzzz')
+        store.invalidate(b'a')
+        self.assertIsNone(store.get_latest(b'a'))
+        self.assertEqual(store.size, 7)
+        store.invalidate([b'b', b'd'])
+        self.assertIsNone(store.get_latest(b'b'))
+        self.assertEqual(store.get_latest(b'c'), (b'zzzz', b'1'))
+        self.assertEqual(store.size, 4)
+        store.clear()
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.size, 0)
+        self.assertIsNone(store.get_latest(b'c'))
+
+    def test_threads(self):
+        import threading
+        store = self._makeOne(1000)
+
+        def work(n):
+            for i in range(200):
+                oid = b'%d' % (i % 20)
+                store.set(oid, b'%d' % n, b'x' * (i % 7))
+                store.get_latest(oid)
+                if i % 10 == 0:
+                    store.invalidate(oid)
+
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(store.size, 1000)
+        self.assertEqual(
+            store.size,
+            sum(len(store.get(*key)) for key in list(store._states)))
+
 
 class TestWeakValueDictionary(unittest.TestCase):
 